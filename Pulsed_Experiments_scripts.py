@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 from datetime import datetime
 from inspect import signature
@@ -7,6 +8,12 @@ from qcodes.instrument.parameter import ArrayParameter, StandardParameter
 from qcodes.utils.helpers import full_class
 from qcodes.utils.wrappers import do1d
 
+from sequence_cache import (cached_sequence, render_sequence,
+                            SequencePrefetcher)
+from awg_control import upload_package, replace_element_waveforms
+from setting_cache import cached_settings
+from timing_planner import plan_timing
+
 ramp = bb.PulseAtoms.ramp
 sine = bb.PulseAtoms.sine
 
@@ -21,19 +28,20 @@ class ArgumentError(Exception):
 def check_kwargs(func):
     """
     Decorator function that ensures that all kwargs of a function taking
-    only kwargs have been specified.
+    only kwargs have been specified. Kwargs with a default other than None
+    are optional.
     """
 
     params = signature(func).parameters
-    no_of_args = len(params)
+    needed = set(name for name, param in params.items()
+                 if param.default is None)
 
     def wrapper(**kwargs):
 
         given = set(kwargs.keys())
-        needed = set(params.keys())
 
-        if len(kwargs) < no_of_args:
-            missing = needed.difference(given)
+        missing = needed.difference(given)
+        if missing:
             raise ArgumentError('Unspecified arguments: {}'.format(missing))
 
         return func(**kwargs)
@@ -51,7 +59,7 @@ class AverageRampResponse(ArrayParameter):
 
     def __init__(self, name, awg, zi, no_of_avgs, voltages,
                  awg_channel=1,
-                 label=None, unit=None):
+                 label=None, unit=None, single_acquisition=False):
         """
         Instantiate the parameter. The setpoints must be known at
         the time of instantiation and can not be changed.
@@ -65,6 +73,10 @@ class AverageRampResponse(ArrayParameter):
             awg_channel (int): The relevant AWG channel. Each .awg file
                 upload switches the channels off, so we must know this
                 to switch them back on.
+            single_acquisition (bool): If True, all averages are acquired
+                as the segments of a single scope shot while the AWG loops
+                over the ramp (see the loop option of _DPE_makeSequence),
+                instead of one run/get/stop cycle per average.
         """
 
         super().__init__(name, shape=(len(voltages),))
@@ -74,6 +86,7 @@ class AverageRampResponse(ArrayParameter):
         self.awgchannel = awg_channel
 
         self.no_of_avgs = no_of_avgs
+        self.single_acquisition = single_acquisition
 
         self.setpoints = (tuple(voltages),)
         self.setpoint_labels = ('Ramp voltage',)
@@ -95,21 +108,31 @@ class AverageRampResponse(ArrayParameter):
         # and the relevant one must be on Channel 2
         assert self.zi.scope_channels() == 3
 
+        no_of_pulses = len(self.setpoints[0])
+        if self.single_acquisition:
+            self.zi.scope_segments_count(no_of_pulses*self.no_of_avgs)
+            no_of_runs = 1
+        else:
+            no_of_runs = self.no_of_avgs
+
         self.zi.Scope.prepare_scope()
 
-        data = np.zeros(self.zi.scope_segments_count())
+        data = np.zeros(no_of_pulses)
 
         # switch AWG channel on (an .awg file upload will have switched it off)
         self.awg.parameters['ch{}_state'.format(self.awgchannel)].set(1)
 
-        for n in range(self.no_of_avgs):
+        for n in range(no_of_runs):
             self.awg.run()
             temp_data = self.zi.Scope.get()
             self.awg.stop()
-            demod_data_avg = [np.mean(arr) for arr in temp_data[1]]
-            data += np.array(demod_data_avg)
+            # (segments, samples), the segments of a shot are consecutive
+            # ramps of no_of_pulses pulses each
+            segments = np.asarray(temp_data[1])
+            data += segments.reshape(-1, no_of_pulses,
+                                     segments.shape[-1]).mean(axis=(0, 2))
 
-        data /= self.no_of_avgs
+        data /= no_of_runs
 
         return data
 
@@ -119,11 +142,13 @@ class PulseTime(StandardParameter):
     The parameter setting a new pulsetime.
 
     A candidate for a parameter with the most side effects in its set.
-    Builds a new sequence and uploads it to the AWG.
+    Builds a new sequence and uploads it to the AWG. After the first
+    upload, only the waveforms of the modified element are rendered and
+    replaced on the AWG.
     """
 
     def __init__(self, name, basesequence, pos, chan, segname, awg,
-                 awgchannels):
+                 awgchannels, force_upload=False, incremental=True):
         """
         Args:
             name (str): The name of the parameter.
@@ -134,6 +159,10 @@ class PulseTime(StandardParameter):
             awg (Tektronix_AWG5014): An instance of the QCoDeS instrument
             awgchannels (list): The channels on the AWG to upload the sequence
                 to
+            force_upload (bool): Upload the full sequence on every set, even
+                if the resulting sequence is already loaded on the AWG
+            incremental (bool): Only replace the waveforms of the modified
+                element once the full sequence has been uploaded
         """
         super().__init__(name, set_cmd=self.set, get_cmd=self.get)
 
@@ -145,6 +174,10 @@ class PulseTime(StandardParameter):
         self.segname = segname
         self.awg = awg
         self.awgchannels = awgchannels
+        self.force_upload = force_upload
+        self.incremental = incremental
+        self._uploaded = False
+        self._prefetcher = None
 
         # self._instrument = FakeInstrument('Tektronix AWG')
 
@@ -153,9 +186,83 @@ class PulseTime(StandardParameter):
         self.seq.element(self.pos).changeDuration(self.chan,
                                                   self.segname, width)
 
-        package = self.seq.outputForAWGFile()
-        self.awg.make_send_and_load_awg_file(*package[:],
-                                             channels=self.awgchannels)
+        if self._incremental_update():
+            package = self._render(self._element_sequence())
+            try:
+                replace_element_waveforms(self.awg, package, self.pos,
+                                          self.awgchannels)
+            except Exception:
+                # the state of the AWG is unknown, upload everything next time
+                self._uploaded = False
+                raise
+        else:
+            package = self._render(self.seq)
+            upload_package(self.awg, package, channels=self.awgchannels,
+                           force=self.force_upload)
+            self._uploaded = True
+
+    def _incremental_update(self):
+        return self.incremental and self._uploaded and not self.force_upload
+
+    def _render(self, seq):
+        if self._prefetcher is not None:
+            return self._prefetcher.render(seq)
+        # a single point of the sweep, not worth keeping on disk
+        return render_sequence(seq, persist=False)
+
+    def _element_sequence(self, element=None):
+        """
+        A sequence holding only the element to modify, with the sample rate
+        of the full sequence and the voltage ranges of the AWG channels,
+        which the full sequence is set up with as well (see
+        _DPE_makeSequence and _DPE_prepareTektronixAWG), such that its
+        waveforms are rendered identically
+        """
+        if element is None:
+            element = self.seq.element(self.pos)
+        elemseq = bb.Sequence()
+        elemseq.addElement(1, element.copy())
+        elemseq.setSequenceSettings(1, 0, 1, 0, 0)
+        elemseq.setSR(self.seq.SR)
+        for chan, awgchan in zip(self.seq.channels, self.awgchannels):
+            elemseq.setChannelVoltageRange(
+                chan, self.awg.parameters['ch{}_amp'.format(awgchan)].get(),
+                self.awg.parameters['ch{}_offset'.format(awgchan)].get())
+        return elemseq
+
+    def _sequence_for(self, width):
+        """
+        The sequence set renders for a given width, without modifying
+        the base sequence. Once the full sequence has been uploaded this
+        is the modified element only.
+        """
+        if self.incremental and not self.force_upload:
+            element = self.seq.element(self.pos).copy()
+            element.changeDuration(self.chan, self.segname, width)
+            return self._element_sequence(element)
+        seq = copy.deepcopy(self.seq)
+        seq.element(self.pos).changeDuration(self.chan, self.segname, width)
+        return seq
+
+    def prefetch(self, widths, max_ahead=4, processes=None):
+        """
+        Render the sequences of the given widths in a pool of processes
+        ahead of the sweep. Call stop_prefetch when the sweep is done.
+
+        Args:
+            widths (iterable): The widths in the order they will be set
+            max_ahead (int): The maximal number of sequences rendered ahead
+            processes (Optional[int]): The number of worker processes
+        """
+        self.stop_prefetch()
+        self._prefetcher = SequencePrefetcher(self._sequence_for, widths,
+                                              max_ahead=max_ahead,
+                                              processes=processes)
+
+    def stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
 
     def get(self):
         return 1
@@ -193,6 +300,7 @@ def _DPE_prepareKeysight(no_of_pulses=None, cycletime=None, ramp_low=None,
     """
     if None in [no_of_pulses, cycletime, ramp_low, ramp_high, keysight]:
         raise ValueError('Keysight settings underspecified!')
+    keysight = cached_settings(keysight)
 
     keysight.ch1_function_type('RAMP')
     keysight.ch1_ramp_symmetry(100)
@@ -225,6 +333,7 @@ def _DPE_prepareTektronixAWG(awg, awg_channel, SR, pulsehigh):
 
     # NB: If you change these settings, make sure to change them in
     # _DPE_makeSequence as well!
+    awg = cached_settings(awg)
 
     awg.clock_freq(SR)
     awg.parameters['ch{}_amp'.format(awg_channel)].set(2*pulsehigh)
@@ -249,40 +358,43 @@ def _DPE_prepareZIUHFLI(zi, demod_freq, pts_per_shot,
             of scope segments.
         meastime (float): The data acquisition time per point (s)
     """
-
-    # Demodulator
-    zi.oscillator1_freq(demod_freq)
-    zi.demod1_order(1)
-    zi.demod1_timeconstant(0.1*meastime)
-    zi.signal_output1_on('ON')
-    # TODO: use this in post-processing to remove first part of demod. data
-
-    # Scope
-    zi.scope_channel1_input('Demod 1 R')
-    zi.scope_channel2_input('Signal Input 2')
-    zi.scope_mode('Time Domain')
-    zi.scope_samplingrate(SRstring)
-    zi.scope_length(pts_per_shot)
-    zi.scope_channels(3)
-    #
-    zi.scope_trig_enable('ON')
-    # trigger delay reference point: at trigger event time
-    zi.scope_trig_reference(0)
-    zi.scope_trig_delay(1e-6)
-    zi.scope_trig_holdoffmode('s')
-    zi.scope_trig_holdoffseconds(60e-6)
-    zi.scope_trig_gating_enable('OFF')
-    zi.scope_trig_signal('Trig Input 1')
-    #
-    zi.scope_segments('ON')
-    zi.scope_segments_count(no_of_pulses)
+    zi = cached_settings(zi)
+
+    with zi.batched_settings():
+        # Demodulator
+        zi.oscillator1_freq(demod_freq)
+        zi.demod1_order(1)
+        zi.demod1_timeconstant(0.1*meastime)
+        zi.signal_output1_on('ON')
+        # TODO: use this in post-processing to remove first part of demod. data
+
+        # Scope
+        zi.scope_channel1_input('Demod 1 R')
+        zi.scope_channel2_input('Signal Input 2')
+        zi.scope_mode('Time Domain')
+        zi.scope_samplingrate(SRstring)
+        zi.scope_length(pts_per_shot)
+        zi.scope_channels(3)
+        #
+        zi.scope_trig_enable('ON')
+        # trigger delay reference point: at trigger event time
+        zi.scope_trig_reference(0)
+        zi.scope_trig_delay(1e-6)
+        zi.scope_trig_holdoffmode('s')
+        zi.scope_trig_holdoffseconds(60e-6)
+        zi.scope_trig_gating_enable('OFF')
+        zi.scope_trig_signal('Trig Input 1')
+        #
+        zi.scope_segments('ON')
+        zi.scope_segments_count(no_of_pulses)
 
 
 def _DPE_correct_meastime(meastime, npts):
     """
     Given a number of points to measure, and a desired measurement time,
     find the measurement time closest to the given one that the ZI UHF-LI can
-    actually realise.
+    actually realise. The sample rate is chosen by
+    timing_planner.plan_timing.
 
     Args:
         meastime (float): The desired measurement time
@@ -291,25 +403,14 @@ def _DPE_correct_meastime(meastime, npts):
     Returns:
         tuple (float, str): A tuple with the new measurement time and
             a string with the sample rate achieving this
-    """
-
-    # TODO: is a logarithmic error measure better than a linear one?
-
-    # the sample rates of the lock-in
-    SRs = [1.8e9/2**n for n in range(17)]
 
-    realtimes = np.array([npts/SR for SR in SRs])
-    errors = np.abs(meastime-realtimes)
-
-    newtime = realtimes[errors.argmin()]
-
-    SRstrings = ['1.80 GHz', '900 MHz', '450 MHz', '225 MHz', '113 MHz',
-                 '56.2 MHz',
-                 '28.1 MHz', '14.0 MHz', '7.03 MHz', '3.50 MHz', '1.75 MHz',
-                 '880 kHz',
-                 '440 kHz', '220 kHz', '110 kHz', '54.9 kHz', '27.5 kHz']
+    Raises:
+        ValueError: If npts is less than 4096
+    """
 
-    SRstring = SRstrings[errors.argmin()]
+    plan = plan_timing(0, meastime, detector='zi', zi_npts=npts)
+    newtime = plan['zi_npts']/plan['zi_sample_rate']
+    SRstring = plan['zi_sample_rate_string']
 
     # Do some rounding for safety
     newtime = float('{:.4e}'.format(newtime))
@@ -317,8 +418,9 @@ def _DPE_correct_meastime(meastime, npts):
     return newtime, SRstring
 
 
+@cached_sequence
 def _DPE_makeSequence(hightime, trig_delay, meastime, prewaittime, cycletime,
-                      no_of_pulses, pulsehigh, SR, segname):
+                      no_of_pulses, pulsehigh, SR, segname, loop=False):
     """
     Generate the pulse sequence for the experiment.
 
@@ -340,6 +442,8 @@ def _DPE_makeSequence(hightime, trig_delay, meastime, prewaittime, cycletime,
         SR (int): The AWG sample rate (Sa/s)
         segname (str): The name of the high pulse segment as used internally
             by broadbean.
+        loop (bool): If True, the sequence starts over after the last pulse
+            and plays until the AWG is stopped, otherwise it plays once.
     """
 
     waitbits = 100  # no. of repetitions of the first part
@@ -388,8 +492,12 @@ def _DPE_makeSequence(hightime, trig_delay, meastime, prewaittime, cycletime,
 
     seq.setSequenceSettings(1, 0, waitbits, 0, 2)
     seq.setSequenceSettings(2, 0, 1, 0, 3)
-    # the last zero disables jumping, i.e. seq. plays once
-    seq.setSequenceSettings(3, 0, no_of_pulses, 0, 0)
+    if loop:
+        # go back to the wait for the next ramp
+        seq.setSequenceSettings(3, 0, no_of_pulses, 0, 1)
+    else:
+        # the last zero disables jumping, i.e. seq. plays once
+        seq.setSequenceSettings(3, 0, no_of_pulses, 0, 0)
 
     return seq
 
@@ -412,11 +520,19 @@ def doPulsedExperiment(fast_axis=None, slow_axis=None,
                        demod_freq=None,
                        # AWG setting
                        awg_channel=None,
-                       awg=None, ZI=None, keysight=None):
+                       awg=None, ZI=None, keysight=None,
+                       single_acquisition=False, prefetch=False):
     """
     Top level function for performing pulsed experiments, i.e. sending a
     single square pulse riding on a ramp to the sample and measuring by
     demodulating and shining RF with a ZI UHF-LI
+
+    All arguments but single_acquisition and prefetch must be given. If
+    single_acquisition is True, all n_avgs ramps are acquired in one
+    scope shot (see AverageRampResponse). If prefetch is True, the
+    sequences of the sweep are rendered ahead in a pool of processes (see
+    PulseTime.prefetch), which on Windows requires the experiment to be
+    started from a script or an interactive session.
     """
 
     # INPUT VALIDATORS
@@ -466,7 +582,8 @@ def doPulsedExperiment(fast_axis=None, slow_axis=None,
                                       cycletime=cycletime,
                                       no_of_pulses=fast_npts,
                                       pulsehigh=pulsehigh,
-                                      SR=SR, segname='high')
+                                      SR=SR, segname='high',
+                                      loop=single_acquisition)
 
     # Make the two measurement parameters
     if slow_axis == 'dt':
@@ -480,14 +597,22 @@ def doPulsedExperiment(fast_axis=None, slow_axis=None,
     ramp_avg = AverageRampResponse(name='ramp_response', awg=awg, zi=ZI,
                                    no_of_avgs=n_avgs, voltages=voltages,
                                    awg_channel=awg_channel,
-                                   label='Demod response', unit=None)
+                                   label='Demod response', unit=None,
+                                   single_acquisition=single_acquisition)
 
     awg.parameters['pulsetime'] = pulseTime
     pulseTime._instrument = awg
     awg.parameters['ramp_avg'] = ramp_avg
     ramp_avg._instrument = awg
 
-    do1d(pulseTime, slow_start, slow_stop, slow_npts, 0, ramp_avg)
+    # the first width is uploaded in full, the rest are only rendered
+    # and sent element wise and can be prepared during the sweep
+    if prefetch:
+        pulseTime.prefetch(np.linspace(slow_start, slow_stop, slow_npts)[1:])
+    try:
+        do1d(pulseTime, slow_start, slow_stop, slow_npts, 0, ramp_avg)
+    finally:
+        pulseTime.stop_prefetch()
 
 
 def showPulsedExperiment(fast_npts=None,
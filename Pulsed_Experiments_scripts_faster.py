@@ -8,6 +8,8 @@ from qcodes.instrument.parameter import ArrayParameter, StandardParameter
 from qcodes.utils.helpers import full_class
 from qcodes.utils.wrappers import do1d
 
+from timing_planner import plan_timing
+
 ramp = bb.PulseAtoms.ramp
 sine = bb.PulseAtoms.sine
 
@@ -284,7 +286,8 @@ def _DPE_correct_meastime(meastime, npts):
     """
     Given a number of points to measure, and a desired measurement time,
     find the measurement time closest to the given one that the ZI UHF-LI can
-    actually realise.
+    actually realise. The sample rate is chosen by
+    timing_planner.plan_timing.
 
     Args:
         meastime (float): The desired measurement time
@@ -293,25 +296,14 @@ def _DPE_correct_meastime(meastime, npts):
     Returns:
         tuple (float, str): A tuple with the new measurement time and
             a string with the sample rate achieving this
-    """
-
-    # TODO: is a logarithmic error measure better than a linear one?
-
-    # the sample rates of the lock-in
-    SRs = [1.8e9/2**n for n in range(17)]
 
-    realtimes = np.array([npts/SR for SR in SRs])
-    errors = np.abs(meastime-realtimes)
-
-    newtime = realtimes[errors.argmin()]
-
-    SRstrings = ['1.80 GHz', '900 MHz', '450 MHz', '225 MHz', '113 MHz',
-                 '56.2 MHz',
-                 '28.1 MHz', '14.0 MHz', '7.03 MHz', '3.50 MHz', '1.75 MHz',
-                 '880 kHz',
-                 '440 kHz', '220 kHz', '110 kHz', '54.9 kHz', '27.5 kHz']
+    Raises:
+        ValueError: If npts is less than 4096
+    """
 
-    SRstring = SRstrings[errors.argmin()]
+    plan = plan_timing(0, meastime, detector='zi', zi_npts=npts)
+    newtime = plan['zi_npts']/plan['zi_sample_rate']
+    SRstring = plan['zi_sample_rate_string']
 
     # Do some rounding for safety
     newtime = float('{:.4e}'.format(newtime))
@@ -1,15 +1,19 @@
 import logging
-from typing import Union, Sequence, Tuple, List
+import time
+from contextlib import contextmanager
+from typing import Union, Sequence, Tuple, List, Optional, Any
 
 import numpy as np
 
 import alazar_controllers.acq_helpers as helpers
 from qcodes import ChannelList
+from qcodes.utils import validators as vals
 from .alazar_channel import AlazarChannel
 from .alazar_multidim_parameters import AlazarMultiChannelParameter
 from qcodes.instrument_drivers.AlazarTech.ATS import AcquisitionController
 from .acquisition_parameters import AcqVariablesParam, NonSettableDerivedParameter
 from .demodulator import Demodulator
+from .online_statistics import OnlineStatistics
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +32,23 @@ class ATSChannelController(AcquisitionController):
         filter (default 'win'): filter to be used to filter out double freq
             component ('win' - window, 'ls' - least squared, 'ave' - averaging)
         numtaps (default 101): number of freq components used in filter
+        post_acquire_memory_limit (default None): approximate upper bound
+            in bytes on the temporary memory used by post_acquire. If set,
+            non averaged data is processed in slabs along the buffer or
+            record axis (see the post_acquire_chunk_axis parameter)
+        demod_reference (default 'software'): 'software' to demodulate with
+            software reference signals at the nominal demodulation
+            frequencies only, 'B' to use alazar channel B as a measured
+            reference: the demodulated signals are then returned relative
+            to the phase of channel B, measured for every record
+        collect_statistics (default False): accumulate statistics of the
+            raw samples (see OnlineStatistics) buffer by buffer into
+            the statistics attribute
+        trigger_source (default None): object starting the instrument that
+            triggers the alazar, e.g. an awg_control.AWGStarter. Its
+            pre_start_capture, pre_acquire and post_acquire methods, where
+            present, are called at the corresponding steps of every
+            acquisition. See also triggered_by.
         **kwargs: kwargs are forwarded to the Instrument base class
 
     TODO(nataliejpg) test filter options
@@ -39,11 +60,21 @@ class ATSChannelController(AcquisitionController):
     """
 
     filter_dict = {'win': 0, 'ls': 1, 'ave': 2}
+    # seconds spent in post processing per sample and channel, per sample
+    # and demodulation frequency and per acquisition. Overwritten by
+    # calibrate_cost_model
+    default_cost_model = {'per_sample': 1e-8,
+                          'per_demod_sample': 2e-7,
+                          'per_acquisition': 5e-3}
 
     def __init__(self, name,
                  alazar_name: str,
                  filter: str = 'win',
                  numtaps: int =101,
+                 post_acquire_memory_limit: Optional[int] = None,
+                 demod_reference: str = 'software',
+                 collect_statistics: bool = False,
+                 trigger_source: Any = None,
                  **kwargs) -> None:
         super().__init__(name, alazar_name, **kwargs)
         self.filter_settings = {'filter': self.filter_dict[filter],
@@ -65,11 +96,37 @@ class ATSChannelController(AcquisitionController):
         self.add_parameter(name='samples_per_record',
                            alternative='int_time and int_delay',
                            parameter_class=NonSettableDerivedParameter)
+        self.add_parameter(name='post_acquire_memory_limit',
+                           label='Post acquire memory limit',
+                           unit='B',
+                           initial_value=post_acquire_memory_limit,
+                           vals=vals.MultiType(vals.Ints(min_value=1),
+                                               vals.Enum(None)),
+                           get_cmd=None, set_cmd=None)
+        self.add_parameter(name='post_acquire_chunk_axis',
+                           label='Post acquire chunk axis',
+                           initial_value='buffers',
+                           vals=vals.Enum('buffers', 'records'),
+                           get_cmd=None, set_cmd=None)
+        self.add_parameter(name='demod_reference',
+                           label='Demodulation reference',
+                           initial_value=demod_reference,
+                           vals=vals.Enum('software', 'B'),
+                           get_cmd=None, set_cmd=None)
+        self.add_parameter(name='collect_statistics',
+                           label='Collect raw statistics',
+                           initial_value=collect_statistics,
+                           vals=vals.Bool(),
+                           get_cmd=None, set_cmd=None)
 
         self.samples_divisor = self._get_alazar().samples_divisor
 
         self.shape_info = {}
         self.active_channels_nested = []
+        self._stream_outputs = None
+        self.statistics = None
+        self.trigger_source = trigger_source
+        self.cost_model = dict(self.default_cost_model)
         self.board_info = self._get_alazar().get_idn()
 
     def _update_int_time(self, value: Union[float, int], **kwargs) -> None:
@@ -111,6 +168,10 @@ class ATSChannelController(AcquisitionController):
         """
         total_time = (int_time or 0) + (int_delay or 0)
         samples_needed = total_time * sample_rate
+        # don't round up a whole extra divisor for floating point noise,
+        # e.g. when int_time is computed from a number of samples
+        if abs(samples_needed - round(samples_needed)) < 1e-6:
+            samples_needed = round(samples_needed)
         samples_per_record = helpers.roundup(
             samples_needed, self.samples_divisor)
         logger.info("need {} samples round up to {}".format(samples_needed, samples_per_record))
@@ -193,6 +254,185 @@ class ATSChannelController(AcquisitionController):
         self.filter_settings.update({'filter': self.filter_dict[filter],
                                      'numtaps': numtaps})
 
+    def estimate(self, *channels: AlazarChannel,
+                 trigger_period: Optional[float] = None) -> dict:
+        """
+        Estimates the memory use and duration of an acquisition of the given
+        channels with the current settings without arming the card.
+        The configuration is validated in the same way as before an
+        acquisition, i.e. a RuntimeError is raised if the acquisition
+        would fail.
+
+        Args:
+            *channels: the channels that would be acquired together. All
+                channels if none are given.
+            trigger_period: the time between two triggers (records) in
+                seconds, e.g. the cycle time of the pulse sequence. If not
+                given the duration of a record is used which makes the
+                acquisition time a lower bound.
+
+        Returns:
+            dict with the acquisition shape, the DMA buffer size
+            (dma_bytes), the peak host memory (host_memory_peak), the
+            acquisition and post processing times in seconds (the latter
+            from cost_model) and the expected points_per_second.
+        """
+        if not channels:
+            channels = tuple(self.channels)
+        if not channels:
+            raise RuntimeError("No channels to estimate an acquisition for")
+        alazar = self._get_alazar()
+        sample_rate = alazar.get_sample_rate()
+        samples_per_record = self.samples_per_record.get()
+        if samples_per_record is None or self.int_time.get() is None:
+            raise RuntimeError("int_time must be set before estimating an "
+                               "acquisition")
+
+        first = channels[0]
+        shape_flags = (first._average_buffers, first._average_records,
+                       first._integrate_samples)
+        records_per_buffer = first.records_per_buffer.get()
+        buffers_per_acquisition = first.buffers_per_acquisition.get()
+        demods_per_channel = [0] * self.number_of_channels
+        raw_per_channel = [False] * self.number_of_channels
+        signals = 0
+        valid = True
+        for channel in channels:
+            if (channel._average_buffers, channel._average_records,
+                    channel._integrate_samples) != shape_flags:
+                raise RuntimeError("Channels {} and {} do not have the same "
+                                   "shape".format(first.name, channel.name))
+            if (channel.records_per_buffer.get() != records_per_buffer or
+                    channel.buffers_per_acquisition.get() != buffers_per_acquisition):
+                raise RuntimeError("Found non matching records_per_buffer or "
+                                   "buffers_per_acquisition for {} and "
+                                   "{}".format(first.name, channel.name))
+            if channel.dimensions > 0 and channel._stale_setpoints:
+                logger.warning("prepare_channel must be run for {} before "
+                               "acquiring".format(channel.name))
+            alazar_channel = channel.alazar_channel.raw_value
+            if channel._demod:
+                demods_per_channel[alazar_channel] += 1
+                valid &= Demodulator.verify_demod_freq(channel.demod_freq.get(),
+                                                       sample_rate,
+                                                       self.int_time.get())
+            else:
+                raw_per_channel[alazar_channel] = True
+            signals += 1
+
+        average_buffers, average_records, integrate_samples = shape_flags
+        samples_per_buffer = records_per_buffer * samples_per_record
+        max_samples = self.board_info['max_samples']
+        if samples_per_buffer > max_samples:
+            raise RuntimeError("Trying to acquire {} samples in one buffer maximum"
+                               " supported is {}".format(samples_per_buffer, max_samples))
+        if buffers_per_acquisition > 1:
+            allocated_buffers = 4
+        else:
+            allocated_buffers = 1
+
+        # uint16 samples for both channels
+        dma_buffer_bytes = samples_per_buffer * self.number_of_channels * 2
+        dma_bytes = dma_buffer_bytes * allocated_buffers
+
+        streaming = not (average_buffers or average_records or integrate_samples)
+        if streaming:
+            host_buffer_bytes = 0
+            processed_buffers = 1
+        elif average_buffers:
+            host_buffer_bytes = samples_per_buffer * self.number_of_channels * 8
+            processed_buffers = 1
+        else:
+            host_buffer_bytes = dma_buffer_bytes * buffers_per_acquisition
+            processed_buffers = buffers_per_acquisition
+        processed_records = 1 if average_records else records_per_buffer
+        processed_samples = processed_buffers * processed_records * samples_per_record
+
+        bytes_per_sample = 0
+        for ndemods, raw in zip(demods_per_channel, raw_per_channel):
+            if ndemods or raw:
+                bytes_per_sample += helpers.post_processing_bytes_per_sample(ndemods, raw)
+        reference_only = (self.demod_reference.get() == 'B' and
+                          not (demods_per_channel[1] or raw_per_channel[1]))
+        if reference_only:
+            bytes_per_sample += helpers.post_processing_bytes_per_sample(0, False)
+        processing_bytes = bytes_per_sample * processed_samples
+        memory_limit = self.post_acquire_memory_limit.get()
+        if memory_limit is not None and not streaming:
+            # a slab can not be smaller than a single record
+            processing_bytes = min(processing_bytes,
+                                   max(memory_limit,
+                                       bytes_per_sample * samples_per_record))
+
+        output_shape = [buffers_per_acquisition, records_per_buffer, samples_per_record]
+        for axis, averaged in enumerate(shape_flags):
+            if averaged:
+                output_shape[axis] = 1
+        output_bytes = signals * int(np.prod(output_shape)) * 8
+
+        total_samples = buffers_per_acquisition * samples_per_buffer
+        active_channels = sum(1 for ndemods, raw in
+                              zip(demods_per_channel, raw_per_channel)
+                              if ndemods or raw) + int(reference_only)
+        post_processing_time = (self.cost_model['per_acquisition'] +
+                                self.cost_model['per_sample'] *
+                                total_samples * active_channels +
+                                self.cost_model['per_demod_sample'] *
+                                processed_samples * sum(demods_per_channel))
+        if trigger_period is None:
+            trigger_period = samples_per_record / sample_rate
+        acquisition_time = buffers_per_acquisition * records_per_buffer * trigger_period
+        total_time = acquisition_time + post_processing_time
+
+        return {'samples_per_record': samples_per_record,
+                'records_per_buffer': records_per_buffer,
+                'buffers_per_acquisition': buffers_per_acquisition,
+                'allocated_buffers': allocated_buffers,
+                'output_shape': tuple(output_shape),
+                'dma_bytes': dma_bytes,
+                'host_memory_peak': (dma_bytes + host_buffer_bytes +
+                                     processing_bytes + output_bytes),
+                'acquisition_time': acquisition_time,
+                'post_processing_time': post_processing_time,
+                'points_per_second': 1 / total_time,
+                'demod_settings_valid': valid}
+
+    def calibrate_cost_model(self, records: int = 100,
+                             samples_per_record: int = 4096,
+                             num_demods: int = 1) -> dict:
+        """
+        Times the volts conversion and demodulation on random data with the
+        current filter settings and updates cost_model accordingly.
+
+        Args:
+            records: number of records of the test data
+            samples_per_record: number of samples per record of the test data
+            num_demods: number of demodulation frequencies to time
+
+        Returns:
+            the updated cost model
+        """
+        sample_rate = self._get_alazar().get_sample_rate()
+        data = np.random.randint(0, 2**16, size=(1, records, samples_per_record),
+                                 dtype=np.uint16)
+        int_time = samples_per_record / sample_rate
+        demodulator = Demodulator(1, records, samples_per_record, sample_rate,
+                                  self.filter_settings,
+                                  [sample_rate / 10] * num_demods,
+                                  average_buffers=True,
+                                  average_records=False,
+                                  integrate_samples=True)
+        t_start = time.perf_counter()
+        volts = self._to_volts(data)
+        t_volts = time.perf_counter()
+        demodulator.demodulate(volts, 0, int_time)
+        t_demod = time.perf_counter()
+        self.cost_model['per_sample'] = (t_volts - t_start) / data.size
+        self.cost_model['per_demod_sample'] = ((t_demod - t_volts) /
+                                               (data.size * num_demods))
+        logger.info("calibrated cost model: {}".format(self.cost_model))
+        return self.cost_model
+
     def pre_start_capture(self) -> None:
         """
         Called before capture start to update Acquisition Controller with
@@ -219,41 +459,176 @@ class ATSChannelController(AcquisitionController):
 
         # We currently enforce the shape to be identical for all channels
         # so it's safe to take the first
-        if self.shape_info['average_buffers']:
+        self._records_per_buffer = records_per_buffer
+        self._samples_per_record = samples_per_record
+        if self.collect_statistics.get():
+            self.statistics = OnlineStatistics(
+                records_per_buffer, self.number_of_channels,
+                self.board_info['bits_per_sample'])
+        else:
+            self.statistics = None
+        stream = self._streaming()
+        if stream:
+            # buffers are processed as they arrive so there is no need
+            # to keep the raw data around
+            self.buffer = None
+            self._allocate_stream_outputs((buffers_per_acquisition,
+                                           records_per_buffer,
+                                           samples_per_record))
+        elif self.shape_info['average_buffers']:
+            self._stream_outputs = None
             self.buffer = np.zeros(samples_per_record *
                                    records_per_buffer *
                                    self.number_of_channels)
         else:
+            # nothing is summed so the raw samples can be kept as
+            # they are which uses a quarter of the memory of float64
+            self._stream_outputs = None
             self.buffer = np.zeros((buffers_per_acquisition,
                                    samples_per_record *
                                    records_per_buffer *
-                                   self.number_of_channels))
-        self.demodulators = []
-
-        for channel in self.active_channels_nested:
-            if channel['ndemods'] > 0:
-                self.demodulators.append(Demodulator(buffers_per_acquisition,
-                                                     records_per_buffer,
-                                                     samples_per_record,
-                                                     sample_rate,
-                                                     self.filter_settings,
-                                                     channel['demod_freqs'],
-                                                     self.shape_info['average_buffers'],
-                                                     self.shape_info['average_records'],
-                                                     self.shape_info['integrate_samples']
-                                                     ))
+                                   self.number_of_channels),
+                                   dtype=np.uint16)
+        # One demodulator handles the frequencies of all channels such that
+        # both channels are demodulated in a single pass
+        # The channel index is relative to the first stacked channel as only
+        # the channels needed are stacked in _process_block
+        first_channel, _ = self._stacked_channels()
+        demod_freqs = []
+        channel_index = []
+        for channel_number, channel in enumerate(self.active_channels_nested):
+            demod_freqs += channel['demod_freqs']
+            channel_index += [channel_number - first_channel] * len(channel['demod_freqs'])
+        if self.demod_reference.get() == 'B':
+            reference_channel = 1 - first_channel
+        else:
+            reference_channel = None
+        if demod_freqs:
+            self.demodulator = Demodulator(buffers_per_acquisition,
+                                           records_per_buffer,
+                                           samples_per_record,
+                                           sample_rate,
+                                           self.filter_settings,
+                                           demod_freqs,
+                                           self.shape_info['average_buffers'] or stream,
+                                           self.shape_info['average_records'],
+                                           self.shape_info['integrate_samples'],
+                                           channel_index=channel_index,
+                                           reference_channel=reference_channel)
+        else:
+            self.demodulator = None
+        self._call_trigger_source('pre_start_capture')
+
+    def _call_trigger_source(self, hook: str) -> None:
+        """
+        Call the hook method of the trigger source if it has one
+        """
+        if self.trigger_source is not None:
+            method = getattr(self.trigger_source, hook, None)
+            if method is not None:
+                method()
+
+    @contextmanager
+    def triggered_by(self, trigger_source: Any):
+        """
+        Context manager using trigger_source for all acquisitions within
+        the context, the previous trigger source is restored on exit, also
+        on errors.
+
+        Args:
+            trigger_source: see the trigger_source argument of the
+                constructor
+        """
+        previous = self.trigger_source
+        self.trigger_source = trigger_source
+        try:
+            yield trigger_source
+        finally:
+            self.trigger_source = previous
+
+    @contextmanager
+    def collecting_statistics(self, collect: bool = True):
+        """
+        Context manager collecting raw statistics (see the
+        collect_statistics parameter) in all acquisitions within the
+        context only. The previous setting is restored on exit, also on
+        errors, while the statistics of the last acquisition are kept in
+        the statistics attribute.
+
+        Args:
+            collect: whether to collect the statistics
+        """
+        previous = self.collect_statistics.get()
+        self.collect_statistics.set(collect)
+        try:
+            yield
+        finally:
+            self.collect_statistics.set(previous)
+
+    def _stacked_channels(self) -> Tuple[int, int]:
+        """
+        First and last alazar channel that have to be processed, i.e. the
+        active channels and the reference channel if demodulating against
+        a measured reference.
+        """
+        needed = [channel_number for channel_number, channel_info
+                  in enumerate(self.active_channels_nested)
+                  if channel_info['nsignals'] > 0]
+        if self.demod_reference.get() == 'B':
+            needed.append(1)
+        return min(needed), max(needed)
+
+    def _streaming(self) -> bool:
+        """
+        Buffers are processed one by one as they arrive when neither
+        averaging nor integrating, i.e. for 3 dimensional output.
+        """
+        return not (self.shape_info['average_buffers'] or
+                    self.shape_info['average_records'] or
+                    self.shape_info['integrate_samples'])
+
+    def _allocate_stream_outputs(self, shape: Tuple[int, int, int]) -> None:
+        """
+        Preallocate one output array per signal in the order in which the
+        signals are produced by _process_block. Signals that have a data
+        file assigned are written to a memory mapped .npy file.
+        """
+        output_files = self.shape_info.get('output_files') or []
+        signal_channels = self.shape_info['output_order']
+        self._stream_outputs = []
+        for signal_channel in signal_channels:
+            filename = None
+            if signal_channel < len(output_files):
+                filename = output_files[signal_channel]
+            if filename is None:
+                output = np.zeros(shape)
             else:
-                self.demodulators.append(None)
+                logger.info("writing {} output to {}".format(shape, filename))
+                output = np.lib.format.open_memmap(filename, mode='w+',
+                                                   dtype=np.float64,
+                                                   shape=shape)
+            self._stream_outputs.append(output)
 
     def pre_acquire(self):
-        pass
+        self._call_trigger_source('pre_acquire')
 
     def handle_buffer(self, data: np.ndarray, buffernum: int=0):
         """
         Adds data from Alazar to buffer either averaging or appending
-        depending on output type.
+        depending on output type. If not averaging at all the buffer
+        is processed right away and written into the output arrays.
         """
-        if self.shape_info['average_buffers']:
+        if self.statistics is not None:
+            self.statistics.update(data)
+        if self._stream_outputs is not None:
+            block = data.reshape(1,
+                                 self._records_per_buffer,
+                                 self._samples_per_record,
+                                 self.number_of_channels)
+            processed = self._process_block(block, 1)
+            for output, buffer_data in zip(self._stream_outputs, processed):
+                output[buffernum] = buffer_data[0]
+        elif self.shape_info['average_buffers']:
             self.buffer += data
         else:
             self.buffer[buffernum] = data
@@ -273,86 +648,179 @@ class ATSChannelController(AcquisitionController):
         # S00A, S00B, S01A, S01B...S10A, S10B, S11A, S11B...
         # where SXYZ is record X, sample Y, channel Z.
 
+        self._call_trigger_source('post_acquire')
         # break buffer up into records and averages over them
         alazar = self._get_alazar()
         samples_per_record = alazar.samples_per_record.get()
         records_per_buffer = alazar.records_per_buffer.get()
         buffers_per_acquisition = alazar.buffers_per_acquisition.get()
-        if self.shape_info['average_buffers']:
-            number_of_buffers = 1
+        if self._stream_outputs is not None:
+            for output in self._stream_outputs:
+                if isinstance(output, np.memmap):
+                    output.flush()
+            outputdata = list(self._stream_outputs)
         else:
-            number_of_buffers = buffers_per_acquisition
-        reshaped_buf = self.buffer.reshape(number_of_buffers,
-                                           records_per_buffer,
-                                           samples_per_record,
-                                           self.number_of_channels)
-        channelAData = reshaped_buf[..., 0]
-        channelBData = reshaped_buf[..., 1]
-
-        def handle_alazar_channel(channelData,
-                                  channel_number: int,
-                                  raw: bool,
-                                  settings: dict,
-                                  demod_freqs: Sequence[float],
-                                  demod_types: Sequence[str]) -> List[np.ndarray]:
-            # TODO(JHN) could probably get better precision
-            # if we avoid casting back to uint16 after taking the average.
-            # either change the conversion to something that supports floats
-            # or
-            if settings['average_records'] and settings['average_buffers']:
-                recordA = np.uint16(np.mean(channelData, axis=1, keepdims=True) /
-                                    buffers_per_acquisition)
-            elif settings['average_records']:
-                recordA = np.uint16(np.mean(channelData, axis=1, keepdims=True))
-            elif settings['average_buffers']:
-                recordA = np.uint16(channelData/buffers_per_acquisition)
+            if self.shape_info['average_buffers']:
+                number_of_buffers = 1
             else:
-                recordA = np.uint16(channelData)
-            recordA = self._to_volts(recordA)
-
-            data = []
-            if raw:
-                if settings['integrate_samples']:
-                    data.append(np.squeeze(np.mean(recordA, axis=-1)))
-                else:
-                    data.append(np.squeeze(recordA))
-            # do demodulation
-            if demod_freqs:
-                magA, phaseA = self.demodulators[channel_number].demodulate(recordA, self.int_delay(), self.int_time())
-                for i, type in enumerate(demod_types):
-                    if type=='magnitude':
-                        mydata = np.squeeze(magA[i])
-                    elif type == 'phase':
-                        mydata = np.squeeze(phaseA[i])
-                    else:
-                        raise RuntimeError("unknown demodulator type")
-                    if settings['integrate_samples']:
-                        mydata = np.mean(mydata, axis=-1)
-                    data.append(mydata)
-            return data
-
-        if self.active_channels_nested[0]['nsignals']>0:
-            outputdataA = handle_alazar_channel(channelAData, 0, self.active_channels_nested[0]['raw'],
-                                                self.shape_info,
-                                                self.active_channels_nested[0]['demod_freqs'],
-                                                self.active_channels_nested[0]['demod_types'])
-        else:
-            outputdataA = []
-        if self.active_channels_nested[1]['nsignals'] > 0:
-            outputdataB = handle_alazar_channel(channelBData, 1, self.active_channels_nested[1]['raw'],
-                                                self.shape_info,
-                                                self.active_channels_nested[1]['demod_freqs'],
-                                                self.active_channels_nested[1]['demod_types'])
-        else:
-            outputdataB = []
+                number_of_buffers = buffers_per_acquisition
+            reshaped_buf = self.buffer.reshape(number_of_buffers,
+                                               records_per_buffer,
+                                               samples_per_record,
+                                               self.number_of_channels)
+            outputdata = [np.squeeze(data) for data in
+                          self._process_in_slabs(reshaped_buf, buffers_per_acquisition)]
         # ensure that data gets back in the same order
-        outputdata = outputdataA + outputdataB
         outputdata = [outputdata[i] for i in self.shape_info['output_order']]
         if len(outputdata) == 1:
             return outputdata[0]
         else:
             return tuple(outputdata)
 
+    def _slab_axis(self, shape: Tuple[int, ...]) -> Optional[int]:
+        """
+        Axis of a (buffers, records, samples, channels) block along which it
+        can be processed in slabs. This must be an axis which is not averaged
+        over. Returns None if there is no such axis.
+        """
+        axes = {}
+        if not self.shape_info['average_buffers'] and shape[0] > 1:
+            axes['buffers'] = 0
+        if not self.shape_info['average_records'] and shape[1] > 1:
+            axes['records'] = 1
+        preferred = self.post_acquire_chunk_axis.get()
+        if preferred in axes:
+            return axes[preferred]
+        if axes:
+            return next(iter(axes.values()))
+        return None
+
+    def _slab_length(self, shape: Tuple[int, ...], axis: int) -> int:
+        """
+        Number of entries along axis that can be processed at once while
+        staying below post_acquire_memory_limit.
+        """
+        memory_limit = self.post_acquire_memory_limit.get()
+        if memory_limit is None:
+            return shape[axis]
+        bytes_per_sample = 0
+        for channel_info in self.active_channels_nested:
+            if channel_info['nsignals'] > 0:
+                bytes_per_sample += helpers.post_processing_bytes_per_sample(
+                    len(channel_info['demod_freqs']), channel_info['raw'])
+        samples_per_entry = int(np.prod(shape[:3])) // shape[axis]
+        bytes_per_entry = max(bytes_per_sample * samples_per_entry, 1)
+        slab_length = max(int(memory_limit // bytes_per_entry), 1)
+        if slab_length < shape[axis]:
+            logger.info("processing {} {} per slab to stay below {} "
+                        "bytes".format(slab_length,
+                                       self.post_acquire_chunk_axis.get(),
+                                       memory_limit))
+        return min(slab_length, shape[axis])
+
+    def _process_in_slabs(self, block: np.ndarray,
+                          buffers_per_acquisition: int) -> List[np.ndarray]:
+        """
+        Same as _process_block but splits the block into slabs along the
+        buffer or record axis such that the temporary memory stays below
+        post_acquire_memory_limit. The slabs are written into preallocated
+        output arrays.
+        """
+        axis = self._slab_axis(block.shape)
+        if axis is None:
+            return self._process_block(block, buffers_per_acquisition)
+        total_length = block.shape[axis]
+        slab_length = self._slab_length(block.shape, axis)
+        if slab_length >= total_length:
+            return self._process_block(block, buffers_per_acquisition)
+
+        outputdata = None
+        index = [slice(None)] * block.ndim
+        for start in range(0, total_length, slab_length):
+            index[axis] = slice(start, start + slab_length)
+            processed = self._process_block(block[tuple(index)],
+                                            buffers_per_acquisition)
+            if outputdata is None:
+                outputdata = []
+                for data in processed:
+                    shape = list(data.shape)
+                    shape[axis] = total_length
+                    outputdata.append(np.empty(shape, dtype=data.dtype))
+            for output, data in zip(outputdata, processed):
+                output[tuple(index[:data.ndim])] = data
+        return outputdata
+
+    def _process_block(self, block: np.ndarray,
+                       buffers_per_acquisition: int) -> List[np.ndarray]:
+        """
+        Processes a block of data shaped (buffers, records, samples, channels)
+        for all active alazar channels. The channels are stacked and
+        averaged, converted to volts and demodulated together. The returned
+        arrays keep the buffer and record axes such that they can be written
+        into a larger output.
+
+        Args:
+            block: the raw data
+            buffers_per_acquisition: number of buffers summed into block
+                when averaging over buffers
+
+        Returns:
+            List of arrays for channel A followed by channel B
+        """
+        settings = self.shape_info
+        active = [channel_number for channel_number, channel_info
+                  in enumerate(self.active_channels_nested)
+                  if channel_info['nsignals'] > 0]
+        if not active:
+            return []
+        # there are only two channels so the stacked channels are
+        # contiguous and this is a view of shape
+        # (channels, buffers, records, samples)
+        first_channel, last_channel = self._stacked_channels()
+        channelData = np.moveaxis(block[..., first_channel:last_channel + 1], -1, 0)
+
+        # TODO(JHN) could probably get better precision
+        # if we avoid casting back to uint16 after taking the average.
+        # either change the conversion to something that supports floats
+        # or
+        if settings['average_records'] and settings['average_buffers']:
+            records = (np.mean(channelData, axis=2, keepdims=True) /
+                       buffers_per_acquisition)
+        elif settings['average_records']:
+            records = np.mean(channelData, axis=2, keepdims=True)
+        elif settings['average_buffers']:
+            records = channelData/buffers_per_acquisition
+        else:
+            records = channelData
+        records = self._to_volts(records.astype(np.uint16, order='C'))
+
+        if self.demodulator is not None:
+            magnitude, phase = self.demodulator.demodulate(records,
+                                                           self.int_delay(),
+                                                           self.int_time())
+        demod_number = 0
+        data = []
+        for channel_number in active:
+            channel_info = self.active_channels_nested[channel_number]
+            recordA = records[channel_number - first_channel]
+            if channel_info['raw']:
+                if settings['integrate_samples']:
+                    data.append(np.mean(recordA, axis=-1))
+                else:
+                    data.append(recordA)
+            for type in channel_info['demod_types']:
+                if type == 'magnitude':
+                    mydata = magnitude[demod_number]
+                elif type == 'phase':
+                    mydata = phase[demod_number]
+                else:
+                    raise RuntimeError("unknown demodulator type")
+                if settings['integrate_samples']:
+                    mydata = np.mean(mydata, axis=-1)
+                data.append(mydata)
+                demod_number += 1
+        return data
+
     def _to_volts(self, record):
         # convert rec to volts
         bps = self.board_info['bits_per_sample']
@@ -14,17 +14,61 @@ def sample_to_volt_u12(raw_samples, bps, input_range_volts):
     # right_shift 16-bit sample by 4 to get 12 bit sample
     shifted_samples = np.right_shift(raw_samples, 4)
 
+    return code_to_volt(shifted_samples, bps, input_range_volts)
+
+
+def code_to_volt(codes, bps, input_range_volts):
+    """
+    Converts sample codes (after removing the padding bits) to volts.
+    The conversion is linear so it may also be applied to (float)
+    averages of codes
+
+    return:
+        volt_samples
+    """
     # Alazar calibration
     code_zero = (1 << (bps - 1)) - 0.5
     code_range = (1 << (bps - 1)) - 0.5
 
     # Convert to volts
     volt_samples = np.float64(input_range_volts *
-                              (shifted_samples - code_zero) / code_range)
+                              (codes - code_zero) / code_range)
 
     return volt_samples
 
 
+def volts_per_code(bps, input_range_volts):
+    """
+    Volts corresponding to a single code step, i.e. the slope of
+    code_to_volt
+    """
+    code_range = (1 << (bps - 1)) - 0.5
+    return input_range_volts / code_range
+
+
+def post_processing_bytes_per_sample(num_demods, raw=True):
+    """
+    Rough number of bytes of temporary host memory needed to post process
+    a single sample of a single alazar channel. Used to bound the peak
+    memory of the post processing by processing the data in slabs.
+
+    Args:
+        num_demods: number of demodulation frequencies of the channel
+        raw: whether the raw (volts) data is returned as well
+
+    return:
+        bytes per sample
+    """
+    # averaging, uint16 cast and volts conversion
+    nbytes = 24
+    if raw:
+        nbytes += 8
+    # mixing with both references, filtering, complex conversion and
+    # magnitude/phase output for each demodulation frequency
+    nbytes += 96 * num_demods
+    return nbytes
+
+
 def roundup(num, to_nearest):
     """
     Rounds up the 'num' to the nearest multiple of 'to_nearest', all int
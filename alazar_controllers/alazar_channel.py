@@ -1,7 +1,9 @@
 import math
+from typing import Optional
 from qcodes.instrument.channel import InstrumentChannel
 from qcodes.utils import validators as vals
-from .alazar_multidim_parameters import Alazar0DParameter, Alazar1DParameter, Alazar2DParameter
+from .alazar_multidim_parameters import Alazar0DParameter, Alazar1DParameter, Alazar2DParameter, \
+                                        Alazar3DParameter
 from .acquisition_parameters import AcqVariablesParam, NonSettableDerivedParameter
 
 class AlazarChannel(InstrumentChannel):
@@ -17,6 +19,10 @@ class AlazarChannel(InstrumentChannel):
     buffers_vs_records_trace: Integrated over samples. 2D array of buffers vs records
     samples_trace: Averaged over buffers and records. 1D trace as a function of samples (time)
     records_vs_samples_trace: Averaged over buffers. 2D array of records vs samples
+    buffers_vs_records_vs_samples_trace: No averaging. 3D array of buffers vs records
+        vs samples. Each buffer is processed as it arrives and written into the output
+        array, which may be a memory mapped .npy file (see the data_file parameter)
+        such that acquisitions larger than the available RAM are possible.
 
     """
 
@@ -39,9 +45,6 @@ class AlazarChannel(InstrumentChannel):
         else:
             self._stale_setpoints = False
 
-        if self.dimensions >= 3:
-            raise RuntimeError("Alazar controller only supports up to 2 dimensional arrays")
-
         self._demod = demod
         if demod:
             self.add_parameter('demod_freq',
@@ -111,6 +114,22 @@ class AlazarChannel(InstrumentChannel):
                                average_records=average_records,
                                average_buffers=average_buffers,
                                parameter_class=Alazar2DParameter)
+        elif self.dimensions == 3:
+            self.add_parameter('data',
+                               label='mydata',
+                               unit='V',
+                               integrate_samples=integrate_samples,
+                               average_records=average_records,
+                               average_buffers=average_buffers,
+                               parameter_class=Alazar3DParameter)
+            self.add_parameter('data_file',
+                               label='Data file',
+                               initial_value=None,
+                               vals=vals.MultiType(vals.Strings(), vals.Enum(None)),
+                               docstring='Path of a .npy file that the data is '
+                                         'written to as a memory mapped array. '
+                                         'If None the data is kept in memory.',
+                               get_cmd=None, set_cmd=None)
         else:
             raise RuntimeError("Not implemented here")
 
@@ -121,6 +140,13 @@ class AlazarChannel(InstrumentChannel):
             self.data.set_setpoints_and_labels()
             self._stale_setpoints = False
 
+    def estimate(self, trigger_period: Optional[float] = None) -> dict:
+        """
+        Estimates memory use and duration of acquiring this channel.
+        See ATSChannelController.estimate
+        """
+        return self._parent.estimate(self, trigger_period=trigger_period)
+
     def _update_num_avg(self, value: int, **kwargs) -> None:
         # allow unused **kwargs as the function may be
         # called with additional unused args
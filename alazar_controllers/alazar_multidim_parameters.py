@@ -121,6 +121,8 @@ class AlazarNDParameter(ArrayParameter):
         cntrl.shape_info['average_records'] = channel._average_records
         cntrl.shape_info['integrate_samples'] = channel._integrate_samples
         cntrl.shape_info['output_order'] = [0]
+        if 'data_file' in channel.parameters:
+            cntrl.shape_info['output_files'] = [channel.data_file.get()]
 
         params_to_kwargs = ['samples_per_record', 'records_per_buffer',
                             'buffers_per_acquisition', 'allocated_buffers']
@@ -272,6 +274,53 @@ class Alazar2DParameter(AlazarNDParameter):
         self.setpoints = (outer_setpoints, tuple(inner_setpoints for _ in range(len(outer_setpoints))))
 
 
+class Alazar3DParameter(AlazarNDParameter):
+    def __init__(self,
+                 name: str,
+                 instrument,
+                 label: str,
+                 unit: str,
+                 average_buffers: bool=False,
+                 average_records: bool=False,
+                 integrate_samples: bool=False,
+                 shape: Sequence[int] = (1, 1, 1),
+                 setpoint_names: Sequence[str] = None,
+                 setpoint_labels: Sequence[str] = None,
+                 setpoint_units: Sequence[str] = None) -> None:
+        if average_buffers or average_records or integrate_samples:
+            raise RuntimeError("A 3D Alazar parameter can not average or integrate")
+        setpoint_names = ('buffers', 'records', 'time')
+        setpoint_labels = ('Buffers', 'Records', 'Time')
+        setpoint_units = ('', '', 'S')
+        super().__init__(name,
+                         unit=unit,
+                         label=label,
+                         shape=shape,
+                         instrument=instrument,
+                         setpoint_names=setpoint_names,
+                         setpoint_labels=setpoint_labels,
+                         setpoint_units=setpoint_units,
+                         average_buffers=average_buffers,
+                         average_records=average_records,
+                         integrate_samples=integrate_samples)
+
+    def set_setpoints_and_labels(self):
+        records = self._instrument.records_per_buffer()
+        buffers = self._instrument.buffers_per_acquisition()
+        samples = self._instrument._parent.samples_per_record.get()
+        sample_rate = self._instrument._parent._get_alazar().get_sample_rate()
+        stop = samples/sample_rate
+        self.shape = (buffers, records, samples)
+        # The setpoints of a 3D array may be as large as the data itself, so
+        # use read only broadcast views rather than nested tuples.
+        outer_setpoints = np.linspace(0, buffers, buffers, endpoint=False)
+        middle_setpoints = np.broadcast_to(
+            np.linspace(0, records, records, endpoint=False), (buffers, records))
+        inner_setpoints = np.broadcast_to(
+            np.linspace(0, stop, samples, endpoint=False), (buffers, records, samples))
+        self.setpoints = (outer_setpoints, middle_setpoints, inner_setpoints)
+
+
 class AlazarMultiChannelParameter(MultiChannelInstrumentParameter):
     """
 
@@ -318,6 +367,10 @@ class AlazarMultiChannelParameter(MultiChannelInstrumentParameter):
                 output_order += achan['raw_order']
                 output_order += achan['demod_order']
             cntrl.shape_info['output_order'] = output_order
+            cntrl.shape_info['output_files'] = [channel.data_file.get()
+                                                if 'data_file' in channel.parameters
+                                                else None
+                                                for channel in self._channels]
             params_to_kwargs = ['samples_per_record', 'records_per_buffer',
                                 'buffers_per_acquisition', 'allocated_buffers']
             acq_kwargs = channel.acquisition_kwargs.copy()
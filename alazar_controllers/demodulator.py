@@ -59,7 +59,33 @@ class Demodulator:
                  demod_freqs,
                  average_buffers: bool=True,
                  average_records: bool=True,
-                 integrate_samples: bool=True):
+                 integrate_samples: bool=True,
+                 channel_index=None,
+                 reference_channel=None):
+        """
+        Args:
+            buffers_per_acquisition: number of buffers in the acquisition
+            records_per_buffer: number of records per buffer
+            samples_per_record: number of samples per record
+            sample_rate: sampling rate of the alazar
+            filter_settings: dict with the filter type and numtaps
+            demod_freqs: demodulation frequencies
+            average_buffers: whether the records are averaged over buffers
+            average_records: whether the records are averaged over records
+            integrate_samples: whether to apply the integration limits
+            channel_index (optional): for each demodulation frequency the
+                index of the alazar channel to demodulate. If given the records
+                passed to demodulate are stacked along a leading channel axis
+                which allows demodulating several channels with their own
+                frequency tables in one call. The low pass filter cutoff is
+                chosen per channel.
+            reference_channel (optional): index of a channel along the stacked
+                channel axis (requires channel_index) which carries a copy of
+                the excitation signal. The phase of this reference is measured
+                for every record at each demodulation frequency and the
+                demodulated signals are returned relative to it, removing any
+                phase drift between the signal source and the alazar clock.
+        """
 
         self.filter_settings = filter_settings
         self.sample_rate = sample_rate
@@ -78,14 +104,33 @@ class Demodulator:
         mat_shape = (num_demods, len_buffers,
                      len_records, samples_per_record)
         self.mat_shape = mat_shape
+        # The reference signals only depend on the sample index so they are
+        # stored once and broadcast over buffers and records. This keeps the
+        # memory use independent of the number of buffers and records and
+        # allows demodulating a slab of buffers or records at a time.
         integer_list = np.arange(samples_per_record)
-        integer_mat = (np.outer(np.ones(len_buffers),
-                                np.outer(np.ones(len_records), integer_list)))
         angle_mat = 2 * np.pi * \
-                    np.outer(demod_freqs, integer_mat).reshape(mat_shape) / sample_rate
+                    np.outer(demod_freqs, integer_list).reshape(
+                        (num_demods, 1, 1, samples_per_record)) / sample_rate
         self.cos_mat = np.cos(angle_mat)
         self.sin_mat = np.sin(angle_mat)
         self.integrate_samples = integrate_samples
+        self.samples_per_record = samples_per_record
+
+        if reference_channel is not None and channel_index is None:
+            raise RuntimeError("A reference channel requires stacked channels "
+                               "i.e. a channel_index")
+        self.reference_channel = reference_channel
+
+        if channel_index is None:
+            self.channel_index = None
+            self.cutoffs = np.full(num_demods, max(demod_freqs)/10)
+        else:
+            self.channel_index = np.array(channel_index)
+            self.cutoffs = np.zeros(num_demods)
+            for channel in np.unique(self.channel_index):
+                in_channel = self.channel_index == channel
+                self.cutoffs[in_channel] = self.demod_freqs[in_channel].max()/10
 
     def demodulate(self, volt_rec, int_delay, int_time):
         """
@@ -95,44 +140,48 @@ class Demodulator:
         Args:
             record (numpy array): record from alazar to be multiplied
                                   with the software signal, filtered and limited
-                                  to ifantegration limits shape = (samples_taken, )
+                                  to ifantegration limits
+                                  shape = (buffers, records, samples_taken)
+                                  where buffers and records may be any slab
+                                  of the full acquisition. If channel_index
+                                  is set the records of all channels stacked
+                                  shape = (channels, buffers, records,
+                                           samples_taken)
 
         Returns:
-            magnitude (numpy array): shape = (demod_length, samples_after_limiting)
-            phase (numpy array): shape = (demod_length, samples_after_limiting)
+            magnitude (numpy array): shape = (demod_length, buffers, records,
+                                              samples_after_limiting)
+            phase (numpy array): shape = (demod_length, buffers, records,
+                                          samples_after_limiting)
         """
 
-        # volt_rec to matrix and multiply with demodulation signal matrices
-        demod_length = len(self.demod_freqs)
-        volt_rec_mat = np.outer(np.ones(demod_length), volt_rec).reshape(self.mat_shape)
-        re_mat = np.multiply(volt_rec_mat, self.cos_mat)
-        im_mat = np.multiply(volt_rec_mat, self.sin_mat)*0
+        if self.channel_index is None:
+            # multiply with demodulation signal matrices broadcasting
+            # the record over the demodulation frequencies
+            volt_rec_mat = volt_rec[np.newaxis, ...]
+            re_mat = np.multiply(volt_rec_mat, self.cos_mat)
+            im_mat = np.multiply(volt_rec_mat, self.sin_mat)*0
+        else:
+            # pick the channel belonging to each demodulation frequency
+            # and multiply in place to avoid another full size temporary
+            re_mat = volt_rec[self.channel_index]
+            im_mat = np.multiply(re_mat, self.sin_mat)
+            if self.reference_channel is None:
+                im_mat *= 0
+            re_mat *= self.cos_mat
 
         # filter out higher freq component
-        cutoff = max(self.demod_freqs)/10
-        if self.filter_settings['filter'] == 0:
-            re_filtered = filter_win(re_mat, cutoff,
-                                     self.sample_rate,
-                                     self.filter_settings['numtaps'],
-                                     axis=-1)
-            im_filtered = filter_win(im_mat, cutoff,
-                                     self.sample_rate,
-                                     self.filter_settings['numtaps'],
-                                     axis=-1)
-        elif self.filter_settings['filter'] == 1:
-            re_filtered = filter_ls(re_mat, cutoff,
-                                    self.sample_rate,
-                                    self.filter_settings['numtaps'],
-                                    axis=-1)
-            im_filtered = filter_ls(im_mat, cutoff,
-                                    self.sample_rate,
-                                    self.filter_settings['numtaps'],
-                                    axis=-1)
-        elif self.filter_settings['filter'] == 2:
-            re_filtered = re_mat
-            im_filtered = im_mat
+        cutoffs = np.unique(self.cutoffs)
+        if len(cutoffs) == 1:
+            re_filtered = self._filter(re_mat, cutoffs[0])
+            im_filtered = self._filter(im_mat, cutoffs[0])
         else:
-            raise RuntimeError("Filter setting: {} not implemented".format(self.filter_settings['filter']))
+            re_filtered = np.empty_like(re_mat)
+            im_filtered = np.empty_like(im_mat)
+            for cutoff in cutoffs:
+                rows = self.cutoffs == cutoff
+                re_filtered[rows] = self._filter(re_mat[rows], cutoff)
+                im_filtered[rows] = self._filter(im_mat[rows], cutoff)
 
         if self.integrate_samples:
             # apply integration limits
@@ -147,11 +196,61 @@ class Demodulator:
 
         # convert to magnitude and phase
         complex_mat = re_limited + im_limited * 1j
+        if self.reference_channel is not None:
+            complex_mat *= np.conj(self.reference_phasor(
+                volt_rec[self.reference_channel], int_delay, int_time))
         magnitude = abs(complex_mat)
         phase = np.angle(complex_mat, deg=True)
 
         return magnitude, phase
 
+    def reference_phasor(self, ref_rec, int_delay, int_time):
+        """
+        Measures the phase of a reference record at each demodulation
+        frequency within the integration limits. This is a single matrix
+        product over all buffers and records.
+
+        Args:
+            ref_rec (numpy array): reference records in volts
+                                   shape = (buffers, records, samples_taken)
+            int_delay: start of the integration window (s)
+            int_time: length of the integration window (s)
+
+        Returns:
+            unit phasors shape = (demod_length, buffers, records, 1)
+        """
+        beginning = int(int_delay * self.sample_rate)
+        end = beginning + int(int_time * self.sample_rate)
+        if end <= beginning:
+            end = self.samples_per_record
+        # same convention as the mixing in demodulate: cos + i sin
+        reference = (self.cos_mat + 1j * self.sin_mat)[:, 0, 0, beginning:end]
+        iq = np.matmul(ref_rec[..., beginning:end], reference.T)
+        magnitude = np.abs(iq)
+        magnitude[magnitude == 0] = 1
+        phasor = iq / magnitude
+        return np.moveaxis(phasor, -1, 0)[..., np.newaxis]
+
+    def _filter(self, mat, cutoff):
+        """
+        Applies the low pass filter selected in filter_settings along
+        the samples axis
+        """
+        if self.filter_settings['filter'] == 0:
+            return filter_win(mat, cutoff,
+                              self.sample_rate,
+                              self.filter_settings['numtaps'],
+                              axis=-1)
+        elif self.filter_settings['filter'] == 1:
+            return filter_ls(mat, cutoff,
+                             self.sample_rate,
+                             self.filter_settings['numtaps'],
+                             axis=-1)
+        elif self.filter_settings['filter'] == 2:
+            return mat
+        else:
+            raise RuntimeError("Filter setting: {} not implemented".format(self.filter_settings['filter']))
+
     @staticmethod
     def verify_demod_freq(value, sample_rate, int_time):
         """
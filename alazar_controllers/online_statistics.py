@@ -0,0 +1,201 @@
+import logging
+from typing import Optional
+
+import numpy as np
+
+import alazar_controllers.acq_helpers as helpers
+
+logger = logging.getLogger(__name__)
+
+
+class OnlineStatistics:
+    """
+    Accumulates statistics of the raw samples of an acquisition buffer by
+    buffer, such that no extra pass over the full data is needed after
+    the acquisition.
+
+    For every channel and record the mean and variance over all samples
+    of all buffers is accumulated, combining the per buffer mean and
+    variance with the parallel version of Welford's algorithm. For every
+    channel and buffer the mean and variance over all samples of all
+    records of the buffer are kept, i.e. the statistics per setpoint if
+    every buffer is one setpoint. For every channel the minimum and
+    maximum code, the number of samples at either clipping edge and a
+    histogram of the codes are kept as well.
+
+    Everything is accumulated in codes, the volts properties apply the
+    (linear) alazar calibration.
+
+    Args:
+        records_per_buffer: number of records in a buffer
+        number_of_channels: number of channels interleaved in a buffer
+        bits_per_sample: bits per sample of the alazar card
+        input_range_volts: input range used to convert codes to volts
+        histogram_bins: number of bins of the code histogram. Must be a
+            power of two not larger than the number of codes
+    """
+
+    def __init__(self, records_per_buffer: int,
+                 number_of_channels: int = 2,
+                 bits_per_sample: int = 12,
+                 input_range_volts: float = 0.4,
+                 histogram_bins: int = 256) -> None:
+        self.records_per_buffer = records_per_buffer
+        self.number_of_channels = number_of_channels
+        self.bits_per_sample = bits_per_sample
+        self.input_range_volts = input_range_volts
+        self.max_code = (1 << bits_per_sample) - 1
+        self._shift = 16 - bits_per_sample
+        self._histogram_shift = bits_per_sample - int(np.log2(histogram_bins))
+        if self._histogram_shift < 0:
+            raise ValueError("Can not make a histogram with {} bins of {} "
+                             "bit samples".format(histogram_bins,
+                                                  bits_per_sample))
+        self.histogram_bins = histogram_bins
+        self.reset()
+
+    def reset(self) -> None:
+        shape = (self.number_of_channels, self.records_per_buffer)
+        self.buffers = 0
+        self.count = 0
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self._buffer_means = []
+        self._buffer_m2s = []
+        self.min_code = np.full(self.number_of_channels, self.max_code)
+        self.max_code_seen = np.zeros(self.number_of_channels, dtype=np.int64)
+        self.clipped_low = np.zeros(self.number_of_channels, dtype=np.int64)
+        self.clipped_high = np.zeros(self.number_of_channels, dtype=np.int64)
+        self.histogram = np.zeros((self.number_of_channels,
+                                   self.histogram_bins), dtype=np.int64)
+
+    def update(self, data: np.ndarray) -> None:
+        """
+        Add a single raw buffer
+
+        Args:
+            data: the buffer as returned by the alazar, samples
+                interleaved by channel
+        """
+        # (channels, records, samples) view of the 12 bit codes
+        codes = np.right_shift(data, self._shift).reshape(
+            self.records_per_buffer, -1, self.number_of_channels)
+        codes = np.moveaxis(codes, -1, 0)
+        samples = codes.shape[-1]
+
+        batch_mean = codes.mean(axis=-1)
+        batch_m2 = codes.var(axis=-1) * samples
+        # Chan et al. combination of the accumulated and the batch moments
+        total = self.count + samples
+        delta = batch_mean - self._mean
+        self._mean += delta * samples / total
+        self._m2 += batch_m2 + delta**2 * self.count * samples / total
+        self.count = total
+        self.buffers += 1
+
+        # the moments of this buffer over all of its records
+        buffer_mean = batch_mean.mean(axis=-1)
+        self._buffer_means.append(buffer_mean)
+        self._buffer_m2s.append(
+            batch_m2.sum(axis=-1) +
+            samples * ((batch_mean - buffer_mean[:, np.newaxis])**2).sum(axis=-1))
+
+        flat = codes.reshape(self.number_of_channels, -1)
+        self.min_code = np.minimum(self.min_code, flat.min(axis=-1))
+        self.max_code_seen = np.maximum(self.max_code_seen, flat.max(axis=-1))
+        self.clipped_low += np.count_nonzero(flat == 0, axis=-1)
+        self.clipped_high += np.count_nonzero(flat == self.max_code, axis=-1)
+        for channel_number in range(self.number_of_channels):
+            self.histogram[channel_number] += np.bincount(
+                np.right_shift(flat[channel_number], self._histogram_shift),
+                minlength=self.histogram_bins)
+
+    @property
+    def buffer_mean_codes(self) -> np.ndarray:
+        """
+        Mean code per channel and buffer, shape (channels, buffers)
+        """
+        if not self._buffer_means:
+            return np.zeros((self.number_of_channels, 0))
+        return np.stack(self._buffer_means, axis=-1)
+
+    @property
+    def buffer_variance_codes(self) -> np.ndarray:
+        """
+        Sample variance in codes squared per channel and buffer
+        """
+        samples = self.count // max(self.buffers, 1) * self.records_per_buffer
+        if not self._buffer_m2s or samples < 2:
+            return np.full((self.number_of_channels, len(self._buffer_m2s)),
+                           np.nan)
+        return np.stack(self._buffer_m2s, axis=-1) / (samples - 1)
+
+    def _to_volts(self, codes):
+        return helpers.code_to_volt(codes, self.bits_per_sample,
+                                    self.input_range_volts)
+
+    @property
+    def mean_codes(self) -> np.ndarray:
+        """
+        Mean code per channel and record, shape (channels, records)
+        """
+        return self._mean.copy()
+
+    @property
+    def variance_codes(self) -> np.ndarray:
+        """
+        Sample variance in codes squared per channel and record
+        """
+        if self.count < 2:
+            return np.full_like(self._m2, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def mean_volts(self) -> np.ndarray:
+        """
+        Mean per channel and record in volts, shape (channels, records)
+        """
+        return self._to_volts(self._mean)
+
+    @property
+    def variance_volts(self) -> np.ndarray:
+        """
+        Sample variance per channel and record in volts squared
+        """
+        scale = helpers.volts_per_code(self.bits_per_sample,
+                                       self.input_range_volts)
+        return self.variance_codes * scale**2
+
+    @property
+    def buffer_mean_volts(self) -> np.ndarray:
+        """
+        Mean per channel and buffer in volts, shape (channels, buffers)
+        """
+        return self._to_volts(self.buffer_mean_codes)
+
+    @property
+    def buffer_variance_volts(self) -> np.ndarray:
+        """
+        Sample variance per channel and buffer in volts squared
+        """
+        scale = helpers.volts_per_code(self.bits_per_sample,
+                                       self.input_range_volts)
+        return self.buffer_variance_codes * scale**2
+
+    @property
+    def min_volts(self) -> np.ndarray:
+        return self._to_volts(self.min_code)
+
+    @property
+    def max_volts(self) -> np.ndarray:
+        return self._to_volts(self.max_code_seen)
+
+    def clipped_fraction(self, channel_number: Optional[int] = None):
+        """
+        Fraction of the samples at either edge of the input range
+        """
+        samples = max(self.count * self.records_per_buffer, 1)
+        fraction = (self.clipped_low + self.clipped_high) / samples
+        if channel_number is None:
+            return fraction
+        return fraction[channel_number]
@@ -0,0 +1,390 @@
+# Module containing helpers for uploading sequences to the Tektronix AWGs
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from qcodes import Parameter
+
+from sequence_cache import render_sequence
+
+log = logging.getLogger(__name__)
+
+# The hash of the package last uploaded to each AWG
+_loaded_packages = WeakKeyDictionary()
+
+
+def _update_hash(sha, obj):
+    if isinstance(obj, (list, tuple)):
+        sha.update(b'[')
+        for entry in obj:
+            _update_hash(sha, entry)
+        sha.update(b']')
+    else:
+        array = np.ascontiguousarray(obj)
+        sha.update('{}{}'.format(array.dtype.str, array.shape).encode('utf-8'))
+        sha.update(array.tobytes())
+
+
+def package_hash(package, channels=None):
+    """
+    Content hash of a package as returned by Sequence.outputForAWGFile(),
+    i.e. nested lists of waveform and marker arrays followed by lists of
+    sequencing settings
+
+    Args:
+        package (tuple): The package
+        channels (Optional[list]): The channels the package is uploaded to
+    """
+    sha = hashlib.sha1()
+    sha.update(repr(channels).encode('utf-8'))
+    _update_hash(sha, tuple(package))
+    return sha.hexdigest()
+
+
+def _sequence_length_matches(awg, package):
+    """
+    Cheap check that the AWG was not reset or reloaded by hand since our
+    last upload. The sequencing settings are the fourth entry of the
+    package, one per sequence element.
+    """
+    if 'sequence_length' not in awg.parameters:
+        return True
+    try:
+        return int(awg.sequence_length.get()) == len(package[3])
+    except Exception as e:
+        log.warning('Could not read the sequence length of {}: '
+                    '{}'.format(awg.name, e))
+        return False
+
+
+def _awg_file_api(awg):
+    """
+    The waveform packing and .awg file generating methods of an AWG5014
+    driver. Newer qcodes versions made them private and keep the public
+    names only as deprecated wrappers, so both are taken from the same
+    generation of the API.
+    """
+    if hasattr(awg, '_generate_awg_file'):
+        return awg._pack_waveform, awg._generate_awg_file
+    return awg.pack_waveform, awg.generate_awg_file
+
+
+def make_deduplicated_awg_file(awg, package, channels=None):
+    """
+    Make an .awg file from a package like Tektronix_AWG5014.make_awg_file,
+    but storing every distinct waveform (including its markers) only once.
+    Sequence elements with identical waveforms refer to the same entry of
+    the waveform list, which makes the file smaller and saves waveform
+    memory on the AWG.
+
+    Args:
+        awg (Tektronix_AWG5014): The relevant awg
+        package (tuple): The output of Sequence.outputForAWGFile()
+        channels (Optional[list]): The channels to upload to. Default is
+            channels 1, 2, ...
+
+    Returns:
+        bytes: The .awg file
+    """
+    waveforms, m1s, m2s, nreps, trig_waits, goto_states, jump_tos = package[:7]
+    pack_waveform, generate_awg_file = _awg_file_api(awg)
+    if not isinstance(waveforms[0], list):
+        waveforms = [waveforms]
+        m1s = [m1s]
+        m2s = [m2s]
+
+    packed_wfs = {}
+    names_by_hash = {}
+    waveform_names = []
+    for ii in range(len(waveforms)):
+        channel = ii + 1 if channels is None else channels[ii]
+        namelist = []
+        for jj in range(len(waveforms[ii])):
+            sha = hashlib.sha1()
+            _update_hash(sha, (waveforms[ii][jj], m1s[ii][jj], m2s[ii][jj]))
+            # the AWG file takes the channel from the end of the name, so
+            # waveforms are only shared within a channel
+            key = (channel, sha.hexdigest())
+            if key not in names_by_hash:
+                # named after the first element and channel using it
+                thisname = 'wfm{:03d}ch{}'.format(jj + 1, channel)
+                names_by_hash[key] = thisname
+                packed_wfs[thisname] = pack_waveform(waveforms[ii][jj],
+                                                     m1s[ii][jj],
+                                                     m2s[ii][jj])
+            namelist.append(names_by_hash[key])
+        waveform_names.append(namelist)
+    wavenamearray = np.array(waveform_names, dtype='str')
+
+    total = sum(len(namelist) for namelist in waveform_names)
+    log.info('Uploading {} distinct waveforms for {} sequence '
+             'entries'.format(len(packed_wfs), total))
+
+    return generate_awg_file(packed_wfs, wavenamearray, nreps,
+                             trig_waits, goto_states, jump_tos, {},
+                             preservechannelsettings=True)
+
+
+def send_and_load_awg_file(awg, awg_file, filename='customawgfile.awg'):
+    """
+    Send an .awg file to an AWG (5014C) and load it, the same way as
+    Tektronix_AWG5014.make_send_and_load_awg_file does
+    """
+    # by default, an unusable directory is targeted on the AWG
+    awg.visa_handle.write('MMEMory:CDIRectory '
+                          '"C:\\Users\\OEM\\Documents"')
+    awg.send_awg_file(filename, awg_file)
+    currentdir = awg.visa_handle.query('MMEMory:CDIRectory?')
+    currentdir = currentdir.replace('"', '').replace('\n', '\\')
+    loadfrom = '{}{}'.format(currentdir, filename)
+    awg.load_awg_file(loadfrom)
+
+
+def upload_package(awg, package, channels=None, force=False, dedupe=True):
+    """
+    Send and load a package on an AWG (5014C) unless the very same package
+    is already loaded there.
+
+    Which package is loaded is remembered per AWG in this session. If the
+    AWG is changed by other means, call forget_loaded_package or pass
+    force=True.
+
+    Args:
+        awg (Tektronix_AWG5014): The relevant awg
+        package (tuple): The output of Sequence.outputForAWGFile()
+        channels (Optional[list]): The channels to upload to. Default is
+            the driver default.
+        force (bool): Upload even if the package is already loaded
+        dedupe (bool): Store identical waveforms only once (see
+            make_deduplicated_awg_file)
+
+    Returns:
+        bool: Whether the package was uploaded
+    """
+    new_hash = package_hash(package, channels)
+    if (not force and _loaded_packages.get(awg) == new_hash and
+            _sequence_length_matches(awg, package)):
+        log.info('Sequence already loaded on {}, skipping '
+                 'upload.'.format(awg.name))
+        return False
+
+    # forget the old package first such that a failed upload is redone
+    forget_loaded_package(awg)
+    if dedupe:
+        awg_file = make_deduplicated_awg_file(awg, package, channels=channels)
+        send_and_load_awg_file(awg, awg_file)
+    elif channels is None:
+        awg.make_send_and_load_awg_file(*package[:])
+    else:
+        awg.make_send_and_load_awg_file(*package[:], channels=channels)
+    _loaded_packages[awg] = new_hash
+    return True
+
+
+def forget_loaded_package(awg):
+    """
+    Forget which package is loaded on an AWG, such that the next upload
+    is not skipped
+    """
+    _loaded_packages.pop(awg, None)
+
+
+def replace_element_waveforms(awg, package, element_no, channels):
+    """
+    Replace the waveforms of a single element of the sequence loaded on an
+    AWG (5014C), leaving the sequence table and all other waveforms alone.
+    Much faster than uploading a full .awg file when only one element
+    changes.
+
+    The new waveforms are sent under names of their own, as the loaded
+    waveforms may be shared with other elements (see
+    make_deduplicated_awg_file), and linked to the element. The waveforms
+    of a previous update of the element are replaced.
+
+    Args:
+        awg (Tektronix_AWG5014): The relevant awg
+        package (tuple): The output of outputForAWGFile() of a sequence
+            containing only the new element
+        element_no (int): The position of the element in the loaded sequence
+        channels (list): The AWG channels of the channels of the package
+    """
+    waveforms, m1s, m2s = package[:3]
+    for index, channel in enumerate(channels):
+        name = 'elem{:03d}ch{}'.format(element_no, channel)
+        awg.write('WLISt:WAVeform:DELete "{}"'.format(name))
+        awg.send_waveform_to_list(waveforms[index][0], m1s[index][0],
+                                  m2s[index][0], name)
+        awg.set_sqel_waveform(name, channel, element_no)
+    # what is loaded no longer corresponds to any full package
+    forget_loaded_package(awg)
+
+
+class SequencerJumpParameter(Parameter):
+    """
+    Sweep parameter stepping through variants of a pulse (e.g. widths or
+    amplitudes) that are all loaded on the AWG (5014C) at once. Setting a
+    value only changes the goto target of a router element to the element
+    playing that variant, so a sweep runs at sequencer speed instead of
+    upload speed.
+
+    The sequence must start with a router element (see the router option
+    of makeT2Sequence) whose goto target selects the variant, and each
+    variant element must go back to the router when done.
+
+    Args:
+        name (str): The name of the parameter
+        awg (Tektronix_AWG5014): The relevant awg
+        values (iterable): The sweep values, one per variant
+        router_element (int): The sequence position of the router element
+        index_offset (int): The sequence position of the variant of the
+            first value. The variants must follow each other.
+        verify (bool): Whether to read back the goto target after each set
+    """
+
+    def __init__(self, name, awg, values, router_element=1, index_offset=2,
+                 verify=True, **kwargs):
+        super().__init__(name, **kwargs)
+        self.awg = awg
+        self.values = np.asarray(values, dtype=float)
+        self.router_element = router_element
+        self.index_offset = index_offset
+        self.verify = verify
+        self._value = None
+
+    def index_of(self, value):
+        """
+        The sequence position of the variant of value
+        """
+        position = int(np.argmin(np.abs(self.values - value)))
+        if not np.isclose(self.values[position], value, rtol=1e-6, atol=1e-15):
+            raise ValueError('{} is not one of the loaded values '
+                             '{}'.format(value, self.values))
+        return position + self.index_offset
+
+    def upload(self, seq, force=False):
+        """
+        Upload the sequence holding all the variants
+
+        Args:
+            seq (bb.Sequence): The sequence
+            force (bool): Upload even if the sequence is already loaded
+        """
+        package = render_sequence(seq)
+        last = self.index_offset + len(self.values) - 1
+        if len(package[3]) < last:
+            raise ValueError('The sequence has {} elements but {} variants '
+                             'starting at position {} are '
+                             'expected'.format(len(package[3]),
+                                               len(self.values),
+                                               self.index_offset))
+        upload_package(self.awg, package, force=force)
+        self.reset()
+
+    def set_raw(self, value):
+        target = self.index_of(value)
+        self.awg.set_sqel_goto_target_index(self.router_element, target)
+        if self.verify:
+            actual = int(self.awg.ask('SEQuence:ELEMent{}:GOTO:'
+                                      'INDex?'.format(self.router_element)))
+            if actual != target:
+                self._value = None
+                raise RuntimeError('Router element {} goes to {} instead of '
+                                   '{}'.format(self.router_element, actual,
+                                               target))
+        self._value = value
+
+    def get_raw(self):
+        return self._value
+
+    def reset(self):
+        """
+        Point the router back at the first variant
+        """
+        self.awg.set_sqel_goto_target_index(self.router_element,
+                                            self.index_offset)
+        self._value = self.values[0]
+
+    @contextmanager
+    def sweeping(self):
+        """
+        Context manager resetting the router when the sweep is done or
+        has failed
+        """
+        try:
+            yield self
+        finally:
+            try:
+                self.reset()
+            except Exception:
+                log.exception('Could not reset the router element of '
+                              '{}'.format(self.awg.name))
+
+
+class AWGStarter:
+    """
+    Trigger source for the ATSChannelController starting an AWG (5014C)
+    for every acquisition, once the previous run has finished.
+
+    Rather than polling the AWG state at a fixed short interval, the
+    starter sleeps for the expected run duration after each start and only
+    then polls, with an interval growing from min_poll to max_poll.
+
+    Args:
+        awg (Tektronix_AWG5014): The relevant awg
+        run_duration (Optional[float]): The expected duration of one run of
+            the sequence (s), e.g. no_of_avgs*cycletime
+        arm_first (bool): Whether to start the AWG before the alazar
+            starts capturing and only force a trigger once the alazar is
+            ready. The sequence must then wait for a trigger first.
+        timeout (float): Time to wait for the previous run to finish
+            beyond the expected run duration (s)
+        min_poll (float): The first poll interval (s)
+        max_poll (float): The maximal poll interval (s)
+    """
+
+    def __init__(self, awg, run_duration=None, arm_first=False, timeout=10,
+                 min_poll=1e-3, max_poll=50e-3):
+        self.awg = awg
+        self.run_duration = run_duration
+        self.arm_first = arm_first
+        self.timeout = timeout
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self._started_at = None
+
+    def wait_until_stopped(self):
+        """
+        Wait for the current run of the AWG to finish
+        """
+        if self._started_at is not None and self.run_duration:
+            remaining = self._started_at + self.run_duration - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+        deadline = time.perf_counter() + self.timeout
+        poll = self.min_poll
+        while self.awg.state() == 'Running':
+            if time.perf_counter() > deadline:
+                raise TimeoutError('{} still running {} s after the expected '
+                                   'end of its run'.format(self.awg.name,
+                                                           self.timeout))
+            time.sleep(poll)
+            poll = min(2*poll, self.max_poll)
+
+    def start(self):
+        self.wait_until_stopped()
+        self.awg.run()
+        self._started_at = time.perf_counter()
+
+    def pre_start_capture(self):
+        if self.arm_first:
+            self.start()
+
+    def pre_acquire(self):
+        if self.arm_first:
+            self.awg.force_trigger()
+            self._started_at = time.perf_counter()
+        else:
+            self.start()
@@ -3,6 +3,8 @@
 Customised instruments with extra features such as voltage dividers and derived
 parameters for use with T10
 """
+from contextlib import contextmanager
+
 import numpy as np
 
 from qcodes.instrument_drivers.QDev.QDac_channels import QDac
@@ -11,7 +13,12 @@ from qcodes.instrument_drivers.stanford_research.SR830 import ChannelBuffer
 from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
 from qcodes.instrument_drivers.devices import VoltageDivider
 from qcodes.instrument_drivers.ZI.ZIUHFLI import ZIUHFLI
-from qcodes import ArrayParameter, Parameter
+from qcodes import ArrayParameter, Parameter, Task
+
+from fast_axis import LinearResampler
+from setting_cache import invalidate
+from shared_acquisition import SharedAcquisition
+from zi_batching import BatchedDAQ
 
 
 class Scope_avg(ArrayParameter):
@@ -26,11 +33,14 @@ class Scope_avg(ArrayParameter):
             raise ValueError('Channel must be 1 or 2')
 
         self.channel = channel
+        # maps the averaged trace onto the setpoints, see linearise
+        self.resampler = None
 
     def make_setpoints(self, sp_start, sp_stop, sp_npts):
         """
         Makes setpoints and prepares the averager (updates its unit)
         """
+        self.resampler = None
         self.shape = (sp_npts,)
         self.unit = self._instrument.Scope.units[self.channel-1]
         self.setpoints = (tuple(np.linspace(sp_start, sp_stop, sp_npts)),)
@@ -39,21 +49,55 @@ class Scope_avg(ArrayParameter):
         self.has_setpoints = True
         self.label = self.zi.parameters['scope_channel{}_input'.format(self.channel)].get()
 
+    def _down_sampling(self):
+        return int(self._instrument.scope_length.get()/self.shape[0])
+
+    def sample_times(self):
+        """
+        The times after the trigger (delay) of the points returned by get,
+        i.e. the centres of the averaged blocks of samples (s)
+        """
+        length = self._instrument.scope_length.get()
+        sample_rate = length/self._instrument.scope_duration.get()
+        down_samp = self._down_sampling()
+        if down_samp > 1:
+            npts = min(self.shape[0], length//down_samp)
+            return (np.arange(npts)*down_samp + (down_samp - 1)/2)/sample_rate
+        return np.arange(length)/sample_rate
+
+    def linearise(self, positions):
+        """
+        Resample the traces onto the setpoints in every get, given the
+        actual positions (e.g. voltages) of the points of the trace
+
+        Args:
+            positions (array): The positions of the points at
+                sample_times()
+        """
+        self.resampler = LinearResampler(positions, self.setpoints[0])
+
     def get(self):
 
         if not self.has_setpoints:
             raise ValueError('Setpoints not made. Run make_setpoints')
 
-        data = self._instrument.Scope.get()[self.channel-1]
-        data_avg = np.mean(data, 0)
+        data = np.atleast_2d(self._instrument.get_scope_data()[self.channel-1])
+        segments, samples = data.shape
 
         # KDP: handle less than 4096 points
         # (4096 needs to be multiple of number of points)
-        down_samp = np.int(self._instrument.scope_length.get()/self.shape[0])
+        # Average blocks of down_samp points rather than keeping every
+        # down_samp-th point, fused with the average over the segments
+        down_samp = self._down_sampling()
         if down_samp > 1:
-            data_ret = data_avg[::down_samp]
+            npts = min(self.shape[0], samples//down_samp)
+            blocks = data[:, :npts*down_samp].reshape(segments, npts, down_samp)
+            data_ret = blocks.mean(axis=(0, 2), dtype=np.float32)
         else:
-            data_ret = data_avg
+            data_ret = data.mean(axis=0, dtype=np.float32)
+
+        if self.resampler is not None:
+            data_ret = self.resampler(data_ret)
 
         return data_ret
 
@@ -76,7 +120,7 @@ class Scope_full_avg(Parameter):
     def get_raw(self):
 
         self.label = self._instrument.parameters['scope_channel{}_input'.format(self.channel)].get()
-        data = self._instrument.Scope.get()[self.channel-1]
+        data = self._instrument.get_scope_data()[self.channel-1]
         data_avg = np.mean(data)
 
         return data_avg
@@ -238,10 +282,17 @@ class Keysight_34465A_T10(Keysight_34465A):
 
 
 class ZIUHFLI_T10(ZIUHFLI):
+    """
+    A ZI UHF-LI with averaged scope parameters. Within
+    shared_scope_acquisition, the scope parameters measured at the same
+    sweep point share a single scope acquisition.
+    """
 
     def __init__(self, name, address, **kwargs):
         super().__init__(name, address, **kwargs)
 
+        self._scope_acquisition = SharedAcquisition(lambda: self.Scope.get())
+
         self.add_parameter('scope_avg_ch1',
                            channel=1,
                            label='',
@@ -258,3 +309,67 @@ class ZIUHFLI_T10(ZIUHFLI):
         self.add_parameter('scope_full_avg_ch2',
                            channel=2,
                            parameter_class=Scope_full_avg)
+
+    @contextmanager
+    def batched_settings(self):
+        """
+        Context manager sending all node writes of the parameter sets in
+        its body as a single batched set followed by one sync, instead of
+        a round trip to the data server per parameter. Nested uses join
+        the outermost batch. The writes are sent when the outermost block
+        is left, also if it is left by an error.
+
+        Example:
+            with zi.batched_settings():
+                zi.scope_trig_level(0.5)
+                zi.scope_trig_delay(1e-6)
+        """
+        if isinstance(self.daq, BatchedDAQ):
+            yield
+            return
+        daq = self.daq
+        # the settings cache must not believe in writes that never arrived
+        batched = BatchedDAQ(daq, on_failure=lambda: invalidate(self))
+        self.daq = batched
+        try:
+            yield
+        finally:
+            self.daq = daq
+            batched.flush()
+
+    def get_scope_data(self):
+        """
+        Return the scope data of the current sweep point, see
+        shared_scope_acquisition. Outside of it, acquire anew.
+        """
+        return self._scope_acquisition.get()
+
+    def next_scope_point(self):
+        """
+        Mark the advance of the sweep, such that the next scope parameter
+        acquires anew
+        """
+        self._scope_acquisition.next_point()
+
+    @contextmanager
+    def shared_scope_acquisition(self):
+        """
+        Context manager sharing one scope acquisition between all scope
+        parameters measured at a sweep point (e.g. scope_avg_ch1 and
+        scope_avg_ch2). It yields a Task advancing the point, which must be
+        measured at every point before the scope parameters.
+
+        Example:
+            with zi.shared_scope_acquisition() as next_point:
+                do1d(qdac.ch01.v, 0, 1, 101, 0, next_point,
+                     zi.scope_avg_ch1, zi.scope_avg_ch2)
+        """
+        with self._scope_acquisition.sharing():
+            yield Task(self.next_scope_point)
+
+    def invalidate_scope_cache(self):
+        """
+        Forget the last scope acquisition, such that the next scope
+        parameter acquires anew. Call this if the scope settings change.
+        """
+        self._scope_acquisition.invalidate()
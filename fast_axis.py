@@ -0,0 +1,70 @@
+# Module containing the voltage axis of the fast sawtooth and its
+# linearisation onto a uniform grid
+import numpy as np
+
+
+def ramp_voltages(v_start, v_stop, times, rise_time):
+    """
+    The voltages of a rising sawtooth ramp at the given times
+
+    Args:
+        v_start (float): The voltage at the start of the rising ramp (V)
+        v_stop (float): The voltage at the end of the rising ramp (V)
+        times (array): The times after the start of the rising ramp (s)
+        rise_time (float): The duration of the rising ramp (s)
+    """
+    return v_start + (v_stop - v_start)*np.asarray(times)/rise_time
+
+
+def sawtooth_rise_time(ramp):
+    """
+    The duration of the rising part of the sawtooth set up by
+    prepare_fast_charge_diagram, i.e. the period minus the falling part
+    of duration asym*period
+    """
+    return (1 - ramp['asym'])/ramp['frequency']
+
+
+class LinearResampler:
+    """
+    Linear interpolation of data measured at fixed, non-uniform positions
+    onto a grid. The interpolation indices and weights are computed once,
+    after which resampling is a single vectorised operation on the last
+    axis of the data, e.g. a whole frame at a time. Grid points outside of
+    the measured positions hold the value of the outermost point (like
+    np.interp), as the measured points are block centres which do not
+    reach the ends of the ramp.
+
+    Args:
+        positions (array): The positions of the measured points, in any
+            (but the same for every call) order
+        grid (array): The positions to interpolate to
+    """
+
+    def __init__(self, positions, grid):
+        positions = np.asarray(positions, dtype=float)
+        grid = np.asarray(grid, dtype=float)
+        if positions.size < 2:
+            raise ValueError('Need at least two measured points.')
+        order = np.argsort(positions, kind='stable')
+        ordered = positions[order]
+
+        lower = np.searchsorted(ordered, grid, side='right') - 1
+        lower = np.clip(lower, 0, len(ordered) - 2)
+        step = ordered[lower + 1] - ordered[lower]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(step > 0, (grid - ordered[lower])/step, 0)
+
+        # the clipped weights hold the outermost points beyond the ends
+        self._lower = order[lower]
+        self._upper = order[lower + 1]
+        self._weights = np.clip(weights, 0, 1).astype(np.float32)
+        self.size = len(positions)
+
+    def __call__(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        if data.shape[-1] != self.size:
+            raise ValueError('Expected {} points on the last axis, got '
+                             '{}.'.format(self.size, data.shape[-1]))
+        return (data[..., self._lower]*(1 - self._weights) +
+                data[..., self._upper]*self._weights)
@@ -1,7 +1,11 @@
 from qcodes.utils.wrappers import do1d
 import qcodes as qc
 
-def prepare_measurement(keysight_low_V, keysight_high_V, scope_avger, qdac_fast_channel, npts, zi, add_offset: bool=True):
+from fast_axis import ramp_voltages, sawtooth_rise_time
+from setting_cache import cached_settings
+
+def prepare_measurement(keysight_low_V, keysight_high_V, scope_avger, qdac_fast_channel, npts, zi, add_offset: bool=True,
+                        ramp=None):
     """
     Args:
         keysight_low_V (float): keysight ramp start value
@@ -9,8 +13,13 @@ def prepare_measurement(keysight_low_V, keysight_high_V, scope_avger, qdac_fast_
         scope_avger (Scope_avg): The Scope_avg instance
         qdac_fast_channel (int): The number of the QDac channel added to
             the Keysight ramp
+        ramp (Optional[dict]): The sawtooth settings as returned by
+            prepare_fast_charge_diagram. If given, the traces are resampled
+            from the actual ramp voltages onto the setpoints. Setpoints
+            beyond the voltages seen by the scope hold the outermost value.
     """
     zi.Scope.prepare_scope()
+    zi.invalidate_scope_cache()
     #npts = zi.scope_length()
     
     offset = 0
@@ -22,6 +31,13 @@ def prepare_measurement(keysight_low_V, keysight_high_V, scope_avger, qdac_fast_
     scope_avger.setpoint_labels = ('Fast {}'.format(qdac_fast_channel.label),)
     scope_avger.setpoint_units = ('V',)
 
+    if ramp is not None:
+        # the trace starts zi_trig_delay after the start of the rising ramp
+        times = scope_avger.sample_times() + ramp['zi_trig_delay']
+        voltages = ramp_voltages(keysight_low_V+offset, keysight_high_V+offset,
+                                 times, sawtooth_rise_time(ramp))
+        scope_avger.linearise(voltages)
+
     # zi.scope_avg_ch1.make_setpoints(keysight_low_V, keysight_high_V, npts)
     # zi.scope_avg_ch1.setpoint_names = ('keysight_voltage',)
     # zi.scope_avg_ch1.setpoint_labels = ('Keysight Voltage',)
@@ -29,37 +45,26 @@ def prepare_measurement(keysight_low_V, keysight_high_V, scope_avger, qdac_fast_
 
 
 
-def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
-                        qdac_channel, q_start, q_stop, npoints, delay, qdac_fast_channel, comp_scale,
-                        scope_signal, zi_trig_signal='Trig Input 1',
-                        trigger_holdoff=60e-6, zi_samplingrate='14.0 MHz', zi_scope_length=4096,
-                        zi_trig_hyst=0, zi_trig_level=.5, zi_trig_delay = 0, print_settings=False,
-                        keysight_voltage_multiplier=1, zi=None, keysight=None, tasks_to_perform=None):
+def prepare_fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop,
+                                n_averages, qdac_fast_channel, comp_scale,
+                                scope_signal, zi_trig_signal='Trig Input 1',
+                                trigger_holdoff=60e-6, zi_samplingrate='14.0 MHz',
+                                zi_scope_length=4096, zi_trig_hyst=0,
+                                zi_trig_level=.5, zi_trig_delay=0,
+                                print_settings=False,
+                                keysight_voltage_multiplier=1, zi=None,
+                                keysight=None, linearise=True):
     """
-    Args:
-        keysight_channel:
-        fast_v_start
-        fast_v_stop
-        keys_freq
-        n_averages
-        qdac_channel
-        q_start
-        q_stop
-        npoints:
-        delay:
-        zi_input_chan:
-        zi_trig_signal:
-        trigger_holdoff;
-        zi_samplingrate:
-        zi_trig_hyst:
-        zi_trig_level:
-        zi_trig_delay: Should be the rise time of your signal/trigger signal 
-                       For Keysight sawtooth it is 6e-7s.
-        keysight_voltage_multiplier: The actual voltage to the keysight is fast_v_start
-        and fast_v_stop multiplied by this number. I.e. if you have a voltage divider 
-        between the keysight and your device that divides the voltage by 5. You should
-        set the fast_voltage_start and fast_voltage_stop to the values you want on the
-        device and the values sent to the keysight will be 5*fast_voltage_start and 5*fast_voltage_stop
+    Set up the Keysight sawtooth on the fast axis and the ZI scope
+    averaging it, as used by fast_charge_diagram and the video mode.
+    The arguments are those of fast_charge_diagram.
+
+    Returns:
+        scope_avger (list): The Scope_avg parameters of the scope signals
+        ramp (dict): The settings of the sawtooth, frequency (Hz),
+            amplitude (Vpp), offset (V) and asym, the fraction of the
+            period spent on the falling ramp, together with the
+            scope_duration, trigger_holdoff and zi_trig_delay (s)
     """
 
     if zi is None:
@@ -68,6 +73,9 @@ def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
         keysight = qc.Instrument.find_instrument('keysight_gen_left')
     if keysight_channel not in ['ch01', 'ch02']:
         raise ValueError('Invalid keysight channel. Must be either "ch01" or "ch02".')
+    # only write the settings that changed since the last diagram
+    zi = cached_settings(zi)
+    keysight = cached_settings(keysight)
 
     if not isinstance(scope_signal, list):
         scope_signal = [scope_signal]
@@ -103,26 +111,35 @@ def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
     key_offset = fast_v_start_scaled + keysight_amplitude/2
     # fast_v_start -= additional_sawtooth_amplitude
 
-    zi.scope_channels(3)
-    zi.scope_trig_holdoffseconds.set(trigger_holdoff)
+    ramp = {'frequency': key_frequency,
+            'amplitude': keysight_amplitude,
+            'offset': key_offset,
+            'asym': asym,
+            'scope_duration': scope_duration,
+            'trigger_holdoff': trigger_holdoff,
+            'zi_trig_delay': zi_trig_delay}
 
-    zi.scope_trig_enable.set('ON')
-    zi.scope_trig_signal.set(zi_trig_signal)
-    zi.scope_trig_slope.set('Rise')
+    # one round trip to the data server for all scope settings
+    with zi.batched_settings():
+        zi.scope_channels(3)
+        zi.scope_trig_holdoffseconds.set(trigger_holdoff)
 
-    zi.scope_trig_hystmode('absolute')
-    zi.scope_trig_hystabsolute.set(zi_trig_hyst)
+        zi.scope_trig_enable.set('ON')
+        zi.scope_trig_signal.set(zi_trig_signal)
+        zi.scope_trig_slope.set('Rise')
 
-    zi.scope_trig_gating_enable.set('OFF')
-    zi.scope_trig_holdoffmode.set('s')
+        zi.scope_trig_hystmode('absolute')
+        zi.scope_trig_hystabsolute.set(zi_trig_hyst)
 
-    zi.scope_trig_reference.set(0)
-    zi.scope_segments('ON')
-    zi.scope_segments_count(n_averages)
+        zi.scope_trig_gating_enable.set('OFF')
+        zi.scope_trig_holdoffmode.set('s')
 
-    zi.scope_trig_level.set(zi_trig_level)
-    zi.scope_trig_delay.set(zi_trig_delay)
-    zi.daq.sync()
+        zi.scope_trig_reference.set(0)
+        zi.scope_segments('ON')
+        zi.scope_segments_count(n_averages)
+
+        zi.scope_trig_level.set(zi_trig_level)
+        zi.scope_trig_delay.set(zi_trig_delay)
     if keysight_channel == 'ch01':
         keysight.ch1_function_type('RAMP')
         keysight.ch1_ramp_symmetry(100*(1-asym))
@@ -174,7 +191,8 @@ def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
         try:
             scope_avger.append(zi_averager[ii])
             prepare_measurement(fast_v_start, fast_v_stop, zi_averager[ii],
-                                qdac_fast_channel, zi_scope_length, zi)
+                                qdac_fast_channel, zi_scope_length, zi,
+                                ramp=ramp if linearise else None)
         except KeyError:
             raise ValueError('Invalid scope_channel: {}'.format(ch))
 
@@ -194,24 +212,97 @@ def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
         print('zi_trig_delay: {}'.format(zi_trig_delay))
         print('zi_trig_hyst: {}'.format(zi_trig_hyst))
 
+    return scope_avger, ramp
+
+
+def keysight_output_off(keysight, keysight_channel):
+    """
+    Switch off the sawtooth output set up by prepare_fast_charge_diagram
+    """
+    if keysight_channel == 'ch01':
+        keysight.ch1_output('OFF')
+    elif keysight_channel == 'ch02':
+        keysight.ch2_output('OFF')
+
+
+def fast_charge_diagram(keysight_channel, fast_v_start, fast_v_stop, n_averages,
+                        qdac_channel, q_start, q_stop, npoints, delay, qdac_fast_channel, comp_scale,
+                        scope_signal, zi_trig_signal='Trig Input 1',
+                        trigger_holdoff=60e-6, zi_samplingrate='14.0 MHz', zi_scope_length=4096,
+                        zi_trig_hyst=0, zi_trig_level=.5, zi_trig_delay = 0, print_settings=False,
+                        keysight_voltage_multiplier=1, zi=None, keysight=None, tasks_to_perform=None,
+                        linearise=True):
+    """
+    Fast charge diagram with the fast axis swept by a Keysight sawtooth and
+    recorded by the ZI scope, and the slow axis stepped by a QDac channel
+    in a do1d.
+
+    The rows are acquired with the scope rather than as a DAQ module grid
+    (see zi_daq_module.DAQModuleGrid): the QDac is stepped in software, so
+    every row has to be armed and read after its step anyway, and a grid of
+    one row per point would not save the per-point cycle. For a slow axis
+    swept in hardware use video_mode.GridSawtoothSlowAxis.
+
+    Args:
+        keysight_channel:
+        fast_v_start
+        fast_v_stop
+        keys_freq
+        n_averages
+        qdac_channel
+        q_start
+        q_stop
+        npoints:
+        delay:
+        zi_input_chan:
+        zi_trig_signal:
+        trigger_holdoff;
+        zi_samplingrate:
+        zi_trig_hyst:
+        zi_trig_level:
+        zi_trig_delay: Should be the rise time of your signal/trigger signal 
+                       For Keysight sawtooth it is 6e-7s.
+        keysight_voltage_multiplier: The actual voltage to the keysight is fast_v_start
+        and fast_v_stop multiplied by this number. I.e. if you have a voltage divider 
+        between the keysight and your device that divides the voltage by 5. You should
+        set the fast_voltage_start and fast_voltage_stop to the values you want on the
+        device and the values sent to the keysight will be 5*fast_voltage_start and 5*fast_voltage_stop
+        linearise: Resample the traces from the actual ramp voltages, taking the
+        trigger holdoff and delay into account, onto the fast axis setpoints.
+        Setpoints the ramp does not reach during the trace hold the value at
+        the nearest end of the trace.
+    """
+
+    if zi is None:
+        zi = qc.Instrument.find_instrument('ziuhfli')
+    if keysight is None:
+        keysight = qc.Instrument.find_instrument('keysight_gen_left')
+
+    scope_avger, _ = prepare_fast_charge_diagram(
+        keysight_channel, fast_v_start, fast_v_stop, n_averages,
+        qdac_fast_channel, comp_scale, scope_signal,
+        zi_trig_signal=zi_trig_signal, trigger_holdoff=trigger_holdoff,
+        zi_samplingrate=zi_samplingrate, zi_scope_length=zi_scope_length,
+        zi_trig_hyst=zi_trig_hyst, zi_trig_level=zi_trig_level,
+        zi_trig_delay=zi_trig_delay, print_settings=print_settings,
+        keysight_voltage_multiplier=keysight_voltage_multiplier, zi=zi,
+        keysight=keysight, linearise=linearise)
+
     try:
-        if tasks_to_perform is None:
-            #plot, data = do1d_M(qdac_channel, q_start, q_stop, npoints, delay, scope_avger)
-            plot, data = do1d(qdac_channel, q_start, q_stop, npoints, delay, *scope_avger)
-        else:
-            #plot, data = do1d_M(qdac_channel, q_start, q_stop, npoints, delay, scope_avger, *tasks_to_perform)
-            plot, data = do1d(qdac_channel, q_start, q_stop, npoints, delay, *scope_avger, *tasks_to_perform)
+        # the scope parameters share one scope shot per qdac point
+        with zi.shared_scope_acquisition() as next_point:
+            if tasks_to_perform is None:
+                #plot, data = do1d_M(qdac_channel, q_start, q_stop, npoints, delay, scope_avger)
+                plot, data = do1d(qdac_channel, q_start, q_stop, npoints, delay, next_point, *scope_avger)
+            else:
+                #plot, data = do1d_M(qdac_channel, q_start, q_stop, npoints, delay, scope_avger, *tasks_to_perform)
+                plot, data = do1d(qdac_channel, q_start, q_stop, npoints, delay, next_point, *scope_avger,
+                                  *tasks_to_perform)
 
-        if keysight_channel == 'ch01':
-            keysight.ch1_output('OFF')
-        elif keysight_channel == 'ch02':
-            keysight.ch2_output('OFF')
+        keysight_output_off(keysight, keysight_channel)
 
     except KeyboardInterrupt:
-        if keysight_channel == 'ch01':
-            keysight.ch1_output('OFF')
-        elif keysight_channel == 'ch02':
-            keysight.ch2_output('OFF')
+        keysight_output_off(keysight, keysight_channel)
         print('Measurement interrupted.')
         raise KeyboardInterrupt
     return plot, data
@@ -0,0 +1,220 @@
+# Module containing the offline (re)demodulation of stored raw traces
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from alazar_controllers.demodulator import Demodulator
+
+log = logging.getLogger(__name__)
+
+# Same numbering as ATSChannelController.filter_dict, without the least
+# squares filter ('ls': 1) which the Demodulator does not implement
+FILTERS = {'win': 0, 'ave': 2}
+
+
+def _point_rows(raw_file):
+    """
+    Return the sweep points of a raw trace file together with the
+    (start, stop) rows of the traces of each point. The rows of a
+    point are contiguous as they are appended point by point.
+    """
+    with h5py.File(raw_file, 'r') as f:
+        points = f['index'][:, 0]
+    if len(points) == 0:
+        return [], []
+    boundaries = np.flatnonzero(np.diff(points)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(points)]))
+    return points[starts], list(zip(starts, stops))
+
+
+def _read_traces(raw_file, start, stop):
+    """
+    Read the traces in rows start to stop of a raw data file, either
+    a RawTraceWriter HDF5 file or a .npy file (memory mapped)
+    """
+    if raw_file.endswith('.npy'):
+        return np.load(raw_file, mmap_mode='r')[start]
+    with h5py.File(raw_file, 'r') as f:
+        return f['traces'][start:stop]
+
+
+def _demodulate_point(raw_file, start, stop, settings):
+    """
+    Demodulate the traces of a single sweep point. Runs in a worker
+    process so everything is passed as plain arguments.
+
+    Returns:
+        magnitude, phase: shape (demods, rows) if integrating, otherwise
+            (demods, rows, samples)
+    """
+    traces = np.asarray(_read_traces(raw_file, start, stop),
+                        dtype=np.float64)
+    rows, samples = traces.shape
+    demodulator = Demodulator(1, rows, samples,
+                              settings['sample_rate'],
+                              {'filter': settings['filter'],
+                               'numtaps': settings['numtaps']},
+                              settings['demod_freqs'],
+                              average_buffers=True,
+                              average_records=False,
+                              integrate_samples=settings['integrate'])
+    magnitude, phase = demodulator.demodulate(traces[np.newaxis],
+                                              settings['int_delay'],
+                                              settings['int_time'])
+    magnitude = magnitude[:, 0]
+    phase = phase[:, 0]
+    if settings['integrate']:
+        magnitude = np.mean(magnitude, axis=-1)
+        phase = np.mean(phase, axis=-1)
+    return magnitude, phase
+
+
+def redemodulate(raw_file, out_file, demod_freqs, int_delay=0,
+                 int_time=None, filter='win', numtaps=101,
+                 integrate=True, processes=None, sample_rate=None):
+    """
+    Rerun the demodulation on stored raw traces with new settings and
+    write the result to a new file.
+
+    The sweep points are demodulated in parallel in a pool of processes,
+    each of which reads only the traces of its point from disk.
+
+    The output file contains the datasets magnitude and phase of shape
+    (points, demods, rows) (with an additional samples axis if not
+    integrating), the sweep point numbers, the demodulation frequencies
+    and the row setpoints of the raw file. The settings are stored as
+    attributes.
+
+    Args:
+        raw_file (str): The raw trace file as written by RawTraceWriter,
+            or a .npy file of shape (points, rows, samples) as written by
+            a 3D alazar channel. The latter is memory mapped.
+        out_file (str): The file to write
+        demod_freqs (list): The demodulation frequencies (Hz)
+        int_delay (float): Start of the integration window (s)
+        int_time (Optional[float]): Length of the integration window (s).
+            Default is the rest of the trace.
+        filter (str): The low pass filter, 'win' or 'ave'
+        numtaps (int): Number of taps of the low pass filter
+        integrate (bool): Whether to average over the integration window
+        processes (Optional[int]): Number of worker processes. Default is
+            the number of CPUs, 1 runs in this process.
+        sample_rate (Optional[float]): The sample rate of the traces (Hz).
+            Required for .npy files, for HDF5 files the stored sample rate
+            is used by default.
+    """
+    if filter not in FILTERS:
+        raise ValueError('Unknown filter {}, must be one of '
+                         '{}'.format(filter, list(FILTERS)))
+    demod_freqs = list(np.atleast_1d(demod_freqs))
+
+    row_setpoints = None
+    if raw_file.endswith('.npy'):
+        raw = np.load(raw_file, mmap_mode='r')
+        points = np.arange(raw.shape[0])
+        rows = [(point, point + 1) for point in points]
+        samples = raw.shape[-1]
+    else:
+        points, rows = _point_rows(raw_file)
+        with h5py.File(raw_file, 'r') as f:
+            samples = f['traces'].shape[1]
+            if sample_rate is None:
+                sample_rate = f.attrs.get('sample_rate')
+            if 'row_setpoints' in f:
+                row_setpoints = f['row_setpoints'][:]
+    if sample_rate is None:
+        raise ValueError('No sample rate given or stored in '
+                         '{}'.format(raw_file))
+
+    if int_time is None:
+        int_time = samples/sample_rate - int_delay
+    if int_delay + int_time > samples/sample_rate:
+        raise ValueError('Integration window ends after the traces')
+
+    settings = {'sample_rate': sample_rate,
+                'filter': FILTERS[filter],
+                'numtaps': numtaps,
+                'demod_freqs': demod_freqs,
+                'int_delay': int_delay,
+                'int_time': int_time,
+                'integrate': integrate}
+
+    log.info('Demodulating {} points of {} at {}'.format(len(points),
+                                                         raw_file,
+                                                         demod_freqs))
+    starts = [start for start, _ in rows]
+    stops = [stop for _, stop in rows]
+    nargs = len(rows)
+
+    with h5py.File(out_file, 'w') as out:
+        out.create_dataset('points', data=np.asarray(points))
+        out.create_dataset('demod_freqs', data=np.asarray(demod_freqs))
+        if row_setpoints is not None:
+            out.create_dataset('row_setpoints', data=row_setpoints)
+        out.attrs['raw_file'] = raw_file
+        for key, value in settings.items():
+            if key != 'demod_freqs':
+                out.attrs[key] = value
+        out.attrs['filter'] = filter
+
+        if processes == 1:
+            results = map(_demodulate_point, [raw_file]*nargs, starts, stops,
+                          [settings]*nargs)
+            _write_results(out, results)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                results = pool.map(_demodulate_point, [raw_file]*nargs,
+                                   starts, stops, [settings]*nargs)
+                _write_results(out, results)
+
+    log.info('Wrote demodulated data to {}'.format(out_file))
+
+
+def _write_results(out, results):
+    """
+    Write the results of _demodulate_point in order of the sweep points
+    as they come in
+    """
+    magnitude = None
+    phase = None
+    for point_number, (point_magnitude, point_phase) in enumerate(results):
+        if magnitude is None:
+            shape = (0,) + point_magnitude.shape
+            maxshape = (None,) + point_magnitude.shape
+            magnitude = out.create_dataset('magnitude', shape=shape,
+                                           maxshape=maxshape,
+                                           dtype='float64')
+            phase = out.create_dataset('phase', shape=shape,
+                                       maxshape=maxshape, dtype='float64')
+        magnitude.resize(point_number + 1, axis=0)
+        magnitude[point_number] = point_magnitude
+        phase.resize(point_number + 1, axis=0)
+        phase[point_number] = point_phase
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Demodulate stored raw traces with new settings')
+    parser.add_argument('raw_file')
+    parser.add_argument('out_file')
+    parser.add_argument('demod_freqs', type=float, nargs='+')
+    parser.add_argument('--int_delay', type=float, default=0)
+    parser.add_argument('--int_time', type=float, default=None)
+    parser.add_argument('--filter', default='win', choices=list(FILTERS))
+    parser.add_argument('--numtaps', type=int, default=101)
+    parser.add_argument('--traces', action='store_true',
+                        help='keep the samples instead of integrating')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--sample_rate', type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    redemodulate(args.raw_file, args.out_file, args.demod_freqs,
+                 int_delay=args.int_delay, int_time=args.int_time,
+                 filter=args.filter, numtaps=args.numtaps,
+                 integrate=not args.traces, processes=args.processes,
+                 sample_rate=args.sample_rate)
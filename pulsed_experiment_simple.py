@@ -2,21 +2,23 @@
 import time
 import numpy as np
 import qcodes as qc
-from os.path import sep
-from qcodes import DataArray
-from qcodes.data.data_set import new_data
 from qcodes.instrument.parameter import ArrayParameter
 import broadbean as bb
 ramp = bb.PulseAtoms.ramp
 from alazar_controllers.ATSChannelController import ATSChannelController
 from alazar_controllers.alazar_channel import AlazarChannel
 from qcodes.utils.wrappers import CURRENT_EXPERIMENT
-import multiprocessing as mp
+from raw_data import RawTraceWriter, AsyncRawTraceWriter
+from sequence_cache import cached_sequence, render_sequence
+from awg_control import upload_package
+from setting_cache import cached_settings, config_once
+from timing_planner import plan_timing
 import logging
 
 log = logging.getLogger(__name__)
 
 
+@cached_sequence
 def makeSimpleSequence(hightime, trig_delay, meastime,
                        cycletime, pulsehigh, pulselow,
                        no_of_avgs, SR,
@@ -111,6 +113,7 @@ def makeSimpleSequence(hightime, trig_delay, meastime,
     return seq
 
 
+@cached_sequence
 def makeT1Sequence(hightime, trig_delay, RF_delay, meastime,
                    cycletime, pulsehigh, pulselow,
                    no_of_avgs, SR,
@@ -195,16 +198,18 @@ def makeT1Sequence(hightime, trig_delay, RF_delay, meastime,
     return seq
 
 
-def sendSequenceToAWG(awg, seq):
+def sendSequenceToAWG(awg, seq, force=False):
     """
     Function to upload a sequence to an AWG (5014C)
     The sequence is checked to be realisable on the AWG,
     i.e. do sample rates match? Are the voltages within the
     range on the AWG?
+    The upload is skipped if the very same sequence is already loaded.
 
     Args:
         awg (Tektronix_AWG5014): The relevant awg
         seq (bb.Sequence): The sequence to upload
+        force (bool): Upload even if the sequence is already loaded
     """
 
     # Check sample rates
@@ -215,8 +220,8 @@ def sendSequenceToAWG(awg, seq):
 
     seq.setChannelVoltageRange(1, awg.ch1_amp(), awg.ch1_offset())
 
-    package = seq.outputForAWGFile()
-    awg.make_send_and_load_awg_file(*package[:])
+    package = render_sequence(seq)
+    upload_package(awg, package, force=force)
 
 
 
@@ -224,7 +229,8 @@ def correctMeasTime(meastime, npts):
     """
     Given a number of points to measure, and a desired measurement time,
     find the measurement time closest to the given one that the ZI UHF-LI can
-    actually realise.
+    actually realise. The sample rate is chosen by
+    timing_planner.plan_timing.
 
     Args:
         meastime (float): The desired measurement time
@@ -233,26 +239,14 @@ def correctMeasTime(meastime, npts):
     Returns:
         tuple (float, str): A tuple with the new measurement time and
             a string with the sample rate achieving this
-    """
-
-    if npts < 4096:
-        raise ValueError('Sorry, but npts must be at least 4096.')
-
-    # the sample rates of the lock-in
-    SRs = [1.8e9/2**n for n in range(17)]
-
-    realtimes = np.array([npts/SR for SR in SRs])
-    errors = np.abs(meastime-realtimes)
 
-    newtime = realtimes[errors.argmin()]
-
-    SRstrings = ['1.80 GHz', '900 MHz', '450 MHz', '225 MHz', '113 MHz',
-                 '56.2 MHz',
-                 '28.1 MHz', '14.0 MHz', '7.03 MHz', '3.50 MHz', '1.75 MHz',
-                 '880 kHz',
-                 '440 kHz', '220 kHz', '110 kHz', '54.9 kHz', '27.5 kHz']
+    Raises:
+        ValueError: If npts is less than 4096
+    """
 
-    SRstring = SRstrings[errors.argmin()]
+    plan = plan_timing(0, meastime, detector='zi', zi_npts=npts)
+    newtime = plan['zi_npts']/plan['zi_sample_rate']
+    SRstring = plan['zi_sample_rate_string']
 
     # Do some rounding for safety
     newtime = float('{:.4e}'.format(newtime))
@@ -260,9 +254,10 @@ def correctMeasTime(meastime, npts):
     return newtime, SRstring
 
 
+@cached_sequence
 def makeT2Sequence(hightimes, trig_delay, RF_delay, meastime,
                        cycletime, pulsehigh, pulselow,
-                       no_of_avgs, SR):
+                       no_of_avgs, SR, router=False):
     """
     Generate the pulse sequence for the experiment.
     The sequence consists of three parts:
@@ -280,17 +275,26 @@ def makeT2Sequence(hightimes, trig_delay, RF_delay, meastime,
         pulselow (float): The amplitude during the measurement (V)
         no_of_avgs (int): The number of averages
         SR (int): The AWG sample rate (Sa/s)
+        router (bool): If True, the sequence starts with a router element
+            waiting for a trigger and going to a single pulse element,
+            which returns to the router after no_of_avgs repetitions.
+            The pulse width is then selected by the goto target of the
+            router (see awg_control.SequencerJumpParameter).
     """
 
     segname = 'high'
 
 
     # Fail if the sequence would end up being too long for the AWG to handle
-    if len(hightimes)*cycletime*SR >= 16e6:
+    # Elements with the same hightime share their waveform when uploaded
+    # (see awg_control.make_deduplicated_awg_file) so only distinct
+    # hightimes take up waveform memory
+    no_of_waveforms = len(set(hightimes))
+    if no_of_waveforms*cycletime*SR >= 16e6:
         raise ValueError("Sequence too long. You are trying to build a "
                          "sequence with {:d} MSamples. The maximally allowed "
                          "number of samples is "
-                         "16 MSamples.".format(int(len(hightimes)*cycletime*SR/1e6)))
+                         "16 MSamples.".format(int(no_of_waveforms*cycletime*SR/1e6)))
 
     ##################################################################
     # The pulsed part
@@ -312,13 +316,27 @@ def makeT2Sequence(hightimes, trig_delay, RF_delay, meastime,
     
     seq = bb.Sequence()
     seq.setSR(SR)
+
+    offset = 0
+    goto = 0
+    if router:
+        # the shortest waveform the AWG accepts in sequence mode
+        bp_router = bb.BluePrint()
+        bp_router.setSR(SR)
+        bp_router.insertSegment(0, 'waituntil', 250/SR)
+        routerelem = bb.Element()
+        routerelem.addBluePrint(1, bp_router)
+        seq.addElement(1, routerelem)
+        seq.setSequenceSettings(1, 1, 1, 0, 2)
+        offset = 1
+        goto = 1
     
     for index, ht in enumerate(hightimes):
         
         elem = pulseelem.copy()
         elem.changeDuration(1, segname, ht)
-        seq.addElement(index+1, elem)
-        seq.setSequenceSettings(index+1, 0, no_of_avgs, 0, 0)
+        seq.addElement(index+1+offset, elem)
+        seq.setSequenceSettings(index+1+offset, 0, no_of_avgs, 0, goto)
 
     return seq
 
@@ -344,45 +362,48 @@ def prepareZIUHFLI(zi, demod_freq, pts_per_shot,
         single_channel (bool): Whether to subscribe the scope to just a
             single channel. If true, channel 1 will be used. Default: False.
     """
-
-    # Demodulator
-    zi.oscillator1_freq(demod_freq)
-    zi.demod1_order(1)
-    zi.demod1_timeconstant(100e-9)
-    zi.signal_output1_on('ON')
-    # TODO: use this in post-processing to remove first part of demod. data
-
-    # output
-    zi.signal_output1_ampdef('dBm')
-    zi.signal_output1_amplitude(outputpwr)
-
-    # input
-    zi.signal_input1_range(30e-3)
-    zi.signal_input2_range(30e-3)
-
-    # Scope
-    zi.scope_channel1_input('Demod 1 R')
-    zi.scope_channel2_input('Signal Input 2')
-    zi.scope_mode('Time Domain')
-    zi.scope_samplingrate(SRstring)
-    zi.scope_length(pts_per_shot)
-    if single_channel:
-        zi.scope_channels(1)
-    else:
-        zi.scope_channels(3)
-    #
-    zi.scope_trig_enable('ON')
-    # trigger delay reference point: at trigger event time
-    zi.scope_trig_reference(0)
-    zi.scope_trig_delay(1e-6)
-    zi.scope_trig_holdoffmode('s')
-    zi.scope_trig_holdoffseconds(60e-6)
-    zi.scope_trig_gating_enable('OFF')
-    zi.scope_trig_signal('Trig Input 2')
-    zi.scope_trig_level(0.5)  # we expect the AWG marker to have a 1 V high lvl
-    #
-    zi.scope_segments('ON')
-    zi.scope_segments_count(no_of_avgs)
+    # only write what changed since the last preparation
+    zi = cached_settings(zi)
+
+    with zi.batched_settings():
+        # Demodulator
+        zi.oscillator1_freq(demod_freq)
+        zi.demod1_order(1)
+        zi.demod1_timeconstant(100e-9)
+        zi.signal_output1_on('ON')
+        # TODO: use this in post-processing to remove first part of demod. data
+
+        # output
+        zi.signal_output1_ampdef('dBm')
+        zi.signal_output1_amplitude(outputpwr)
+
+        # input
+        zi.signal_input1_range(30e-3)
+        zi.signal_input2_range(30e-3)
+
+        # Scope
+        zi.scope_channel1_input('Demod 1 R')
+        zi.scope_channel2_input('Signal Input 2')
+        zi.scope_mode('Time Domain')
+        zi.scope_samplingrate(SRstring)
+        zi.scope_length(pts_per_shot)
+        if single_channel:
+            zi.scope_channels(1)
+        else:
+            zi.scope_channels(3)
+        #
+        zi.scope_trig_enable('ON')
+        # trigger delay reference point: at trigger event time
+        zi.scope_trig_reference(0)
+        zi.scope_trig_delay(1e-6)
+        zi.scope_trig_holdoffmode('s')
+        zi.scope_trig_holdoffseconds(60e-6)
+        zi.scope_trig_gating_enable('OFF')
+        zi.scope_trig_signal('Trig Input 2')
+        zi.scope_trig_level(0.5)  # we expect the AWG marker to have a 1 V high lvl
+        #
+        zi.scope_segments('ON')
+        zi.scope_segments_count(no_of_avgs)
 
 
 def prepareZIUHFLIForAlazar(zi, demod_freq, outputpwr, signalscaling):
@@ -395,89 +416,92 @@ def prepareZIUHFLIForAlazar(zi, demod_freq, outputpwr, signalscaling):
         outputpwr (float): The output power of the ZI UHF-LI (dBm)
         signalscaling (float): Scaling factor to apply AUX 1 Output signal
     """
+    # only write what changed since the last preparation
+    zi = cached_settings(zi)
 
-    # Demodulator
-    zi.oscillator1_freq(demod_freq)
-    zi.demod1_order(1)
-    zi.demod1_timeconstant(100e-9)
-    zi.signal_output1_on('ON')
-    # TODO: use this in post-processing to remove first part of demod. data
+    with zi.batched_settings():
+        # Demodulator
+        zi.oscillator1_freq(demod_freq)
+        zi.demod1_order(1)
+        zi.demod1_timeconstant(100e-9)
+        zi.signal_output1_on('ON')
+        # TODO: use this in post-processing to remove first part of demod. data
 
-    # output
-    zi.signal_output1_ampdef('dBm')
-    zi.signal_output1_amplitude(outputpwr)
+        # output
+        zi.signal_output1_ampdef('dBm')
+        zi.signal_output1_amplitude(outputpwr)
 
-    # input
-    zi.signal_input1_range(30e-3)
-    zi.signal_input2_range(30e-3)
+        # input
+        zi.signal_input1_range(30e-3)
+        zi.signal_input2_range(30e-3)
 
 
-    # output
-    zi.aux_out1.output('Demod R')
-    zi.aux_out1.channel(1)
-    zi.aux_out1.limitupper(0.4)
-    zi.aux_out1.limitlower(-0.4)
-    zi.aux_out1.scale(signalscaling)
+        # output
+        zi.aux_out1.output('Demod R')
+        zi.aux_out1.channel(1)
+        zi.aux_out1.limitupper(0.4)
+        zi.aux_out1.limitlower(-0.4)
+        zi.aux_out1.scale(signalscaling)
 
 
 def setupAlazarForT1(alazar, sampling_rate):
     # Configure all settings in the Alazar card
-    alazar.config(clock_source='INTERNAL_CLOCK',
-                  sample_rate=sampling_rate,
-                  #clock_source='EXTERNAL_CLOCK_10MHz_REF',
-                  #external_sample_rate=sampling_rate,
-                  clock_edge='CLOCK_EDGE_RISING',
-                  decimation=1,
-                  coupling=['DC','DC'],
-                  channel_range=[.4,.4],
-                  impedance=[50,50],
-                  trigger_operation='TRIG_ENGINE_OP_J',
-                  trigger_engine1='TRIG_ENGINE_J',
-                  trigger_source1='EXTERNAL',
-                  trigger_slope1='TRIG_SLOPE_POSITIVE',
-                  trigger_level1=160,
-                  trigger_engine2='TRIG_ENGINE_K',
-                  trigger_source2='DISABLE',
-                  trigger_slope2='TRIG_SLOPE_POSITIVE',
-                  trigger_level2=128,
-                  external_trigger_coupling='DC',
-                  external_trigger_range='ETR_TTL',
-                  trigger_delay=0,
-                  timeout_ticks=0,
-                  aux_io_mode='AUX_IN_AUXILIARY', # AUX_IN_TRIGGER_ENABLE for seq mode on
-                  aux_io_param='NONE' # TRIG_SLOPE_POSITIVE for seq mode on
-                 )
+    config_once(alazar, clock_source='INTERNAL_CLOCK',
+                        sample_rate=sampling_rate,
+                        #clock_source='EXTERNAL_CLOCK_10MHz_REF',
+                        #external_sample_rate=sampling_rate,
+                        clock_edge='CLOCK_EDGE_RISING',
+                        decimation=1,
+                        coupling=['DC','DC'],
+                        channel_range=[.4,.4],
+                        impedance=[50,50],
+                        trigger_operation='TRIG_ENGINE_OP_J',
+                        trigger_engine1='TRIG_ENGINE_J',
+                        trigger_source1='EXTERNAL',
+                        trigger_slope1='TRIG_SLOPE_POSITIVE',
+                        trigger_level1=160,
+                        trigger_engine2='TRIG_ENGINE_K',
+                        trigger_source2='DISABLE',
+                        trigger_slope2='TRIG_SLOPE_POSITIVE',
+                        trigger_level2=128,
+                        external_trigger_coupling='DC',
+                        external_trigger_range='ETR_TTL',
+                        trigger_delay=0,
+                        timeout_ticks=0,
+                        aux_io_mode='AUX_IN_AUXILIARY', # AUX_IN_TRIGGER_ENABLE for seq mode on
+                        aux_io_param='NONE' # TRIG_SLOPE_POSITIVE for seq mode on
+                       )
 
 
 def setupAlazarForT2(alazar, sampling_rate):
     # Configure all settings in the Alazar card
-    alazar.config(clock_source='INTERNAL_CLOCK',
-                  sample_rate=sampling_rate,
-                  #clock_source='EXTERNAL_CLOCK_10MHz_REF',
-                  #external_sample_rate=sampling_rate,
-                  clock_edge='CLOCK_EDGE_RISING',
-                  decimation=1,
-                  coupling=['DC','DC'],
-                  channel_range=[.4,.4],
-                  impedance=[50,50],
-                  trigger_operation='TRIG_ENGINE_OP_J',
-                  trigger_engine1='TRIG_ENGINE_J',
-                  trigger_source1='EXTERNAL',
-                  trigger_slope1='TRIG_SLOPE_POSITIVE',
-                  trigger_level1=160,
-                  trigger_engine2='TRIG_ENGINE_K',
-                  trigger_source2='DISABLE',
-                  trigger_slope2='TRIG_SLOPE_POSITIVE',
-                  trigger_level2=128,
-                  external_trigger_coupling='DC',
-                  external_trigger_range='ETR_TTL',
-                  trigger_delay=0,
-                  timeout_ticks=0,
-                  aux_io_mode='AUX_IN_AUXILIARY', # AUX_IN_TRIGGER_ENABLE for seq mode on
-                  aux_io_param='NONE' # TRIG_SLOPE_POSITIVE for seq mode on
-                 # aux_io_mode='AUX_IN_TRIGGER_ENABLE', 
-                 # aux_io_param='TRIG_SLOPE_POSITIVE'
-                 )    
+    config_once(alazar, clock_source='INTERNAL_CLOCK',
+                        sample_rate=sampling_rate,
+                        #clock_source='EXTERNAL_CLOCK_10MHz_REF',
+                        #external_sample_rate=sampling_rate,
+                        clock_edge='CLOCK_EDGE_RISING',
+                        decimation=1,
+                        coupling=['DC','DC'],
+                        channel_range=[.4,.4],
+                        impedance=[50,50],
+                        trigger_operation='TRIG_ENGINE_OP_J',
+                        trigger_engine1='TRIG_ENGINE_J',
+                        trigger_source1='EXTERNAL',
+                        trigger_slope1='TRIG_SLOPE_POSITIVE',
+                        trigger_level1=160,
+                        trigger_engine2='TRIG_ENGINE_K',
+                        trigger_source2='DISABLE',
+                        trigger_slope2='TRIG_SLOPE_POSITIVE',
+                        trigger_level2=128,
+                        external_trigger_coupling='DC',
+                        external_trigger_range='ETR_TTL',
+                        trigger_delay=0,
+                        timeout_ticks=0,
+                        aux_io_mode='AUX_IN_AUXILIARY', # AUX_IN_TRIGGER_ENABLE for seq mode on
+                        aux_io_param='NONE' # TRIG_SLOPE_POSITIVE for seq mode on
+                       # aux_io_mode='AUX_IN_TRIGGER_ENABLE', 
+                       # aux_io_param='TRIG_SLOPE_POSITIVE'
+                       )    
     
 def setupAlazarControllerForT1(alazar):
     myctrl = ATSChannelController(name='my_controller', alazar_name='Alazar')
@@ -494,7 +518,7 @@ def setupAlazarControllerForT2(alazar):
 class AlazarValues(ArrayParameter):
     
     def __init__(self, name, instrument, chan,\
-                 save_raw_data=True):
+                 save_raw_data=True, async_save=True, use_statistics=True):
         super().__init__(name=name,
                          shape=(1,),
                          label='Avg. demod. response',
@@ -506,39 +530,61 @@ class AlazarValues(ArrayParameter):
         self._instrument = instrument
         self._channel = chan
         self._rawdatacounter = 0
+        self._pointcounter = 0
         self._ready = False
         self._save_raw_data = save_raw_data
-#        self._pool = mp.Pool(30)
-#        self._result = []
+        self._async_save = async_save
+        self._use_statistics = use_statistics
+        self._writer = None
+        self._writer_counter = None
+        # variance of the raw samples of each pulse width at the last point
+        self.variance = None
         
     def prepare_alazar_values(self, pulsewidths):
         self.setpoints = (tuple(pulsewidths),)
         self.shape = (len(pulsewidths),)
         self._rawdatacounter = 0
+        self._pointcounter = 0
         self._ready = True
-    
-    @staticmethod
-    def save_single_raw_file(xdata, my_raw_data, rawdatacounter, maincounter):
-        xarr = DataArray(preset_data=xdata, is_setpoint=True, name='time', label='Time', unit='s')
-        yarr = DataArray(preset_data=my_raw_data,
-                         set_arrays=(xarr,), name='demodulated_signal', label='Demodulated Signal', unit='V')
-        name = '{0:06d}'.format(rawdatacounter)
-        locstring = '{}{:03}_raw{}'.format(CURRENT_EXPERIMENT['exp_folder'],
-                                           maincounter, sep)
-        rawdataset = new_data(location=locstring, arrays=[xarr, yarr])
-        rawdataset.formatter.number_format = '{:g}'
-        rawdataset.formatter.extension = '.raw'
-        rawdataset.finalize(filename=name, write_metadata=False)
-       # print('Wrote rawdata to {}'.format(rawdataset.location))
+
+    def _raw_writer(self, maincounter, xdata):
+        """
+        Return the writer of the raw data file of the current run,
+        i.e. of the dataset with number maincounter, opening a new
+        file when a new run has started
+        """
+        if self._writer is not None and self._writer_counter == maincounter:
+            return self._writer
+        self.close_raw_file()
+        filename = '{}{:03}_raw.h5'.format(CURRENT_EXPERIMENT['exp_folder'],
+                                           maincounter)
+        self._writer = RawTraceWriter(filename, xdata,
+                                      row_setpoints=self.setpoints[0])
+        if self._async_save:
+            self._writer = AsyncRawTraceWriter(self._writer)
+        self._writer_counter = maincounter
+        self._rawdatacounter = 0
+        self._pointcounter = 0
+        return self._writer
+
+    def close_raw_file(self):
+        """
+        Close the raw data file of the current run, waiting for all
+        queued traces to be written. Must be called when the measurement
+        has finished. Raises if writing any of the traces failed.
+        """
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            self._writer_counter = None
+            writer.close()
 
     def get_raw(self):
         
-        raw_data = self._channel.data.get()
-#        print("waiting for results")
-#        for res in self._result:
-#            print("waiting for {}".format(res))
-#            res.get()
-#        self._result = []
+        # statistics are only collected for this acquisition, so other
+        # users of the controller do not pay for them
+        with self._instrument.collecting_statistics(self._use_statistics):
+            raw_data = self._channel.data.get()
         
         #####################################
         # Save raw data to disk
@@ -547,9 +593,22 @@ class AlazarValues(ArrayParameter):
         
         xdata = self._channel.data.setpoints[1][0]
         
+        # one average per buffer, i.e. per pulse width
+        avg_data = np.mean(raw_data, 1)
+
         # simple tests for signal scaling correctness
-        max_val = raw_data.max()
-        min_val = raw_data.min()
+        # The statistics accumulated by the controller while acquiring
+        # spare extra passes over the raw data
+        stats = self._instrument.statistics
+        if stats is not None:
+            chan_num = {'A': 0, 'B': 1}[self._channel.alazar_channel()]
+            max_val = stats.max_volts[chan_num]
+            min_val = stats.min_volts[chan_num]
+            self.variance = stats.buffer_variance_volts[chan_num]
+        else:
+            max_val = raw_data.max()
+            min_val = raw_data.min()
+            self.variance = None
         
         if max_val > 0.39:
             log.warning('Maximum voltage at the upper clipping edge detected.')
@@ -561,16 +620,9 @@ class AlazarValues(ArrayParameter):
                         'dynamic Alazar range. Consider rescaling it.')
         
         if self._save_raw_data:
-            for rowind in range(np.shape(raw_data)[0]):
-#                self._result.append(self._pool.apply_async(self.save_single_raw_file, 
-#                                       (xdata, 
-#                                        raw_data[rowind,:], 
-#                                        self._rawdatacounter, 
-#                                        maincounter)))
-                
-                self.save_single_raw_file(xdata, raw_data[rowind,:], self._rawdatacounter, maincounter)
-                self._rawdatacounter += 1
-
+            writer = self._raw_writer(maincounter, xdata)
+            writer.append(self._pointcounter, raw_data)
+            self._rawdatacounter += np.shape(raw_data)[0]
+        self._pointcounter += 1
 
-        avg_data = np.mean(raw_data, 1)
-        return avg_data
\ No newline at end of file
+        return avg_data
@@ -1,7 +1,8 @@
 import numpy as np
 import qcodes as qc
-from pulsed_experiment_simple import (makeT2Sequence, sendSequenceToAWG,
+from pulsed_experiment_simple import (makeT2Sequence,
                                       prepareZIUHFLI, correctMeasTime)
+from awg_control import SequencerJumpParameter
 
 
 
@@ -13,6 +14,7 @@ from pulsed_experiment_simple import (makeT2Sequence, sendSequenceToAWG,
 
 hightimes = np.linspace(1e-9, 3e-9, 10)  # time the pulse is high/ON
 trig_delay = 0e-6  # delay between the end of the pulse and the measurement trigger
+RF_delay = 0e-6  # delay of marker1 relative to the end of the pulse
 meastime = 60e-6  # desired time the measurement, i.e. scope shot, should last (see note below)
 cycletime = meastime + 550e-6  # Time of one pulse-measure cycle. Repeated no_of_avgs times
 no_of_avgs = 50  # number of averages
@@ -47,15 +49,19 @@ print('Corrected meastime from {:.6f} s to {:.6f} s.'.format(oldmeastime, measti
 
 #%%
 
-seq = makeT2Sequence(hightimes, trig_delay, meastime,
+seq = makeT2Sequence(hightimes, trig_delay, RF_delay, meastime,
                      cycletime, pulsehigh, pulselow,
-                     no_of_avgs, SR)
+                     no_of_avgs, SR, router=True)
 
 # seq.plotSequence()
 
 #%%
 
-sendSequenceToAWG(awg, seq)
+# prepare the pulse width parameter. All widths are uploaded once and
+# setting a width only changes which element the router element plays
+step_param = SequencerJumpParameter('pulse_width', awg, hightimes,
+                                    label='Pulse width', unit='s')
+step_param.upload(seq)
 
 #%%
 
@@ -68,40 +74,8 @@ zi.Scope.add_post_trigger_action(awg.force_trigger)
 
 #%%
 
-# prepare the pusle width parameter
-
-
-def step_awg_to_next_pulse(awg, no_of_pulses):
-
-    counter = 0
-
-    while True:
-        target = (counter % (no_of_pulses)) + 2
-        awg.set_sqel_goto_target_index(1, target)
-        counter += 1
-        yield
-
-
-stepper = step_awg_to_next_pulse(awg, len(hightimes))
-
-
-def step_setter(value):
-    next(stepper)
-
-
-step_param = qc.Parameter('Pulse width', label='Pulse width',
-                          unit='s', set_cmd=step_setter)
-
-#%%
-
-
 # At least this code must be run on every measurement
 
-# re-initialise the counter
-stepper = step_awg_to_next_pulse(awg, len(hightimes))
-
-step_param.set = step_setter
-
 
 def make_things_right():
     prepareZIUHFLI(zi, demod_freq, npts, SRstring, no_of_avgs, meastime,
@@ -131,6 +105,6 @@ try:
     do2d(qdac.ch48.v, -1.98, -1.975, 10, 1, step_param, p1, p2, num, 100e-6, zi.scope_full_avg_ch1, resetTask)
 
 finally:
-    awg.set_sqel_goto_target_index(1, 2)
+    step_param.reset()
     awg.stop()
     zi.Scope._scopeactions = []
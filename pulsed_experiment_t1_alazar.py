@@ -14,6 +14,8 @@ from pulsed_experiment_simple import (makeT1Sequence, sendSequenceToAWG,
                                       setupAlazarForT1, setupAlazarControllerForT1)
 from alazar_controllers.ATSChannelController import ATSChannelController
 from alazar_controllers.alazar_channel import AlazarChannel
+from timing_planner import plan_timing
+from awg_control import AWGStarter
 ###############################################################################
 #                                                                             #
 #                         SET EXPERIMENT VARIABLES                            #
@@ -34,7 +36,7 @@ compensation_ratio = 0  # the compensation pusle time ratio
 outputpwr = -15  # the UHF-LI output power (dBm)
 signalscaling = 2000
 
-alazar_sampling_rate = 10_000_000
+alazar_sampling_rate = 10_000_000  # alazar sample rate, kept by plan_timing
 
 ###############################################################################
 #                                                                             #
@@ -49,17 +51,28 @@ zi = station['ziuhfli']
 alazar = station['alazar']
 alazarcontroller = station['alazarcontroller']
 
+# choose the alazar record length together with the
+# AWG timing such that as little time as possible is idle in each cycle
+plan = plan_timing(hightime, meastime, trig_delay=trig_delay,
+                   dead_time=extra_wait_time, awg_SR=SR,
+                   alazar_sample_rate=alazar_sampling_rate)
+alazar_sampling_rate = plan['alazar_sample_rate']
+
 # set alazar settigs
 setupAlazarForT1(alazar, alazar_sampling_rate)
 # set measuere time
-alazarcontroller.int_time(meastime)
 alazarcontroller.int_delay(0)
+alazarcontroller.int_time(plan['int_time'])
 
 oldmeastime = meastime
 # update the meastime with the real value based on allowed sampling rates
-meastime = alazarcontroller.samples_per_record()/alazar.get_sample_rate()
-cycletime = hightime + meastime + extra_wait_time  # Time of one pulse-measure cycle. Repeated no_of_avgs times
-print("Updated meastime from {} to {}".format(oldmeastime, meastime))
+hightime = plan['hightime']
+trig_delay = plan['trig_delay']
+meastime = plan['meastime']
+cycletime = plan['cycletime']  # Time of one pulse-measure cycle. Repeated no_of_avgs times
+print("Updated meastime from {} to {} at {} Sa/s, {} s idle per "
+      "cycle".format(oldmeastime, meastime, alazar_sampling_rate,
+                     plan['idle_time']))
 
 # setup alazar channel with the right format
 chan1 = AlazarChannel(alazarcontroller, 'mychan', demod=False, integrate_samples=False)
@@ -86,17 +99,9 @@ awg1.ch1_m2_high(2.6)
 # holding the scope data
 prepareZIUHFLIForAlazar(zi, demod_freq, outputpwr, signalscaling)
 #%%
-# define functions for running the awg with a hook from within the alazar
-def run_awg():
-    while awg1.state() == 'Running':
-       # print('AWG not ready')
-        time.sleep(10e-3)
-    awg1.run()
-
-def dummy_func():
-    pass
-
-alazarcontroller.pre_acquire = run_awg
+# start the awg from within the alazar acquisition once the previous
+# run, i.e. no_of_avgs cycles, has finished
+awg_starter = AWGStarter(awg1, run_duration=no_of_avgs*cycletime)
 
 #%%
 ###############################################################################
@@ -110,10 +115,9 @@ chan1.prepare_channel()
 try:
     #qc.Measure(chan1.data)
     nsteps = 150
-    plot, data = do1d(qdac.ch48.v, -2.204, -2.198, nsteps, 0.001, chan1.data)
+    with alazarcontroller.triggered_by(awg_starter):
+        plot, data = do1d(qdac.ch48.v, -2.204, -2.198, nsteps, 0.001, chan1.data)
 finally:
-    # remove the post trigger again
-    alazarcontroller.pre_acquire = dummy_func
     zi.signal_output1_on('OFF')
     awg1.all_channels_off()
     
\ No newline at end of file
@@ -16,6 +16,8 @@ from pulsed_experiment_simple import (makeT2Sequence, sendSequenceToAWG,
                                       AlazarValues)
 from alazar_controllers.ATSChannelController import ATSChannelController
 from alazar_controllers.alazar_channel import AlazarChannel
+from timing_planner import plan_timing
+from awg_control import AWGStarter
 ###############################################################################
 #                                                                             #
 #                         SET EXPERIMENT VARIABLES                            #
@@ -36,7 +38,7 @@ compensation_ratio = 0  # the compensation pusle time ratio
 outputpwr = -15  # the UHF-LI output power (dBm)
 signalscaling = 20000
 
-alazar_sampling_rate = 1_000_000_000
+alazar_sampling_rate = 1_000_000_000  # alazar sample rate, kept by plan_timing
 
 ###############################################################################
 #                                                                             #
@@ -53,17 +55,28 @@ alazar.buffer_timeout._set(10000)
 alazar.buffer_timeout._set_updated()
 alazarcontroller = station['alazarcontroller']
 
+# choose the alazar record length together with the
+# AWG timing such that as little time as possible is idle in each cycle
+plan = plan_timing(hightimes, meastime, trig_delay=trig_delay,
+                   dead_time=extra_wait_time, awg_SR=SR,
+                   alazar_sample_rate=alazar_sampling_rate)
+alazar_sampling_rate = plan['alazar_sample_rate']
+
 # set alazar settigs
 setupAlazarForT2(alazar, alazar_sampling_rate)
 # set measuere time
-alazarcontroller.int_time(meastime)
 alazarcontroller.int_delay(0)
+alazarcontroller.int_time(plan['int_time'])
 
 oldmeastime = meastime
 # update the meastime with the real value based on allowed sampling rates
-meastime = alazarcontroller.samples_per_record()/alazar.get_sample_rate()
-cycletime = max(hightimes) + meastime + extra_wait_time  # Time of one pulse-measure cycle. Repeated no_of_avgs times
-print("Updated meastime from {} to {}".format(oldmeastime, meastime))
+hightimes = plan['hightime']
+trig_delay = plan['trig_delay']
+meastime = plan['meastime']
+cycletime = plan['cycletime']  # Time of one pulse-measure cycle. Repeated no_of_avgs times
+print("Updated meastime from {} to {} at {} Sa/s, {} s idle per "
+      "cycle".format(oldmeastime, meastime, alazar_sampling_rate,
+                     plan['idle_time']))
 
 # setup alazar channel with the right format
 chan1 = AlazarChannel(alazarcontroller, 'T2', demod=False,
@@ -90,17 +103,10 @@ awg1.ch1_m2_high(2.6)
 # holding the scope data
 prepareZIUHFLIForAlazar(zi, demod_freq, outputpwr, signalscaling)
 #%%
-# define functions for running the awg with a hook from within the alazar
-# define functions for running the awg with a hook from within the alazar
-def run_awg():
-    while awg1.state() == 'Running':
-        time.sleep(50e-3)
-    awg1.run()
-
-def dummy_func():
-    pass
-
-alazarcontroller.pre_acquire = run_awg
+# start the awg from within the alazar acquisition once the previous
+# run, i.e. no_of_avgs cycles of every pulse width, has finished
+awg_starter = AWGStarter(awg1,
+                         run_duration=len(hightimes)*no_of_avgs*cycletime)
 
 #%%
 ###############################################################################
@@ -127,10 +133,10 @@ try:
 #    loop = qc.Loop(sweep, 0.01).each(av)
 #    data = loop.run()
     nsteps = 200
-    plot, data = do1d(qdac.ch48.v, -2.206, -2.2, nsteps, 0.001, av)
+    with alazarcontroller.triggered_by(awg_starter):
+        plot, data = do1d(qdac.ch48.v, -2.206, -2.2, nsteps, 0.001, av)
 finally:
-    # remove the post trigger again
-    alazarcontroller.pre_acquire = dummy_func
     zi.signal_output1_on('OFF')
+    av.close_raw_file()
     av._rawdatacounter = 0
     awg1.all_channels_off()
\ No newline at end of file
@@ -0,0 +1,196 @@
+# Module containing the storage of raw (undemodulated) traces
+import logging
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class RawTraceWriter:
+    """
+    Object to append the raw traces of a run to a single HDF5 file.
+
+    Every sweep point contributes a number of rows (e.g. one per pulse
+    width) of equally long traces. All rows end up in one chunked, growing
+    dataset together with an index of (sweep point, row), so that a run
+    needs only a single file to be opened and no text formatting.
+
+    The file layout is:
+        traces: (number of rows, samples) the raw traces
+        index: (number of rows, 2) sweep point and row of each trace
+        time: (samples,) the time axis of the traces
+        row_setpoints: (rows per point,) the setpoints of the rows, if given
+
+    Args:
+        filename (str): The path of the file to create
+        time_axis (array): The time axis of the traces (s)
+        row_setpoints (Optional[array]): The setpoints of the rows of each
+            sweep point, e.g. the pulse widths.
+        chunk_rows (int): The number of rows per HDF5 chunk
+        dtype (str): The data type to store the traces as. float32 is
+            plenty for the 12 bit Alazar data.
+    """
+
+    def __init__(self, filename, time_axis, row_setpoints=None,
+                 chunk_rows=256, dtype='float32'):
+
+        self.filename = filename
+        self._samples = len(time_axis)
+        self._rows = 0
+
+        self._file = h5py.File(filename, 'w')
+        self._traces = self._file.create_dataset(
+            'traces', shape=(0, self._samples), maxshape=(None, self._samples),
+            chunks=(chunk_rows, self._samples), dtype=dtype)
+        self._index = self._file.create_dataset(
+            'index', shape=(0, 2), maxshape=(None, 2),
+            chunks=(chunk_rows, 2), dtype='int64')
+        self._file.create_dataset('time', data=np.asarray(time_axis))
+        if row_setpoints is not None:
+            self._file.create_dataset('row_setpoints',
+                                      data=np.asarray(row_setpoints))
+        if self._samples > 1:
+            self._file.attrs['sample_rate'] = 1/(time_axis[1]-time_axis[0])
+
+        log.info('Writing raw traces to {}'.format(filename))
+
+    @property
+    def rows(self):
+        """
+        The number of traces written so far
+        """
+        return self._rows
+
+    def append(self, point, traces):
+        """
+        Append the traces of a sweep point
+
+        Args:
+            point (int): The number of the sweep point
+            traces (array): The traces, shape (rows, samples)
+        """
+        traces = np.atleast_2d(traces)
+        if traces.shape[1] != self._samples:
+            raise ValueError('Expected traces with {} samples, got '
+                             '{}.'.format(self._samples, traces.shape[1]))
+        nrows = traces.shape[0]
+        start = self._rows
+        stop = start + nrows
+
+        self._traces.resize(stop, axis=0)
+        self._traces[start:stop] = traces
+        self._index.resize(stop, axis=0)
+        self._index[start:stop, 0] = point
+        self._index[start:stop, 1] = np.arange(nrows)
+
+        self._rows = stop
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AsyncRawTraceWriter:
+    """
+    Wrapper around a RawTraceWriter which does the writing in a dedicated
+    thread fed through a bounded queue. Appending only waits for the disk
+    if the queue is full, which throttles the measurement rather than
+    letting the memory grow without bounds.
+
+    An error in the writer thread is raised from the next call to append,
+    flush or close, so that no data is lost silently.
+
+    Args:
+        writer (RawTraceWriter): The writer to do the actual writing
+        maxsize (int): The maximal number of sweep points waiting to be
+            written
+    """
+
+    _stop = object()
+
+    def __init__(self, writer, maxsize=16):
+
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='RawTraceWriter',
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def filename(self):
+        return self.writer.filename
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._stop:
+                    return
+                if self._error is None:
+                    self.writer.append(*item)
+            except Exception as e:
+                log.exception('Failed to write raw traces to '
+                              '{}'.format(self.writer.filename))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Writing raw traces to {} '
+                               'failed'.format(self.writer.filename)) \
+                from self._error
+
+    def append(self, point, traces):
+        """
+        Queue the traces of a sweep point for writing. The traces must
+        not be modified afterwards.
+
+        Args:
+            point (int): The number of the sweep point
+            traces (array): The traces, shape (rows, samples)
+        """
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError('The raw trace writer has been closed.')
+        if self._queue.full():
+            log.debug('Raw trace queue full, waiting for the disk.')
+        self._queue.put((point, traces))
+
+    def flush(self):
+        """
+        Wait for all queued traces to be written and flush the file
+        """
+        self._queue.join()
+        self._raise_error()
+        self.writer.flush()
+
+    def close(self):
+        """
+        Write all queued traces, stop the thread and close the file
+        """
+        if self._thread.is_alive():
+            self._queue.put(self._stop)
+            self._thread.join()
+        self.writer.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
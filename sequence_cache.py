@@ -0,0 +1,385 @@
+# Module containing a cache of built and rendered broadbean sequences
+import copy
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from inspect import signature
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def _normalise(obj):
+    """
+    Turn obj into nested tuples of plain python objects with a stable repr,
+    such that equal contents give equal keys (dict order and long numpy
+    arrays would otherwise spoil the repr)
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((repr(key), _normalise(value))
+                            for key, value in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_normalise(value) for value in obj)
+    if isinstance(obj, np.ndarray):
+        return ('ndarray', obj.dtype.str, obj.shape, tuple(obj.ravel().tolist()))
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if callable(obj):
+        return getattr(obj, '__qualname__', repr(obj))
+    return obj
+
+
+def _nbytes(obj, seen=None):
+    """
+    Estimate of the memory held by obj, dominated by its numpy arrays
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_nbytes(key, seen) + _nbytes(value, seen)
+                   for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(_nbytes(value, seen) for value in obj)
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + _nbytes(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
+def make_key(*parts):
+    """
+    Content hash of the given objects
+    """
+    return hashlib.sha1(repr(_normalise(parts)).encode('utf-8')).hexdigest()
+
+
+class SequenceCache:
+    """
+    Two tier cache of built sequences and rendered AWG packages.
+
+    The first tier is an in-memory LRU dict holding entries of at most
+    max_bytes in total (estimated from their numpy arrays). The optional
+    second tier holds pickled entries on disk such that a rerun of an
+    identical experiment in a new session skips the building and rendering
+    as well. Only entries put with persist=True are written to disk, so
+    the renders of a sweep do not pay for pickling on every point. The
+    disk tier is limited to max_disk_entries files, the least recently
+    used are removed.
+
+    The disk entries are unpickled when read, which runs arbitrary code,
+    so the directory must only be writable by the user, i.e. never a
+    shared temporary directory.
+
+    Entries are keyed on content hashes (see make_key), so a stale entry
+    can only be hit if the pulse atoms of broadbean change under the
+    same version number.
+
+    Args:
+        max_bytes (int): The maximal size of the entries in memory (bytes)
+        directory (Optional[str]): The (private) directory of the disk
+            tier. If None, only the memory tier is used.
+        max_disk_entries (int): The maximal number of entries on disk
+    """
+
+    def __init__(self, max_bytes=256*2**20, directory=None,
+                 max_disk_entries=256):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.pkl'.format(key))
+
+    def get(self, key):
+        """
+        Return the cached value of key or None
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log.warning('Could not read cached sequence {}: '
+                            '{}'.format(path, e))
+            else:
+                # mark as recently used for the disk eviction
+                os.utime(path)
+                self._remember(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def __contains__(self, key):
+        """
+        Whether key is in the memory tier, without counting a hit or
+        marking it as used
+        """
+        return key in self._memory
+
+    def put(self, key, value, persist=True):
+        """
+        Cache value under key, on disk as well if persist is True and
+        there is a disk tier
+        """
+        self._remember(key, value)
+        if not persist or self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, path)
+        except Exception as e:
+            log.warning('Could not write cached sequence {}: '
+                        '{}'.format(path, e))
+            return
+        self._evict_disk()
+
+    def _remember(self, key, value):
+        self._forget(key)
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            log.debug('Not keeping an entry of {} bytes in a cache of '
+                      '{} bytes.'.format(size, self.max_bytes))
+            return
+        self._memory[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self._forget(next(iter(self._memory)))
+
+    def _forget(self, key):
+        if key in self._memory:
+            del self._memory[key]
+            self.nbytes -= self._sizes.pop(key)
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory)
+                 if name.endswith('.pkl')]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self, disk=False):
+        """
+        Empty the memory tier and, if disk is True, the disk tier
+        """
+        self._memory.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def memoize(self, func):
+        """
+        Decorator caching the sequences returned by func, keyed on the
+        name and code of func and all of its arguments (defaults
+        included). A copy is returned on every call since the callers
+        modify their sequence, e.g. set voltage ranges.
+        """
+        sig = signature(func)
+        code = func.__code__
+        func_id = (func.__module__, func.__qualname__,
+                   code.co_code, repr(code.co_consts))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = make_key('build', func_id, bound.arguments)
+            seq = self.get(key)
+            if seq is None:
+                seq = func(*args, **kwargs)
+                self.put(key, seq)
+            return copy.deepcopy(seq)
+
+        return wrapper
+
+    @staticmethod
+    def render_key(seq):
+        """
+        The key of the rendered package of seq, hashed from its full
+        pickled content. Unlike the description of a sequence, which
+        reduces array elements to the string 'array', this covers the
+        waveform arrays as well as the AWG settings. Returns None if seq
+        can not be pickled, e.g. as it holds a lambda.
+        """
+        try:
+            content = pickle.dumps(seq, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.debug('Not caching an unpicklable sequence: {}'.format(e))
+            return None
+        # the version of the package (i.e. broadbean) defining the sequence
+        package = sys.modules.get(type(seq).__module__.split('.')[0])
+        return make_key('render', getattr(package, '__version__', None),
+                        hashlib.sha1(content).hexdigest())
+
+    def render(self, seq, persist=True):
+        """
+        Return the output of seq.outputForAWGFile(), from the cache if a
+        sequence with identical content (elements, waveform arrays and AWG
+        settings) has been rendered before. The returned package must not
+        be modified.
+
+        Args:
+            seq (bb.Sequence): The sequence
+            persist (bool): Whether a new render goes to the disk tier.
+                Pass False for renders of a single point of a sweep.
+        """
+        key = self.render_key(seq)
+        if key is None:
+            return seq.outputForAWGFile()
+        package = self.get(key)
+        if package is None:
+            package = seq.outputForAWGFile()
+            self.put(key, package, persist=persist)
+        return package
+
+
+# The default cache, in memory only. Give it a private directory to keep
+# sequences across sessions.
+sequence_cache = SequenceCache()
+
+
+def cached_sequence(func):
+    """
+    Decorator memoizing a sequence building function in the default cache
+    """
+    return sequence_cache.memoize(func)
+
+
+def render_sequence(seq, persist=True):
+    """
+    Render a sequence for upload using the default cache
+    """
+    return sequence_cache.render(seq, persist=persist)
+
+
+def _render_package(seq):
+    """
+    Render a sequence, in a worker process of a SequencePrefetcher
+    """
+    return seq.outputForAWGFile()
+
+
+class SequencePrefetcher:
+    """
+    Renders the sequences of a sweep in a pool of processes ahead of the
+    sweep, such that the rendering overlaps with the measurement of the
+    earlier points.
+
+    The sequences are built (cheaply) in this process by make_sequence
+    and rendered in the pool. At most max_ahead renders are in flight and
+    finished renders go into the memory tier of the (bounded) sequence
+    cache, where render picks them up. Values are expected to be consumed in order, a value
+    that was not prefetched is simply rendered on the spot.
+
+    On Windows the worker processes import the __main__ module, so the
+    sweep must be started from a script or an interactive session rather
+    than at import time of a module.
+
+    Args:
+        make_sequence (callable): Function returning the sequence to
+            render for a sweep value
+        values (iterable): The sweep values in the order of the sweep
+        max_ahead (int): The maximal number of sequences rendered ahead
+        processes (Optional[int]): The number of worker processes
+        cache (Optional[SequenceCache]): The cache to fill. Default is the
+            default cache.
+    """
+
+    def __init__(self, make_sequence, values, max_ahead=4, processes=None,
+                 cache=None):
+        self.make_sequence = make_sequence
+        self.values = list(values)
+        self.max_ahead = max_ahead
+        self.cache = sequence_cache if cache is None else cache
+        self._pool = ProcessPoolExecutor(max_workers=processes)
+        self._next = 0
+        self._pending = OrderedDict()
+        self._top_up()
+
+    def _top_up(self):
+        while (len(self._pending) < self.max_ahead and
+               self._next < len(self.values)):
+            seq = self.make_sequence(self.values[self._next])
+            self._next += 1
+            key = self.cache.render_key(seq)
+            if key is None or key in self._pending or key in self.cache:
+                continue
+            self._pending[key] = self._pool.submit(_render_package, seq)
+
+    def _harvest(self, key=None):
+        """
+        Move finished renders, and the render of key once it has finished,
+        into the cache
+        """
+        for pending_key, future in list(self._pending.items()):
+            if pending_key == key or future.done():
+                del self._pending[pending_key]
+                try:
+                    self.cache.put(pending_key, future.result(),
+                                   persist=False)
+                except Exception as e:
+                    log.warning('Prefetching a sequence failed, rendering '
+                                'it on the spot: {}'.format(e))
+
+    def render(self, seq):
+        """
+        Return the rendered package of seq, waiting for its prefetch if
+        it is in flight, and keep the pool busy with the next values
+        """
+        self._harvest(self.cache.render_key(seq))
+        package = self.cache.render(seq, persist=False)
+        self._top_up()
+        return package
+
+    def close(self):
+        """
+        Cancel all pending renders and shut down the pool
+        """
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,155 @@
+# Module containing a cache of instrument settings to skip redundant writes
+import logging
+from weakref import WeakKeyDictionary
+
+log = logging.getLogger(__name__)
+
+# The values last written through the cache, per instrument (or channel)
+_written = WeakKeyDictionary()
+
+# The keyword arguments of the last Alazar config call, per Alazar
+_configs = WeakKeyDictionary()
+
+# Instrument methods after which the instrument state is unknown
+_INVALIDATING_METHODS = ('reset', 'connect', 'device_clear')
+
+_missing = object()
+
+
+def _equal(a, b):
+    """
+    Equality that does not choke on arrays or incomparable types
+    """
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def invalidate(instrument=None):
+    """
+    Forget the settings written to an instrument (and its channels), e.g.
+    after it was reset or reconnected or changed from its front panel.
+    Without an instrument, forget everything.
+    """
+    if instrument is None:
+        _written.clear()
+        _configs.clear()
+        return
+    _written.pop(instrument, None)
+    _configs.pop(instrument, None)
+    for submodule in getattr(instrument, 'submodules', {}).values():
+        invalidate(submodule)
+
+
+class CachedParameter:
+    """
+    Wrapper around a settable parameter skipping a set if the value was
+    written through the cache before and the parameter still holds it
+    (according to get_latest), i.e. nobody changed it in the meantime.
+    Everything else is passed on to the parameter.
+    """
+
+    def __init__(self, parameter, owner):
+        self._parameter = parameter
+        self._owner = owner
+
+    def __call__(self, *args):
+        if len(args) == 0:
+            return self._parameter.get()
+        self.set(*args)
+
+    def set(self, value):
+        name = self._parameter.name
+        written = _written.setdefault(self._owner, {})
+        if (_equal(written.get(name, _missing), value) and
+                _equal(self._parameter.get_latest(), value)):
+            log.debug('Skipping set of {} to {}, already '
+                      'set.'.format(self._parameter.full_name, value))
+            return
+        # forget the value first such that a failed set is redone
+        written.pop(name, None)
+        self._parameter.set(value)
+        written[name] = value
+
+    def __getattr__(self, name):
+        return getattr(self._parameter, name)
+
+
+class CachedSettings:
+    """
+    Proxy around an instrument whose settable parameters skip writing
+    values they already have (see CachedParameter). Channels are wrapped
+    as well, all other attributes are those of the instrument. The written
+    values are remembered per instrument for the session, so repeated
+    preparations through different proxies only write what changed.
+
+    Calling reset, connect or device_clear through the proxy forgets the
+    written values, other changes of the instrument are caught by
+    get_latest as long as they go through qcodes.
+    """
+
+    def __init__(self, instrument):
+        self._instrument = instrument
+
+    @property
+    def instrument(self):
+        return self._instrument
+
+    @property
+    def parameters(self):
+        return {name: self._wrap(parameter)
+                for name, parameter in self._instrument.parameters.items()}
+
+    def _wrap(self, parameter):
+        if getattr(parameter, 'has_set', False):
+            return CachedParameter(parameter, self._instrument)
+        return parameter
+
+    def invalidate(self):
+        invalidate(self._instrument)
+
+    def __getattr__(self, name):
+        attr = getattr(self._instrument, name)
+        if name in self._instrument.parameters:
+            return self._wrap(attr)
+        if name in getattr(self._instrument, 'submodules', {}):
+            return CachedSettings(attr)
+        if name in _INVALIDATING_METHODS and callable(attr):
+            def invalidating(*args, **kwargs):
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    self.invalidate()
+            return invalidating
+        return attr
+
+
+def cached_settings(instrument):
+    """
+    Return a proxy of instrument skipping redundant parameter writes, see
+    CachedSettings
+    """
+    if isinstance(instrument, CachedSettings):
+        return instrument
+    return CachedSettings(instrument)
+
+
+def config_once(alazar, **settings):
+    """
+    Call alazar.config with the settings unless the very same settings
+    were configured last time and the card parameters still hold them
+
+    Returns:
+        bool: Whether the card was configured
+    """
+    if (_equal(_configs.get(alazar), settings) and
+            all(_equal(alazar.parameters[name].get_latest(), value)
+                for name, value in settings.items()
+                if name in alazar.parameters)):
+        log.debug('Skipping config of {}, already configured.'.format(alazar.name))
+        return False
+    _configs.pop(alazar, None)
+    alazar.config(**settings)
+    _configs[alazar] = dict(settings)
+    return True
@@ -0,0 +1,73 @@
+# Module containing an acquisition shared by the parameters measured at one
+# point of a sweep
+from contextlib import contextmanager
+
+
+class SharedAcquisition:
+    """
+    An acquisition (e.g. a scope shot) read by several parameters.
+
+    Outside of sharing every get acquires anew. Inside sharing the
+    acquisition is kept for the current point, which is only advanced by
+    next_point, i.e. by the sweep itself. All parameters measured at a
+    point thus get the same data, whatever order and number of parameters
+    the sweep measures.
+
+    Args:
+        acquire (callable): Function returning a new acquisition
+    """
+
+    def __init__(self, acquire):
+        self.acquire = acquire
+        self.point = None
+        self._data = None
+        self._data_point = None
+
+    @property
+    def shared(self):
+        return self.point is not None
+
+    def get(self):
+        """
+        Return the acquisition of the current point, acquiring it if
+        needed
+        """
+        if not self.shared:
+            return self.acquire()
+        if self._data_point != self.point:
+            self._data = self.acquire()
+            self._data_point = self.point
+        return self._data
+
+    def next_point(self):
+        """
+        Mark the advance of the sweep, the next get acquires anew
+        """
+        if not self.shared:
+            raise RuntimeError('The acquisition is not shared, use sharing.')
+        self.point += 1
+
+    def invalidate(self):
+        """
+        Forget the acquisition, e.g. after the acquisition settings changed
+        """
+        self._data = None
+        self._data_point = None
+
+    @contextmanager
+    def sharing(self):
+        """
+        Context manager sharing the acquisition between the gets of each
+        point. Call next_point at every point of the sweep, before the
+        parameters are measured.
+        """
+        if self.shared:
+            yield self
+            return
+        self.point = 0
+        self.invalidate()
+        try:
+            yield self
+        finally:
+            self.point = None
+            self.invalidate()
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('qcodes')
+pytest.importorskip('scipy')
+
+from alazar_controllers.ATSChannelController import ATSChannelController  # noqa: E402
+from alazar_controllers.demodulator import Demodulator  # noqa: E402
+
+BUFFERS = 4
+RECORDS = 3
+SAMPLES = 256
+SAMPLE_RATE = 100e6
+FREQ = 10e6
+
+
+class Setting:
+    """
+    Stands in for the manual parameters of the controller
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+class FakeAlazar:
+
+    def __init__(self):
+        self.samples_per_record = Setting(SAMPLES)
+        self.records_per_buffer = Setting(RECORDS)
+        self.buffers_per_acquisition = Setting(BUFFERS)
+
+
+def make_controller(average_buffers=False, average_records=False,
+                    integrate_samples=False, memory_limit=None,
+                    chunk_axis='buffers', output_files=None):
+    # the controller is built without an alazar, only the post processing
+    # state set up by the channels and pre_start_capture is needed
+    controller = object.__new__(ATSChannelController)
+    alazar = FakeAlazar()
+    controller._get_alazar = lambda: alazar
+    controller.number_of_channels = 2
+    controller.board_info = {'bits_per_sample': 12}
+    controller.trigger_source = None
+    controller.statistics = None
+    controller.post_acquire_memory_limit = Setting(memory_limit)
+    controller.post_acquire_chunk_axis = Setting(chunk_axis)
+    controller.demod_reference = Setting('software')
+    controller.int_delay = Setting(0.5e-6)
+    controller.int_time = Setting(1e-6)
+    controller.shape_info = {'average_buffers': average_buffers,
+                             'average_records': average_records,
+                             'integrate_samples': integrate_samples,
+                             'output_order': [0, 1, 2],
+                             'output_files': output_files}
+    controller.active_channels_nested = [
+        {'nsignals': 3, 'raw': True, 'demod_freqs': [FREQ, FREQ],
+         'demod_types': ['magnitude', 'phase']},
+        {'nsignals': 0, 'raw': False, 'demod_freqs': [],
+         'demod_types': []}]
+    stream = controller._streaming()
+    controller.demodulator = Demodulator(BUFFERS, RECORDS, SAMPLES,
+                                         SAMPLE_RATE,
+                                         {'filter': 0, 'numtaps': 21},
+                                         [FREQ, FREQ],
+                                         average_buffers or stream,
+                                         average_records,
+                                         integrate_samples,
+                                         channel_index=[0, 0])
+    controller._records_per_buffer = RECORDS
+    controller._samples_per_record = SAMPLES
+    controller._stream_outputs = None
+    return controller
+
+
+def make_block(buffers=BUFFERS):
+    rng = np.random.RandomState(0)
+    codes = rng.randint(0, 4096, size=(buffers, RECORDS, SAMPLES, 2))
+    return (codes << 4).astype(np.uint16)
+
+
+def test_only_needed_channels_are_stacked():
+    controller = make_controller()
+    assert controller._stacked_channels() == (0, 0)
+    controller.demod_reference.set('B')
+    assert controller._stacked_channels() == (0, 1)
+
+
+@pytest.mark.parametrize('chunk_axis', ['buffers', 'records'])
+@pytest.mark.parametrize('average_buffers,average_records',
+                         [(False, False), (True, False), (False, True)])
+def test_slabs_match_a_single_block(chunk_axis, average_buffers,
+                                    average_records):
+    block = make_block(1 if average_buffers else BUFFERS)
+    if average_buffers:
+        # the buffer holds the sum of all buffers
+        block = block.astype(np.float64)*BUFFERS
+    whole = make_controller(average_buffers, average_records,
+                            chunk_axis=chunk_axis)
+    # one byte per slab forces slabs of a single buffer or record
+    slabs = make_controller(average_buffers, average_records,
+                            memory_limit=1, chunk_axis=chunk_axis)
+
+    expected = whole._process_block(block, BUFFERS)
+    processed = slabs._process_in_slabs(block, BUFFERS)
+
+    assert slabs._slab_length(block.shape, slabs._slab_axis(block.shape)) == 1
+    assert len(processed) == len(expected) == 3
+    for data, expected_data in zip(processed, expected):
+        np.testing.assert_array_equal(data, expected_data)
+
+
+def test_nothing_to_slab_when_averaging_everything():
+    block = make_block(1).astype(np.float64)*BUFFERS
+    controller = make_controller(True, True, memory_limit=1)
+
+    assert controller._slab_axis(block.shape) is None
+    processed = controller._process_in_slabs(block, BUFFERS)
+    for data, expected in zip(processed,
+                              controller._process_block(block, BUFFERS)):
+        np.testing.assert_array_equal(data, expected)
+
+
+def acquire(controller, block):
+    for buffernum, data in enumerate(block):
+        controller.handle_buffer(data.ravel(), buffernum)
+    return controller.post_acquire()
+
+
+def test_streamed_outputs_match_the_block(tmp_path):
+    block = make_block()
+    filenames = [str(tmp_path/'raw.npy'), None, str(tmp_path/'phase.npy')]
+    in_memory = make_controller()
+    memmapped = make_controller(output_files=filenames)
+    for controller in (in_memory, memmapped):
+        assert controller._streaming()
+        controller._allocate_stream_outputs((BUFFERS, RECORDS, SAMPLES))
+
+    assert isinstance(memmapped._stream_outputs[0], np.memmap)
+    assert not isinstance(memmapped._stream_outputs[1], np.memmap)
+    expected = in_memory._process_block(block, BUFFERS)
+    from_memory = acquire(in_memory, block)
+    from_memmap = acquire(memmapped, block)
+    for data, memmap_data, expected_data in zip(from_memory, from_memmap,
+                                                expected):
+        np.testing.assert_array_equal(data, expected_data)
+        np.testing.assert_array_equal(memmap_data, expected_data)
+    np.testing.assert_array_equal(np.load(filenames[0]), expected[0])
+    np.testing.assert_array_equal(np.load(filenames[2]), expected[2])
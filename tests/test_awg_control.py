@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('qcodes')
+
+import awg_control
+
+
+class VisaHandle:
+
+    def __init__(self, log):
+        self.log = log
+
+    def write(self, cmd):
+        self.log.append(('write', cmd))
+
+    def query(self, cmd):
+        self.log.append(('query', cmd))
+        return '"C:\\Users\\OEM\\Documents"\n'
+
+
+class OldAWG:
+    """
+    The AWG5014 of qcodes 0.1.x: public pack_waveform and generate_awg_file
+    """
+
+    name = 'awg'
+    parameters = {}
+
+    def __init__(self):
+        self.log = []
+        self.visa_handle = VisaHandle(self.log)
+
+    def pack_waveform(self, wf, m1, m2):
+        return (wf, m1, m2)
+
+    def generate_awg_file(self, packed_waveforms, wfname_l, *args, **kwargs):
+        self.log.append(('generate', dict(packed_waveforms), wfname_l))
+        return b'awgfile'
+
+    def send_awg_file(self, filename, awg_file):
+        self.log.append(('send', filename))
+
+    def load_awg_file(self, filename):
+        self.log.append(('load', filename))
+
+
+class NewAWG(OldAWG):
+    """
+    The AWG5014 of qcodes 0.2.x: private methods behind deprecated shims
+    """
+
+    _pack_waveform = OldAWG.pack_waveform
+    _generate_awg_file = OldAWG.generate_awg_file
+
+    def pack_waveform(self, *args):
+        raise AssertionError('deprecated shim used')
+
+    def generate_awg_file(self, *args, **kwargs):
+        raise AssertionError('deprecated shim used')
+
+
+def make_package(elements):
+    waveforms = [[np.full(4, value, dtype=float) for value in elements]]
+    markers = [[np.zeros(4) for _ in elements]]
+    n = len(elements)
+    return (waveforms, markers, markers, [1]*n, [0]*n, [0]*n, [0]*n)
+
+
+@pytest.mark.parametrize('awg_class', [OldAWG, NewAWG])
+def test_deduplicated_file_shares_identical_waveforms(awg_class):
+    awg = awg_class()
+    awg_control.make_deduplicated_awg_file(awg, make_package([0, 1, 0]))
+    _, packed, names = awg.log[-1]
+    assert sorted(packed) == ['wfm001ch1', 'wfm002ch1']
+    assert names.tolist() == [['wfm001ch1', 'wfm002ch1', 'wfm001ch1']]
+
+
+@pytest.mark.parametrize('channels, names', [(None, ('1', '2')),
+                                             ([3, 4], ('3', '4'))])
+def test_identical_waveforms_of_different_channels_are_kept(channels, names):
+    awg = OldAWG()
+    single = make_package([0, 1])
+    # both channels play the same waveforms
+    package = tuple(2*part for part in single[:3]) + single[3:]
+    awg_control.make_deduplicated_awg_file(awg, package, channels=channels)
+    _, packed, wavenames = awg.log[-1]
+
+    first, second = names
+    assert wavenames.tolist() == [['wfm001ch' + first, 'wfm002ch' + first],
+                                  ['wfm001ch' + second, 'wfm002ch' + second]]
+    assert len(packed) == 4
+    # the channel of a waveform is the last character of its name
+    for channel, namelist in zip(names, wavenames):
+        assert all(name[-1] == channel for name in namelist)
+
+
+@pytest.mark.parametrize('awg_class', [OldAWG, NewAWG])
+def test_upload_sets_directory_before_sending(awg_class):
+    awg = awg_class()
+    assert awg_control.upload_package(awg, make_package([0, 1]))
+    kinds = [entry[0] for entry in awg.log]
+    assert kinds.index('write') < kinds.index('send') < kinds.index('load')
+    assert ('write', 'MMEMory:CDIRectory "C:\\Users\\OEM\\Documents"') in awg.log
+    assert ('load', 'C:\\Users\\OEM\\Documents\\customawgfile.awg') in awg.log
+
+
+def test_identical_package_is_uploaded_once():
+    awg = OldAWG()
+    package = make_package([0, 1])
+    assert awg_control.upload_package(awg, package)
+    assert not awg_control.upload_package(awg, package)
+    assert awg_control.upload_package(awg, package, force=True)
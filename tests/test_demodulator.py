@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+
+from alazar_controllers.demodulator import Demodulator, filter_win  # noqa: E402
+
+SAMPLE_RATE = 500e6
+SAMPLES = 1024
+FREQ = 20e6
+RECORDS = 5
+FILTER = {'filter': 0, 'numtaps': 101}
+# well after the transient of the low pass filter
+INT_DELAY = 0.8e-6
+INT_TIME = 0.8e-6
+
+
+def tone(amplitude, phase):
+    time = np.arange(SAMPLES)/SAMPLE_RATE
+    return amplitude*np.cos(2*np.pi*FREQ*time + np.asarray(phase)[..., None])
+
+
+def make_demodulator(demod_freqs=(FREQ,), **kwargs):
+    return Demodulator(1, RECORDS, SAMPLES, SAMPLE_RATE, FILTER, demod_freqs,
+                       average_buffers=True, average_records=False, **kwargs)
+
+
+def test_phase_relative_to_reference_is_constant():
+    rng = np.random.RandomState(0)
+    # the source drifts against the alazar clock from record to record but
+    # the signal keeps a fixed phase offset to the reference
+    drift = rng.uniform(-np.pi, np.pi, size=(1, RECORDS))
+    offset = 0.7
+    records = np.stack([tone(0.2, drift + offset), tone(0.5, drift)])
+    demodulator = make_demodulator(channel_index=[0], reference_channel=1)
+
+    magnitude, phase = demodulator.demodulate(records, INT_DELAY, INT_TIME)
+
+    assert phase.shape == (1, 1, RECORDS, int(INT_TIME*SAMPLE_RATE))
+    # mixing with cos + i sin rotates by the negative phase
+    np.testing.assert_allclose(phase, -np.degrees(offset), atol=0.5)
+    np.testing.assert_allclose(magnitude, 0.2/2, rtol=1e-2)
+
+
+def test_reference_has_zero_phase():
+    drift = np.linspace(0, 1, RECORDS)[np.newaxis]
+    records = np.stack([tone(0.2, drift), tone(0.5, drift)])
+    demodulator = make_demodulator([FREQ, FREQ], channel_index=[0, 1],
+                                   reference_channel=1)
+
+    phase = demodulator.demodulate(records, INT_DELAY, INT_TIME)[1]
+
+    np.testing.assert_allclose(phase, 0, atol=0.5)
+
+
+def test_reference_phasor_is_a_unit_phasor():
+    phases = np.linspace(-3, 3, RECORDS)[np.newaxis]
+    demodulator = make_demodulator(channel_index=[0], reference_channel=1)
+
+    phasor = demodulator.reference_phasor(tone(0.5, phases), INT_DELAY,
+                                          INT_TIME)
+
+    assert phasor.shape == (1, 1, RECORDS, 1)
+    np.testing.assert_allclose(np.abs(phasor), 1)
+    np.testing.assert_allclose(np.angle(phasor[0, 0, :, 0]), -phases[0],
+                               atol=1e-2)
+
+
+def test_reference_requires_stacked_channels():
+    with pytest.raises(RuntimeError):
+        make_demodulator(reference_channel=1)
+
+
+def previous_demodulate(records, int_delay, int_time):
+    # the software reference as implemented before the reference channel:
+    # only the in-phase component is demodulated
+    angle = 2*np.pi*np.outer([FREQ], np.arange(SAMPLES))/SAMPLE_RATE
+    re_mat = records*np.cos(angle[0])
+    re_filtered = filter_win(re_mat, FREQ/10, SAMPLE_RATE, FILTER['numtaps'])
+    beginning = int(int_delay*SAMPLE_RATE)
+    end = beginning + int(int_time*SAMPLE_RATE)
+    complex_mat = re_filtered[..., beginning:end] + 0j
+    return abs(complex_mat), np.angle(complex_mat, deg=True)
+
+
+@pytest.mark.parametrize('stacked', [False, True])
+def test_software_reference_is_unchanged(stacked):
+    rng = np.random.RandomState(1)
+    records = tone(0.2, rng.uniform(-np.pi, np.pi, size=(1, RECORDS)))
+    records += rng.normal(scale=0.01, size=records.shape)
+    if stacked:
+        demodulator = make_demodulator(channel_index=[0])
+        magnitude, phase = demodulator.demodulate(records[np.newaxis],
+                                                  INT_DELAY, INT_TIME)
+    else:
+        demodulator = make_demodulator()
+        magnitude, phase = demodulator.demodulate(records, INT_DELAY,
+                                                  INT_TIME)
+
+    expected_magnitude, expected_phase = previous_demodulate(
+        records, INT_DELAY, INT_TIME)
+    np.testing.assert_array_equal(magnitude[0], expected_magnitude)
+    np.testing.assert_array_equal(phase[0], expected_phase)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from fast_axis import LinearResampler, ramp_voltages, sawtooth_rise_time
+
+
+def block_centre_times(length, npts, sample_rate):
+    # the sample times of Scope_avg for a trace of length samples
+    # averaged down to npts points
+    down_samp = length//npts
+    if down_samp > 1:
+        return (np.arange(npts)*down_samp + (down_samp - 1)/2)/sample_rate
+    return np.arange(length)/sample_rate
+
+
+@pytest.mark.parametrize('length, npts', [(4096, 128), (4096, 4096),
+                                          (4096, 1000)])
+def test_nominal_ramp_has_no_nans(length, npts):
+    sample_rate = 14e6
+    v_start, v_stop = -0.01, 0.02
+    times = block_centre_times(length, npts, sample_rate)
+    # the ramp rises over exactly the scope duration
+    voltages = ramp_voltages(v_start, v_stop, times, length/sample_rate)
+    grid = np.linspace(v_start, v_stop, len(times))
+
+    resampler = LinearResampler(voltages, grid)
+    data = np.random.RandomState(0).randn(3, len(times))
+
+    assert not np.isnan(resampler(data)).any()
+
+
+def test_resampling_is_linear_interpolation():
+    positions = np.array([0.0, 0.1, 0.3, 0.6, 1.0])
+    grid = np.linspace(0, 1, 11)
+    data = np.vstack([positions*2 + 1, positions**2])
+
+    resampled = LinearResampler(positions, grid)(data)
+
+    assert resampled.dtype == np.float32
+    np.testing.assert_allclose(resampled[0], grid*2 + 1, rtol=1e-6)
+    np.testing.assert_allclose(resampled[1],
+                               np.interp(grid, positions, positions**2),
+                               rtol=1e-6)
+
+
+def test_unordered_positions():
+    positions = np.array([0.5, 0.0, 1.0, 0.25])
+    grid = np.array([0.0, 0.375, 0.75, 1.0])
+
+    resampled = LinearResampler(positions, grid)(positions)
+
+    np.testing.assert_allclose(resampled, grid, rtol=1e-6)
+
+
+def test_edges_are_held():
+    positions = np.array([1.0, 2.0, 3.0])
+    grid = np.array([-0.5, 0.5, 1.5, 3.5, 4.5])
+
+    resampled = LinearResampler(positions, grid)(np.array([10, 20, 30]))
+
+    np.testing.assert_array_equal(resampled, [10, 10, 15, 30, 30])
+
+
+def test_wrong_number_of_points():
+    resampler = LinearResampler([0, 1, 2], [0, 1])
+    with pytest.raises(ValueError):
+        resampler(np.zeros(4))
+
+
+def test_sawtooth_rise_time():
+    ramp = {'frequency': 1e3, 'asym': 0.25}
+    assert sawtooth_rise_time(ramp) == pytest.approx(0.75e-3)
@@ -0,0 +1,84 @@
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+
+from offline_demodulation import redemodulate  # noqa: E402
+from raw_data import RawTraceWriter  # noqa: E402
+
+SAMPLE_RATE = 100e6
+SAMPLES = 1024
+FREQ = 10e6
+AMPLITUDES = np.array([0.05, 0.1, 0.2])
+
+
+def make_traces(point):
+    time = np.arange(SAMPLES)/SAMPLE_RATE
+    phase = 0.3*point
+    return time, AMPLITUDES[:, np.newaxis]*np.cos(2*np.pi*FREQ*time + phase)
+
+
+@pytest.fixture
+def raw_file(tmp_path):
+    filename = str(tmp_path/'001_raw.h5')
+    with RawTraceWriter(filename, make_traces(0)[0],
+                        row_setpoints=AMPLITUDES) as writer:
+        for point in range(4):
+            writer.append(point, make_traces(point)[1])
+    return filename
+
+
+def test_redemodulate(raw_file, tmp_path):
+    out_file = str(tmp_path/'001_demod.h5')
+    redemodulate(raw_file, out_file, [FREQ], int_delay=2e-6, processes=1)
+
+    with h5py.File(out_file, 'r') as f:
+        magnitude = f['magnitude'][:]
+        phase = f['phase'][:]
+        np.testing.assert_array_equal(f['points'][:], np.arange(4))
+        np.testing.assert_array_equal(f['row_setpoints'][:], AMPLITUDES)
+        assert f.attrs['sample_rate'] == SAMPLE_RATE
+        assert f.attrs['filter'] == 'win'
+
+    assert magnitude.shape == (4, 1, 3)
+    assert phase.shape == (4, 1, 3)
+    # without a reference channel only the in-phase part is demodulated
+    expected = np.outer(np.abs(np.cos(0.3*np.arange(4))), AMPLITUDES)/2
+    np.testing.assert_allclose(magnitude[:, 0], expected, rtol=1e-2)
+
+
+def test_traces_are_kept_without_integration(raw_file, tmp_path):
+    out_file = str(tmp_path/'001_demod.h5')
+    redemodulate(raw_file, out_file, [FREQ, 2*FREQ], integrate=False,
+                 processes=1)
+
+    with h5py.File(out_file, 'r') as f:
+        assert f['magnitude'].shape == (4, 2, 3, SAMPLES)
+
+
+def test_npy_matches_hdf5(raw_file, tmp_path):
+    npy_file = str(tmp_path/'raw.npy')
+    np.save(npy_file, np.stack([make_traces(point)[1]
+                                for point in range(4)]))
+    from_h5 = str(tmp_path/'h5.h5')
+    from_npy = str(tmp_path/'npy.h5')
+    redemodulate(raw_file, from_h5, [FREQ], processes=1)
+    redemodulate(npy_file, from_npy, [FREQ], processes=1,
+                 sample_rate=SAMPLE_RATE)
+
+    with h5py.File(from_h5, 'r') as f, h5py.File(from_npy, 'r') as g:
+        np.testing.assert_allclose(f['magnitude'][:], g['magnitude'][:],
+                                   rtol=1e-5)
+
+
+def test_invalid_settings(raw_file, tmp_path):
+    out_file = str(tmp_path/'out.h5')
+    with pytest.raises(ValueError):
+        redemodulate(raw_file, out_file, [FREQ], filter='bessel')
+    # the least squares filter of the alazar controller is not implemented
+    with pytest.raises(ValueError):
+        redemodulate(raw_file, out_file, [FREQ], filter='ls')
+    with pytest.raises(ValueError):
+        redemodulate(raw_file, out_file, [FREQ], int_delay=5e-6,
+                     int_time=10e-6)
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from alazar_controllers.acq_helpers import code_to_volt
+from alazar_controllers.online_statistics import OnlineStatistics
+
+RECORDS = 3
+SAMPLES = 64
+CHANNELS = 2
+
+
+def make_buffer(rng, low=0, high=4096):
+    # 12 bit codes, interleaved by channel, in the upper bits of uint16
+    codes = rng.randint(low, high, size=(RECORDS, SAMPLES, CHANNELS))
+    return (codes << 4).astype(np.uint16).ravel(), codes
+
+
+def test_moments_match_numpy():
+    rng = np.random.RandomState(0)
+    stats = OnlineStatistics(RECORDS, CHANNELS, 12)
+    all_codes = []
+    for _ in range(5):
+        data, codes = make_buffer(rng)
+        stats.update(data)
+        all_codes.append(codes)
+    # (channels, records, samples of all buffers)
+    codes = np.moveaxis(np.concatenate(all_codes, axis=1), -1, 0)
+
+    assert stats.buffers == 5
+    assert stats.count == 5*SAMPLES
+    np.testing.assert_allclose(stats.mean_codes, codes.mean(axis=-1))
+    np.testing.assert_allclose(stats.variance_codes,
+                               codes.var(axis=-1, ddof=1))
+    np.testing.assert_allclose(stats.mean_volts,
+                               code_to_volt(codes.mean(axis=-1), 12, 0.4))
+    np.testing.assert_array_equal(stats.min_code,
+                                  codes.reshape(CHANNELS, -1).min(axis=-1))
+    np.testing.assert_array_equal(stats.max_code_seen,
+                                  codes.reshape(CHANNELS, -1).max(axis=-1))
+    assert stats.histogram.sum() == codes.size
+
+
+def test_clipping():
+    stats = OnlineStatistics(RECORDS, CHANNELS, 12)
+    codes = np.full((RECORDS, SAMPLES, CHANNELS), 2048)
+    codes[0, :4, 0] = 0
+    codes[1, :2, 1] = 4095
+    stats.update((codes << 4).astype(np.uint16).ravel())
+
+    np.testing.assert_array_equal(stats.clipped_low, [4, 0])
+    np.testing.assert_array_equal(stats.clipped_high, [0, 2])
+    assert stats.clipped_fraction(1) == pytest.approx(2/(RECORDS*SAMPLES))
+
+
+def test_reset():
+    rng = np.random.RandomState(1)
+    stats = OnlineStatistics(RECORDS, CHANNELS, 12)
+    stats.update(make_buffer(rng)[0])
+    stats.reset()
+
+    assert stats.count == 0
+    assert np.isnan(stats.variance_codes).all()
+    assert not stats.histogram.any()
+
+
+def test_too_many_histogram_bins():
+    with pytest.raises(ValueError):
+        OnlineStatistics(RECORDS, CHANNELS, 8, histogram_bins=512)
+
+
+def test_per_buffer_statistics_match_the_point_averages():
+    # every buffer is one setpoint (e.g. pulse width) whose records are
+    # averaged by the channel, the averages per buffer must equal the mean
+    # over the samples of the record averaged traces
+    rng = np.random.RandomState(2)
+    buffers = 4
+    stats = OnlineStatistics(RECORDS, CHANNELS, 12)
+    all_codes = []
+    for _ in range(buffers):
+        data, codes = make_buffer(rng)
+        stats.update(data)
+        all_codes.append(codes)
+    # (buffers, records, samples, channels)
+    codes = np.stack(all_codes)
+    volts = code_to_volt(codes, 12, 0.4)
+    # the data of channel A as returned by a channel averaging records
+    raw = volts[..., 0].mean(axis=1)
+
+    assert stats.buffer_mean_volts.shape == (CHANNELS, buffers)
+    np.testing.assert_allclose(stats.buffer_mean_volts[0], np.mean(raw, 1))
+    np.testing.assert_allclose(
+        stats.buffer_variance_volts[0],
+        volts[..., 0].reshape(buffers, -1).var(axis=-1, ddof=1))
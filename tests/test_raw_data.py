@@ -0,0 +1,63 @@
+import h5py
+import numpy as np
+import pytest
+
+from raw_data import AsyncRawTraceWriter, RawTraceWriter
+
+SAMPLES = 8
+TIME = np.arange(SAMPLES)/1e6
+
+
+def test_traces_and_index(tmp_path):
+    filename = str(tmp_path/'001_raw.h5')
+    traces = np.arange(3*SAMPLES, dtype=float).reshape(3, SAMPLES)
+    with RawTraceWriter(filename, TIME, row_setpoints=[1e-6, 2e-6, 3e-6],
+                        chunk_rows=2) as writer:
+        writer.append(0, traces)
+        writer.append(1, traces + 1)
+        assert writer.rows == 6
+
+    with h5py.File(filename, 'r') as f:
+        np.testing.assert_array_equal(f['traces'][:3], traces)
+        np.testing.assert_array_equal(f['traces'][3:], traces + 1)
+        np.testing.assert_array_equal(f['index'][:],
+                                      [[0, 0], [0, 1], [0, 2],
+                                       [1, 0], [1, 1], [1, 2]])
+        np.testing.assert_array_equal(f['time'][:], TIME)
+        np.testing.assert_array_equal(f['row_setpoints'][:],
+                                      [1e-6, 2e-6, 3e-6])
+        assert f.attrs['sample_rate'] == pytest.approx(1e6)
+        assert f['traces'].dtype == np.float32
+
+
+def test_wrong_number_of_samples(tmp_path):
+    with RawTraceWriter(str(tmp_path/'raw.h5'), TIME) as writer:
+        with pytest.raises(ValueError):
+            writer.append(0, np.zeros((2, SAMPLES + 1)))
+
+
+def test_async_writer(tmp_path):
+    filename = str(tmp_path/'raw.h5')
+    with AsyncRawTraceWriter(RawTraceWriter(filename, TIME),
+                             maxsize=2) as writer:
+        for point in range(10):
+            writer.append(point, np.full((2, SAMPLES), point))
+        writer.flush()
+        assert writer.writer.rows == 20
+
+    with h5py.File(filename, 'r') as f:
+        np.testing.assert_array_equal(f['traces'][:, 0],
+                                      np.repeat(np.arange(10), 2))
+
+
+def test_async_writer_raises_errors(tmp_path):
+    writer = AsyncRawTraceWriter(RawTraceWriter(str(tmp_path/'raw.h5'),
+                                                TIME))
+    # the bad traces only fail in the writer thread
+    writer.append(0, np.zeros((2, SAMPLES + 1)))
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    with pytest.raises(RuntimeError):
+        writer.append(1, np.zeros((2, SAMPLES)))
+    with pytest.raises(RuntimeError):
+        writer.close()
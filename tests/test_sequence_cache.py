@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+import pytest
+
+from sequence_cache import (SequenceCache, SequencePrefetcher, make_key,
+                            sequence_cache)
+
+
+class FakeSequence:
+    # the parts of a broadbean Sequence the cache uses
+
+    def __init__(self, width, npts=100):
+        self.width = width
+        self.npts = npts
+        self.description = {'1': {'width': width}}
+        self._awgspecs = {'SR': 1e9}
+        self.renders = 0
+
+    def outputForAWGFile(self):
+        self.renders += 1
+        return make_package(self.width, self.npts)
+
+
+def make_package(width, npts):
+    return ([[np.full(npts, width)]], [[np.zeros(npts)]],
+            [[np.zeros(npts)]], [1], [1], [0], [0])
+
+
+def test_make_key_ignores_dict_order():
+    assert (make_key({'a': 1, 'b': np.arange(3)}) ==
+            make_key({'b': np.arange(3), 'a': 1}))
+    assert make_key({'a': np.arange(3)}) != make_key({'a': np.arange(4)})
+
+
+def test_render_is_cached():
+    cache = SequenceCache()
+    seq = FakeSequence(1e-6)
+
+    first = cache.render(seq)
+    second = cache.render(FakeSequence(1e-6))
+
+    assert first is second
+    assert seq.renders == 1
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_memory_is_bounded_in_bytes():
+    npts = 1000
+    size = 3*npts*8
+    cache = SequenceCache(max_bytes=int(2.5*size))
+
+    for width in range(3):
+        cache.put(width, make_package(width, npts))
+
+    assert size*2 <= cache.nbytes <= cache.max_bytes
+    assert 0 not in cache
+    assert 1 in cache and 2 in cache
+
+
+def test_oversized_entries_are_not_kept():
+    cache = SequenceCache(max_bytes=1000)
+    cache.put('big', make_package(0, 1000))
+
+    assert 'big' not in cache
+    assert cache.nbytes == 0
+
+
+def test_contains_does_not_count():
+    cache = SequenceCache()
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    assert 'a' in cache and 'c' not in cache
+    assert cache.hits == 0 and cache.misses == 0
+    # a is still the least recently used
+    cache.max_bytes = cache.nbytes - 1
+    cache.put('b', 2)
+    assert 'a' not in cache and 'b' in cache
+
+
+def test_disk_tier_is_opt_in():
+    assert SequenceCache().directory is None
+    assert sequence_cache.directory is None
+
+
+def test_disk_tier(tmp_path):
+    cache = SequenceCache(directory=str(tmp_path))
+    cache.render(FakeSequence(1e-6))
+    cache.render(FakeSequence(2e-6), persist=False)
+
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    seq = FakeSequence(1e-6)
+    package = SequenceCache(directory=str(tmp_path)).render(seq)
+    assert seq.renders == 0
+    np.testing.assert_array_equal(package[0][0][0], 1e-6)
+
+
+def test_memoize_returns_copies():
+    cache = SequenceCache()
+    calls = []
+
+    @cache.memoize
+    def build(width, npts=10):
+        calls.append(width)
+        return {'width': width, 'data': np.zeros(npts)}
+
+    first = build(1)
+    first['data'][:] = 1
+    second = build(1, npts=10)
+
+    assert calls == [1]
+    assert not second['data'].any()
+
+
+def test_prefetcher_fills_the_memory_tier_only(tmp_path):
+    cache = SequenceCache(directory=str(tmp_path))
+    widths = [1e-6, 2e-6, 3e-6]
+    with SequencePrefetcher(FakeSequence, widths, max_ahead=2, processes=1,
+                            cache=cache) as prefetcher:
+        for width in widths:
+            seq = FakeSequence(width)
+            package = prefetcher.render(seq)
+            assert seq.renders == 0
+            np.testing.assert_array_equal(package[0][0][0], width)
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+class FakeArraySequence(FakeSequence):
+    # a sequence of an array element, described as just 'array'
+
+    def __init__(self, waveform):
+        super().__init__(1e-6, npts=len(waveform))
+        self.waveform = np.asarray(waveform, dtype=float)
+        self.description = {'1': {'channels': {'1': 'array'}}}
+
+    def outputForAWGFile(self):
+        self.renders += 1
+        return ([[self.waveform.copy()]],) + make_package(0, self.npts)[1:]
+
+
+def test_array_sequences_with_different_data_do_not_collide():
+    cache = SequenceCache()
+    first = cache.render(FakeArraySequence([0, 1, 2, 3]))
+    second = cache.render(FakeArraySequence([0, 1, 2, 4]))
+
+    np.testing.assert_array_equal(first[0][0][0], [0, 1, 2, 3])
+    np.testing.assert_array_equal(second[0][0][0], [0, 1, 2, 4])
+    assert cache.hits == 0
+
+
+def test_awg_settings_are_part_of_the_key():
+    seq = FakeSequence(1e-6)
+    other = FakeSequence(1e-6)
+    other._awgspecs = {'SR': 1.2e9}
+
+    assert SequenceCache.render_key(seq) == SequenceCache.render_key(
+        FakeSequence(1e-6))
+    assert SequenceCache.render_key(seq) != SequenceCache.render_key(other)
+
+
+def test_unpicklable_sequences_are_not_cached():
+    cache = SequenceCache()
+    seq = FakeSequence(1e-6)
+    seq.shape = lambda t: t
+
+    cache.render(seq)
+    cache.render(seq)
+    assert seq.renders == 2
+    assert cache.nbytes == 0
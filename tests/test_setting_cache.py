@@ -0,0 +1,136 @@
+import pytest
+
+import setting_cache
+from setting_cache import cached_settings, config_once
+
+
+class FakeParameter:
+
+    def __init__(self, name, has_set=True):
+        self.name = name
+        self.full_name = name
+        self.has_set = has_set
+        self.writes = []
+        self._latest = None
+        self.fail = False
+
+    def set(self, value):
+        if self.fail:
+            raise RuntimeError('Write failed')
+        self.writes.append(value)
+        self._latest = value
+
+    def get(self):
+        return self._latest
+
+    def get_latest(self):
+        return self._latest
+
+
+class FakeInstrument:
+
+    def __init__(self, name='inst', submodules=None):
+        self.name = name
+        self.parameters = {'level': FakeParameter('level'),
+                           'idn': FakeParameter('idn', has_set=False)}
+        self.submodules = submodules or {}
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+    def __getattr__(self, name):
+        for attr in ('parameters', 'submodules'):
+            if name in self.__dict__.get(attr, {}):
+                return self.__dict__[attr][name]
+        raise AttributeError(name)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    setting_cache.invalidate()
+    yield
+    setting_cache.invalidate()
+
+
+def test_repeated_set_is_skipped():
+    inst = FakeInstrument()
+    cached_settings(inst).level(1)
+    cached_settings(inst).level(1)
+    cached_settings(inst).level(2)
+
+    assert inst.level.writes == [1, 2]
+
+
+def test_set_is_repeated_if_changed_behind_the_cache():
+    inst = FakeInstrument()
+    proxy = cached_settings(inst)
+    proxy.level(1)
+    inst.level.set(2)
+    proxy.level(1)
+
+    assert inst.level.writes == [1, 2, 1]
+
+
+def test_failed_set_is_repeated():
+    inst = FakeInstrument()
+    proxy = cached_settings(inst)
+    proxy.level(1)
+    inst.level.fail = True
+    with pytest.raises(RuntimeError):
+        proxy.level(2)
+    inst.level.fail = False
+    # the parameter still holds 2 according to get_latest of a driver that
+    # records the value before writing it
+    inst.level._latest = 2
+    proxy.level(2)
+
+    assert inst.level.writes == [1, 2]
+
+
+def test_reset_invalidates():
+    channel = FakeInstrument('ch1')
+    inst = FakeInstrument(submodules={'ch1': channel})
+    proxy = cached_settings(inst)
+    proxy.level(1)
+    proxy.ch1.level(1)
+    proxy.reset()
+    proxy.level(1)
+    proxy.ch1.level(1)
+
+    assert inst.resets == 1
+    assert inst.level.writes == [1, 1]
+    assert channel.level.writes == [1, 1]
+
+
+def test_gettable_parameters_are_not_wrapped():
+    inst = FakeInstrument()
+    proxy = cached_settings(inst)
+
+    assert proxy.idn is inst.idn
+    assert cached_settings(proxy) is proxy
+    assert proxy.instrument is inst
+
+
+class FakeAlazar(FakeInstrument):
+
+    def __init__(self):
+        super().__init__('alazar')
+        self.configs = []
+
+    def config(self, **settings):
+        self.configs.append(settings)
+        for name, value in settings.items():
+            if name in self.parameters:
+                self.parameters[name].set(value)
+
+
+def test_config_once():
+    alazar = FakeAlazar()
+
+    assert config_once(alazar, level=1, clock_source='INTERNAL')
+    assert not config_once(alazar, level=1, clock_source='INTERNAL')
+    alazar.level.set(2)
+    assert config_once(alazar, level=1, clock_source='INTERNAL')
+    assert config_once(alazar, level=1, clock_source='EXTERNAL')
+    assert len(alazar.configs) == 3
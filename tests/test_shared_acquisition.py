@@ -0,0 +1,73 @@
+import pytest
+
+from shared_acquisition import SharedAcquisition
+
+
+class Counter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return self.count
+
+
+def test_acquires_on_every_get_outside_sharing():
+    acquisition = SharedAcquisition(Counter())
+    assert [acquisition.get() for _ in range(3)] == [1, 2, 3]
+
+
+def test_one_acquisition_per_point():
+    acquisition = SharedAcquisition(Counter())
+    with acquisition.sharing():
+        acquisition.next_point()
+        assert acquisition.get() == acquisition.get() == 1
+        acquisition.next_point()
+        assert acquisition.get() == 2
+
+
+def test_unequal_consumers():
+    # different parameters are measured at different points, none of them
+    # asks twice at a point, yet every point must get a fresh acquisition
+    acquisition = SharedAcquisition(Counter())
+    consumers = [['ch1'], ['ch2'], ['ch1', 'ch2'], ['ch2']]
+    measured = []
+    with acquisition.sharing():
+        for names in consumers:
+            acquisition.next_point()
+            measured.append({name: acquisition.get() for name in names})
+
+    assert measured == [{'ch1': 1}, {'ch2': 2}, {'ch1': 3, 'ch2': 3},
+                        {'ch2': 4}]
+
+
+def test_repeated_gets_at_one_point_are_not_fresh():
+    acquisition = SharedAcquisition(Counter())
+    with acquisition.sharing():
+        acquisition.next_point()
+        assert [acquisition.get() for _ in range(3)] == [1, 1, 1]
+
+
+def test_invalidate():
+    acquisition = SharedAcquisition(Counter())
+    with acquisition.sharing():
+        acquisition.next_point()
+        acquisition.get()
+        acquisition.invalidate()
+        assert acquisition.get() == 2
+
+
+def test_sharing_ends_with_the_context():
+    acquisition = SharedAcquisition(Counter())
+    with acquisition.sharing():
+        acquisition.next_point()
+        acquisition.get()
+        # nested use joins the outer sharing
+        with acquisition.sharing():
+            assert acquisition.get() == 1
+        assert acquisition.shared
+    assert not acquisition.shared
+    assert acquisition.get() == 2
+    with pytest.raises(RuntimeError):
+        acquisition.next_point()
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from timing_planner import (ALAZAR_SAMPLES_DIVISOR, ZI_SAMPLE_RATES,
+                            align_to_awg, plan_timing)
+
+
+def test_given_alazar_rate_is_kept():
+    plan = plan_timing(1e-6, 16e-6, trig_delay=1e-6, dead_time=5e-6,
+                       alazar_sample_rate=10e6)
+
+    assert plan['alazar_sample_rate'] == 10e6
+    assert plan['samples_per_record'] % ALAZAR_SAMPLES_DIVISOR == 0
+    assert plan['int_time'] >= 16e-6
+    assert plan['int_time'] == plan['samples_per_record']/10e6
+
+
+def test_rate_change_only_when_allowed():
+    # 16 us at 10 MS/s are 160 samples, rounded up to 256
+    plan = plan_timing(1e-6, 16e-6, alazar_sample_rate=10e6,
+                       allow_rate_change=True)
+
+    assert plan['alazar_sample_rate'] != 10e6
+    assert plan['int_time'] == pytest.approx(16e-6, rel=0.01)
+
+
+def test_max_samples_bounds_the_record():
+    plan = plan_timing(1e-6, 16e-6, allow_rate_change=True,
+                       alazar_sample_rate=1e9, max_samples=1024)
+
+    assert plan['samples_per_record'] <= 1024
+    assert plan['int_time'] >= 16e-6
+
+    with pytest.raises(ValueError):
+        plan_timing(1e-6, 16e-6, alazar_sample_rate=1e9, max_samples=1024)
+
+
+def test_lowest_rate_without_preference():
+    # the lowest rate realising 16 us within the tolerance
+    plan = plan_timing(1e-6, 16e-6)
+
+    assert plan['alazar_sample_rate'] == 200e6
+    assert plan['samples_per_record'] == 3200
+
+
+def test_cycle_is_aligned_to_the_awg():
+    SR = 1.2e9
+    hightimes = np.array([0.1e-6, 1.05e-6, 2e-6])
+    plan = plan_timing(hightimes, 16e-6, trig_delay=1e-6, dead_time=5e-6,
+                       awg_SR=SR, awg_granularity=4,
+                       alazar_sample_rate=500e6)
+
+    samples = plan['cycletime']*SR
+    assert samples == pytest.approx(round(samples))
+    assert round(samples) % 4 == 0
+    np.testing.assert_allclose(plan['hightime']*SR,
+                               np.round(hightimes*SR))
+    assert (plan['cycletime'] >= plan['hightime'].max() +
+            plan['trig_delay'] + plan['meastime'] + 5e-6 - 1/SR)
+    assert plan['idle_time'] >= 5e-6 - 1/SR
+
+
+def test_zi_fixed_npts():
+    plan = plan_timing(1e-6, 100e-6, detector='zi', zi_npts=4096)
+
+    assert plan['zi_npts'] == 4096
+    assert plan['zi_sample_rate'] in ZI_SAMPLE_RATES
+    # 4096 points at 56.2 MHz are the closest to 100 us
+    assert plan['zi_sample_rate_string'] == '56.2 MHz'
+
+
+def test_zi_too_few_points():
+    with pytest.raises(ValueError):
+        plan_timing(1e-6, 16e-6, detector='zi', zi_npts=1024)
+
+
+def test_unknown_detector():
+    with pytest.raises(ValueError):
+        plan_timing(1e-6, 16e-6, detector='scope')
+
+
+def test_align_to_awg():
+    np.testing.assert_allclose(align_to_awg([1.0004e-6, 2.0026e-6], 1e9, 4),
+                               [1.0e-6, 2.0e-6 + 4e-9])
+
+
+@pytest.mark.parametrize('meastime', np.logspace(-6, -1, 40))
+def test_zi_plan_is_the_closest_realisable_time(meastime):
+    # the choice correctMeasTime made before planning with plan_timing
+    realtimes = np.array([4096/rate for rate in ZI_SAMPLE_RATES])
+    closest = np.abs(meastime - realtimes).argmin()
+
+    plan = plan_timing(0, meastime, detector='zi', zi_npts=4096)
+
+    assert plan['zi_sample_rate'] == ZI_SAMPLE_RATES[closest]
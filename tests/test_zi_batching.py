@@ -0,0 +1,141 @@
+import pytest
+
+import setting_cache
+from setting_cache import cached_settings
+from zi_batching import BatchedDAQ
+
+
+class FakeDAQ:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sets = []
+        self.syncs = 0
+        self.calls = []
+
+    def setDouble(self, path, value):
+        self.sets.append([(path, value)])
+
+    def set(self, items):
+        if self.fail:
+            raise RuntimeError('Connection lost')
+        self.sets.append(list(items))
+
+    def sync(self):
+        self.syncs += 1
+
+    def getDouble(self, path):
+        return dict(item for items in self.sets for item in items)[path]
+
+    def setVector(self, path, vector):
+        self.calls.append(('setVector', len(self.sets)))
+
+    def dataAcquisitionModule(self):
+        self.calls.append(('dataAcquisitionModule', len(self.sets)))
+
+    def listNodes(self, path, flags=0):
+        self.calls.append(('listNodes', len(self.sets)))
+        return []
+
+
+class FakeParameter:
+
+    has_set = True
+
+    def __init__(self, instrument, name, path):
+        self.instrument = instrument
+        self.name = name
+        self.full_name = name
+        self.path = path
+        self._latest = None
+
+    def set(self, value):
+        self.instrument.daq.setDouble(self.path, value)
+        self._latest = value
+
+    def get_latest(self):
+        return self._latest
+
+
+class FakeZI:
+
+    def __init__(self, daq):
+        self.daq = daq
+        self.parameters = {'level': FakeParameter(self, 'level',
+                                                  '/dev/scopes/0/level')}
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['parameters'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def test_writes_are_sent_as_one_batch():
+    daq = FakeDAQ()
+    batched = BatchedDAQ(daq)
+    batched.setInt('/dev/a', 1.0)
+    batched.setDouble('/dev/b', 2)
+    batched.sync()
+    assert daq.sets == []
+
+    batched.flush()
+    assert daq.sets == [[('/dev/a', 1), ('/dev/b', 2.0)]]
+    assert daq.syncs == 1
+
+
+def test_reads_flush_first():
+    daq = FakeDAQ()
+    batched = BatchedDAQ(daq)
+    batched.setDouble('/dev/b', 2)
+    assert batched.getDouble('/dev/b') == 2.0
+
+
+def test_other_calls_keep_their_order():
+    daq = FakeDAQ()
+    batched = BatchedDAQ(daq)
+    batched.setDouble('/dev/b', 2)
+    batched.set([('/dev/c', 3)])
+    assert daq.sets == [[('/dev/b', 2.0)], [('/dev/c', 3)]]
+
+    batched.setDouble('/dev/d', 4)
+    batched.setVector('/dev/awgs/0/waveform/waves/0', [0, 1])
+    batched.setDouble('/dev/e', 5)
+    batched.dataAcquisitionModule()
+    # the calls see every write made before them
+    assert daq.calls == [('setVector', 3), ('dataAcquisitionModule', 4)]
+
+
+def test_node_independent_calls_do_not_flush():
+    daq = FakeDAQ()
+    batched = BatchedDAQ(daq)
+    batched.setDouble('/dev/b', 2)
+    batched.listNodes('/dev')
+    assert daq.sets == []
+    assert batched.syncs == 0
+
+
+def test_failed_flush_calls_on_failure():
+    failures = []
+    batched = BatchedDAQ(FakeDAQ(fail=True),
+                         on_failure=lambda: failures.append(True))
+    batched.setDouble('/dev/b', 2)
+    with pytest.raises(RuntimeError):
+        batched.flush()
+    assert failures == [True]
+
+
+def test_failed_flush_is_not_cached_as_written():
+    daq = FakeDAQ(fail=True)
+    zi = FakeZI(daq)
+    proxy = cached_settings(zi)
+
+    zi.daq = BatchedDAQ(daq, on_failure=lambda: setting_cache.invalidate(zi))
+    proxy.level(0.5)
+    with pytest.raises(RuntimeError):
+        zi.daq.flush()
+
+    daq.fail = False
+    zi.daq = daq
+    proxy.level(0.5)
+    assert daq.sets == [[('/dev/scopes/0/level', 0.5)]]
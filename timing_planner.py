@@ -0,0 +1,203 @@
+# Module containing a joint planner of the pulse timing across the AWG
+# and the digitizer (Alazar or ZI UHF-LI scope) sample clocks
+import logging
+import math
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# The internal clock sample rates of the ATS9360 (Sa/s)
+ALAZAR_SAMPLE_RATES = [1_000, 2_000, 5_000, 10_000, 20_000, 50_000,
+                       100_000, 200_000, 500_000, 1_000_000, 2_000_000,
+                       5_000_000, 10_000_000, 20_000_000, 50_000_000,
+                       100_000_000, 200_000_000, 500_000_000, 800_000_000,
+                       1_000_000_000, 1_200_000_000, 1_500_000_000,
+                       1_800_000_000]
+ALAZAR_SAMPLES_DIVISOR = 128
+ALAZAR_MIN_SAMPLES = 256
+
+# The scope sample rates of the ZI UHF-LI and the strings to set them by
+ZI_SAMPLE_RATES = [1.8e9/2**n for n in range(17)]
+ZI_SAMPLE_RATE_STRINGS = ['1.80 GHz', '900 MHz', '450 MHz', '225 MHz',
+                          '113 MHz', '56.2 MHz', '28.1 MHz', '14.0 MHz',
+                          '7.03 MHz', '3.50 MHz', '1.75 MHz', '880 kHz',
+                          '440 kHz', '220 kHz', '110 kHz', '54.9 kHz',
+                          '27.5 kHz']
+ZI_MIN_NPTS = 4096
+ZI_NPTS_DIVISOR = 16
+
+
+def _ceil_to(value, step):
+    """
+    Smallest multiple of step not below value, forgiving floating point
+    noise of a part in 1e9
+    """
+    return math.ceil(value/step - 1e-9)*step
+
+
+def align_to_awg(times, SR, granularity=1):
+    """
+    Round times (s) to the nearest multiple of granularity AWG samples
+    """
+    step = granularity/SR
+    return np.round(np.asarray(times)/step)*step
+
+
+def _alazar_windows(meastime, rates, samples_divisor, min_samples,
+                    max_samples=None):
+    """
+    The measurement windows the Alazar can realise at each rate as
+    (window, rate, samples_per_record), leaving out records longer than
+    max_samples
+    """
+    for rate in rates:
+        samples = max(_ceil_to(meastime*rate, samples_divisor), min_samples)
+        if max_samples is not None and samples > max_samples:
+            continue
+        yield samples/rate, rate, int(samples)
+
+
+def _zi_windows(meastime, npts, max_samples=None):
+    """
+    The measurement windows the ZI scope can realise at each rate as
+    (window, rate, npts), leaving out shots longer than max_samples. With
+    npts fixed, windows shorter than meastime are allowed as well, like
+    correctMeasTime does.
+    """
+    for rate in ZI_SAMPLE_RATES:
+        if npts is None:
+            points = max(_ceil_to(meastime*rate, ZI_NPTS_DIVISOR),
+                         ZI_MIN_NPTS)
+        else:
+            points = npts
+        if max_samples is not None and points > max_samples:
+            continue
+        yield points/rate, rate, int(points)
+
+
+def plan_timing(hightime, meastime, trig_delay=0, dead_time=0,
+                detector='alazar', awg_SR=1e9, awg_granularity=1,
+                awg_min_length=250, alazar_rates=None,
+                alazar_sample_rate=None, allow_rate_change=False,
+                max_samples=None, zi_npts=4096, tolerance=0.01):
+    """
+    Choose the digitizer sample rate and record length together with the
+    AWG aligned pulse timing such that the dead time of each pulse-measure
+    cycle is minimal.
+
+    The measurement window of the digitizer is quantised (the Alazar
+    records a multiple of 128 samples at a fixed set of rates, the ZI scope
+    a number of points at 1.8 GHz/2**n), so instead of fixing the rate and
+    rounding up the window, the rates are tried and the one realising the
+    window closest to (and for the Alazar not below) meastime wins.
+    Windows within tolerance of meastime count as equally good, of those
+    the rate closest to alazar_sample_rate (or the lowest rate, i.e. the
+    least data) wins. All durations are then aligned to the AWG sample
+    clock.
+
+    A given alazar_sample_rate is kept unless allow_rate_change is True,
+    as the rate sets the bandwidth and the data volume of the measurement.
+    Only the record length is then planned.
+
+    Args:
+        hightime (float or array): The pulse width(s) (s). The cycle time
+            is set by the longest.
+        meastime (float): The desired measurement time (s)
+        trig_delay (float): The delay between the end of the pulse and
+            the measurement (s)
+        dead_time (float): Extra wait at the end of each cycle, e.g. to
+            let the sample relax or the digitizer rearm (s)
+        detector (str): 'alazar' or 'zi'
+        awg_SR (float): The AWG sample rate (Sa/s)
+        awg_granularity (int): The AWG waveform length granularity (samples)
+        awg_min_length (int): The minimal AWG waveform length (samples)
+        alazar_rates (Optional[list]): The Alazar rates to choose from.
+            Default is all internal clock rates. Restrict this to fulfil
+            e.g. a Nyquist condition for software demodulation.
+        alazar_sample_rate (Optional[float]): The Alazar rate to use, or
+            to prefer if allow_rate_change is True
+        allow_rate_change (bool): Whether a rate other than
+            alazar_sample_rate may be chosen
+        max_samples (Optional[int]): The maximal number of samples per
+            record (Alazar) or scope points (ZI), bounding the data volume
+        zi_npts (Optional[int]): Fixed number of scope points. If None the
+            number of points is chosen as well, bounded by max_samples.
+        tolerance (float): Relative deviation from meastime considered
+            negligible
+
+    Returns:
+        dict with the aligned hightime, trig_delay, meastime, dead_time and
+        cycletime (s), idle_time, the time per cycle not spent on the
+        pulse, the delay and the desired measurement (s), and either
+        alazar_sample_rate, samples_per_record and int_time or
+        zi_sample_rate, zi_sample_rate_string and zi_npts.
+    """
+    if detector == 'alazar':
+        rates = ALAZAR_SAMPLE_RATES if alazar_rates is None else alazar_rates
+        if alazar_sample_rate is not None and not allow_rate_change:
+            rates = [alazar_sample_rate]
+        windows = list(_alazar_windows(meastime, rates,
+                                       ALAZAR_SAMPLES_DIVISOR,
+                                       ALAZAR_MIN_SAMPLES, max_samples))
+        preferred = alazar_sample_rate or min(rates)
+    elif detector == 'zi':
+        if zi_npts is not None and zi_npts < ZI_MIN_NPTS:
+            raise ValueError('The ZI scope needs at least {} '
+                             'points.'.format(ZI_MIN_NPTS))
+        windows = list(_zi_windows(meastime, zi_npts, max_samples))
+        preferred = min(ZI_SAMPLE_RATES)
+    else:
+        raise ValueError('Unknown detector {}, must be alazar or '
+                         'zi'.format(detector))
+    if not windows:
+        raise ValueError('No sample rate realises a measurement time of {} s '
+                         'within {} samples.'.format(meastime, max_samples))
+
+    def awg_samples(duration):
+        return int(_ceil_to(duration*awg_SR, 1))
+
+    def cost(window):
+        realised, rate, _ = window
+        # the AWG holds the measurement level for the full window
+        deviation = abs(awg_samples(realised) - meastime*awg_SR)
+        return (max(deviation - tolerance*meastime*awg_SR, 0),
+                abs(math.log(rate/preferred)))
+
+    realised, rate, points = min(windows, key=cost)
+
+    # do the bookkeeping in AWG samples to avoid rounding noise
+    high_samples = np.round(np.asarray(hightime)*awg_SR).astype(int)
+    max_high_samples = int(high_samples.max())
+    delay_samples = int(round(trig_delay*awg_SR))
+    meas_samples = awg_samples(realised)
+    dead_samples = awg_samples(dead_time)
+    cycle_samples = int(_ceil_to(max_high_samples + delay_samples +
+                                 meas_samples + dead_samples,
+                                 awg_granularity))
+    cycle_samples = max(cycle_samples,
+                        int(_ceil_to(awg_min_length, awg_granularity)))
+
+    if np.ndim(hightime):
+        aligned_hightime = high_samples/awg_SR
+    else:
+        aligned_hightime = int(high_samples)/awg_SR
+    plan = {'hightime': aligned_hightime,
+            'trig_delay': delay_samples/awg_SR,
+            'meastime': meas_samples/awg_SR,
+            'dead_time': (cycle_samples - max_high_samples -
+                          delay_samples - meas_samples)/awg_SR,
+            'cycletime': cycle_samples/awg_SR,
+            'idle_time': (cycle_samples - max_high_samples -
+                          delay_samples)/awg_SR - meastime}
+    if detector == 'alazar':
+        plan.update({'alazar_sample_rate': rate,
+                     'samples_per_record': points,
+                     'int_time': realised})
+    else:
+        plan.update({'zi_sample_rate': rate,
+                     'zi_sample_rate_string':
+                         ZI_SAMPLE_RATE_STRINGS[ZI_SAMPLE_RATES.index(rate)],
+                     'zi_npts': points})
+    log.info('Planned timing: {}'.format(plan))
+    return plan
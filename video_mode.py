@@ -0,0 +1,470 @@
+# Module containing a live "video mode" acquisition of charge diagrams
+import logging
+import math
+import time
+from collections import deque
+
+import numpy as np
+import matplotlib.pyplot as plt
+import qcodes as qc
+
+from fast_diagrams import prepare_fast_charge_diagram, keysight_output_off
+from fast_axis import LinearResampler, ramp_voltages, sawtooth_rise_time
+from zi_daq_module import DAQModuleGrid
+
+log = logging.getLogger(__name__)
+
+
+class FrameBuffer:
+    """
+    Ring buffer holding the last frames of a video mode acquisition in one
+    preallocated array, so that no memory is allocated per frame.
+
+    Args:
+        size (int): The number of frames to keep
+        shape (tuple): The shape of a frame
+        dtype (str): The data type of the frames
+    """
+
+    def __init__(self, size, shape, dtype='float32'):
+        self.size = size
+        self.frames = np.full((size,) + tuple(shape), np.nan, dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, frame):
+        self.frames[self.count % self.size] = frame
+        self.count += 1
+
+    @property
+    def latest(self):
+        """
+        The last frame added
+        """
+        if self.count == 0:
+            raise ValueError('No frames acquired yet.')
+        return self.frames[(self.count - 1) % self.size]
+
+    def ordered(self):
+        """
+        The frames in the buffer from the oldest to the newest
+        """
+        indices = np.arange(self.count - len(self), self.count) % self.size
+        return self.frames[indices]
+
+    def mean(self, n=None):
+        """
+        The average of the last n frames (default all frames in the buffer)
+        """
+        n = len(self) if n is None else min(n, len(self))
+        if n == 0:
+            raise ValueError('No frames acquired yet.')
+        indices = np.arange(self.count - n, self.count) % self.size
+        return self.frames[indices].mean(axis=0)
+
+
+class QDacSlowAxis:
+    """
+    Slow axis of the video mode stepped by a QDac channel. Every row is
+    one segmented scope shot of the fast sawtooth, averaged as set up by
+    prepare_fast_charge_diagram. The steps are done without a qcodes Loop,
+    so no dataset is created per frame.
+
+    Args:
+        channel (Parameter): The QDac channel voltage parameter
+        start (float): The first voltage of a frame (V)
+        stop (float): The last voltage of a frame (V)
+        npoints (int): The number of rows per frame
+        delay (float): The time to wait after each step (s)
+    """
+
+    def __init__(self, channel, start, stop, npoints, delay=0):
+        self.channel = channel
+        self.npoints = npoints
+        self.delay = delay
+        self.setpoints = np.linspace(start, stop, npoints)
+        self.label = channel.label
+
+    def prepare(self, video):
+        pass
+
+    def acquire_frame(self, video):
+        frame = np.empty(video.frame_shape, dtype=np.float32)
+        # all signals share one scope acquisition per row
+        with video.zi.shared_scope_acquisition() as next_row:
+            for row, voltage in enumerate(self.setpoints):
+                self.channel.set(voltage)
+                if self.delay:
+                    time.sleep(self.delay)
+                next_row()
+                for ii, avger in enumerate(video.scope_avger):
+                    frame[ii, row] = avger.get()
+        return frame
+
+    def finish(self, video):
+        pass
+
+
+class SawtoothSlowAxis:
+    """
+    Slow axis of the video mode driven by a sawtooth completing one period
+    per npoints periods of the fast sawtooth, such that a full frame is
+    swept in hardware.
+
+    A frame is recorded as a single long scope trace triggered by the sync
+    of the slow generator and cut into rows at the period of the fast
+    sawtooth. The slow generator must therefore be phase locked to the fast
+    one, e.g. the other channel of the same Keysight (synced with
+    sync_phase) or a generator sharing its reference clock and started by
+    the same trigger. The trace is limited by the maximal scope length, so
+    keep the frames small or the sample rate low.
+
+    Args:
+        keysight (Keysight_33500B): The generator of the slow sawtooth
+        channel (int): The generator channel, 1 or 2
+        start (float): The first voltage of a frame (V)
+        stop (float): The last voltage of a frame (V)
+        npoints (int): The number of rows per frame
+        frame_trig_signal (str): The ZI trigger input connected to the sync
+            of the slow generator
+        averages (int): The number of frames averaged per scope shot
+        voltage_multiplier (float): The factor between the voltage on the
+            device and the generator voltage, see fast_charge_diagram
+        row_offset (float): Extra delay of the rising fast ramp after the
+            start of its period (s)
+    """
+
+    def __init__(self, keysight, channel, start, stop, npoints,
+                 frame_trig_signal='Trig Input 2', averages=1,
+                 voltage_multiplier=1, row_offset=0):
+        if channel not in [1, 2]:
+            raise ValueError('Channel must be 1 or 2')
+        self.keysight = keysight
+        self.channel = channel
+        self.start = start
+        self.stop = stop
+        self.npoints = npoints
+        self.frame_trig_signal = frame_trig_signal
+        self.averages = averages
+        self.voltage_multiplier = voltage_multiplier
+        self.row_offset = row_offset
+        self.setpoints = np.linspace(start, stop, npoints)
+        self.label = '{} ch{}'.format(keysight.name, channel)
+        self._indices = None
+        self.column_times = None
+
+    def _set(self, name, value):
+        self.keysight.parameters['ch{}_{}'.format(self.channel, name)](value)
+
+    def _start_ramp(self, video):
+        """
+        Start the slow sawtooth, one period per npoints fast periods
+        """
+        frame_period = self.npoints/video.ramp['frequency']
+        v_start = self.voltage_multiplier*self.start
+        v_stop = self.voltage_multiplier*self.stop
+        amplitude = abs(v_stop - v_start)
+        self._set('function_type', 'RAMP')
+        self._set('ramp_symmetry', 100 if v_stop >= v_start else 0)
+        self._set('amplitude_unit', 'VPP')
+        self._set('amplitude', amplitude)
+        self._set('offset', (v_start + v_stop)/2)
+        self._set('frequency', 1/frame_period)
+        self._set('output', 'ON')
+        if self.keysight is video.keysight:
+            self.keysight.sync_phase()
+
+    def prepare(self, video):
+        zi = video.zi
+        ramp = video.ramp
+        fast_period = 1/ramp['frequency']
+        frame_period = self.npoints*fast_period
+        # the measured window of each row, before the scope is reconfigured
+        row_duration = ramp['scope_duration']
+        row_delay = ramp['zi_trig_delay'] + self.row_offset
+        self._start_ramp(video)
+
+        sample_rate = zi.scope_length()/row_duration
+        trace_length = 16*math.ceil(frame_period*sample_rate/16)
+        with zi.batched_settings():
+            zi.scope_trig_signal(self.frame_trig_signal)
+            zi.scope_length(trace_length)
+            zi.scope_segments_count(self.averages)
+            zi.scope_segments('ON' if self.averages > 1 else 'OFF')
+        zi.Scope.prepare_scope()
+        zi.invalidate_scope_cache()
+
+        # precompute the samples of each column of each row
+        npts = video.frame_shape[-1]
+        row_samples = int(row_duration*sample_rate)
+        block = row_samples//npts
+        if block < 1:
+            raise ValueError('Fewer samples per row than points on the fast '
+                             'axis, lower npts or raise the sample rate.')
+        starts = np.round((np.arange(self.npoints)*fast_period + row_delay) *
+                          sample_rate).astype(int)
+        if starts[-1] + npts*block > trace_length:
+            raise ValueError('The rows do not fit into the scope trace.')
+        self._indices = starts[:, np.newaxis] + np.arange(npts*block)
+        self._block = block
+        # the centres of the averaged blocks after the start of the ramp
+        self.column_times = (ramp['zi_trig_delay'] +
+                             (np.arange(npts)*block + (block - 1)/2)/sample_rate)
+
+    def acquire_frame(self, video):
+        data = video.zi.Scope.get()
+        frame = np.empty(video.frame_shape, dtype=np.float32)
+        for ii in range(len(video.scope_avger)):
+            trace = np.atleast_2d(data[ii]).mean(axis=0, dtype=np.float32)
+            rows = trace[self._indices]
+            frame[ii] = rows.reshape(self.npoints, -1, self._block).mean(axis=-1)
+        return frame
+
+    def finish(self, video):
+        self._set('output', 'OFF')
+
+
+class GridSawtoothSlowAxis(SawtoothSlowAxis):
+    """
+    Slow sawtooth axis (see SawtoothSlowAxis) acquired with the DAQ module
+    of the lock-in instead of the scope. Each fast ramp triggers one row of
+    demodulator samples and the data server assembles the frame, which is
+    read as one array.
+
+    The grid starts at an arbitrary row of the slow sawtooth, so the slow
+    ramp (or its monitor output) must be connected to an auxiliary input
+    of the lock-in, given by monitor. The rows are rotated such that the
+    frame starts after the jump of the ramp.
+
+    Args:
+        keysight (Keysight_33500B): The generator of the slow sawtooth
+        channel (int): The generator channel, 1 or 2
+        start (float): The first voltage of a frame (V)
+        stop (float): The last voltage of a frame (V)
+        npoints (int): The number of rows per frame
+        signals (list): The demodulator signals to show, relative to the
+            device, e.g. ['demods/0/sample.r']
+        monitor (str): The signal recording the slow ramp
+        trigger_node (str): The trigger of the rows, i.e. the sync of the
+            fast sawtooth
+        voltage_multiplier (float): The factor between the voltage on the
+            device and the generator voltage, see fast_charge_diagram
+        row_offset (float): Extra delay of the rising fast ramp after the
+            start of its period (s)
+        timeout (float): The maximal time to wait for a frame (s)
+    """
+
+    def __init__(self, keysight, channel, start, stop, npoints,
+                 signals=('demods/0/sample.r',),
+                 monitor='demods/0/sample.auxin0',
+                 trigger_node='demods/0/sample.TrigIn1',
+                 voltage_multiplier=1, row_offset=0, timeout=10):
+        super().__init__(keysight, channel, start, stop, npoints,
+                         voltage_multiplier=voltage_multiplier,
+                         row_offset=row_offset)
+        self.signals = list(signals)
+        self.monitor = monitor
+        self.trigger_node = trigger_node
+        self.timeout = timeout
+        self._grid = None
+
+    @property
+    def signal_labels(self):
+        return self.signals
+
+    def prepare(self, video):
+        ramp = video.ramp
+        self._start_ramp(video)
+        if self._grid is not None:
+            self._grid.close()
+        self._grid = DAQModuleGrid(video.zi, self.signals + [self.monitor],
+                                   rows=self.npoints,
+                                   cols=video.frame_shape[-1],
+                                   duration=ramp['scope_duration'],
+                                   trigger_node=self.trigger_node,
+                                   delay=ramp['zi_trig_delay'] + self.row_offset,
+                                   timeout=self.timeout)
+        self._grid.prepare()
+        cols = video.frame_shape[-1]
+        self.column_times = (ramp['zi_trig_delay'] +
+                             np.arange(cols)*ramp['scope_duration']/cols)
+
+    def acquire_frame(self, video):
+        grids = self._grid.acquire()
+        # the frame starts after the largest jump of the slow ramp
+        monitor = grids[-1].mean(axis=-1)
+        jumps = np.abs(np.diff(np.append(monitor, monitor[0])))
+        first_row = (int(np.argmax(jumps)) + 1) % self.npoints
+        return np.roll(grids[:-1], -first_row, axis=1)
+
+    def finish(self, video):
+        super().finish(video)
+        if self._grid is not None:
+            self._grid.close()
+            self._grid = None
+
+
+class VideoMode:
+    """
+    Continuous acquisition of charge diagrams for interactive tuning. The
+    fast axis is the Keysight sawtooth of fast_charge_diagram, the slow
+    axis is either stepped by a QDac (QDacSlowAxis) or swept by a second
+    sawtooth, acquired with the scope (SawtoothSlowAxis) or the DAQ module
+    (GridSawtoothSlowAxis). Frames go into a ring buffer and the plot
+    is updated in place, together with the achieved frames per second.
+
+    Example:
+        video = VideoMode(QDacSlowAxis(qdac.channels.chan1.v, 0, 0.1, 20),
+                          keysight_channel='ch01', fast_v_start=-0.004,
+                          fast_v_stop=0.004, n_averages=100,
+                          qdac_fast_channel=qdac.channels.chan3.v,
+                          comp_scale=0.5, scope_signal='Demod 1 R')
+        video.run()  # stop with Ctrl-C
+
+    Args:
+        slow_axis (QDacSlowAxis or SawtoothSlowAxis): The slow axis
+        buffer_size (int): The number of frames kept in the ring buffer
+        average_frames (int): The number of frames averaged in the plot
+        plot (bool): Whether to plot the frames live
+        **diagram_kwargs: The fast axis settings, passed on to
+            prepare_fast_charge_diagram
+    """
+
+    def __init__(self, slow_axis, buffer_size=16, average_frames=1,
+                 plot=True, **diagram_kwargs):
+        self.slow_axis = slow_axis
+        self.buffer_size = buffer_size
+        self.average_frames = average_frames
+        self.plot = plot
+        self.diagram_kwargs = diagram_kwargs
+        self.zi = diagram_kwargs.pop('zi', None)
+        self.keysight = diagram_kwargs.pop('keysight', None)
+        self.frames = None
+        self._frame_times = deque(maxlen=buffer_size + 1)
+        self._images = None
+        self._figure = None
+
+    def prepare(self):
+        """
+        Set up the instruments and the frame buffer
+        """
+        if self.zi is None:
+            self.zi = qc.Instrument.find_instrument('ziuhfli')
+        if self.keysight is None:
+            self.keysight = qc.Instrument.find_instrument('keysight_gen_left')
+
+        self.scope_avger, self.ramp = prepare_fast_charge_diagram(
+            zi=self.zi, keysight=self.keysight, **self.diagram_kwargs)
+        self.fast_setpoints = np.asarray(self.scope_avger[0].setpoints[0])
+        self.labels = getattr(self.slow_axis, 'signal_labels',
+                              [avger.label for avger in self.scope_avger])
+        self.frame_shape = (len(self.labels), self.slow_axis.npoints,
+                            len(self.fast_setpoints))
+        self.slow_axis.prepare(self)
+        self.frames = FrameBuffer(self.buffer_size, self.frame_shape)
+
+        # Frames of the sawtooth slow axes are cut from the raw traces and
+        # still need resampling onto the fast setpoints, the QDac rows come
+        # from the (resampled) Scope_avg parameters
+        self.resampler = None
+        column_times = getattr(self.slow_axis, 'column_times', None)
+        if column_times is not None and self.diagram_kwargs.get('linearise',
+                                                                 True):
+            voltages = ramp_voltages(self.fast_setpoints[0],
+                                     self.fast_setpoints[-1], column_times,
+                                     sawtooth_rise_time(self.ramp))
+            self.resampler = LinearResampler(voltages, self.fast_setpoints)
+        self._frame_times.clear()
+
+    @property
+    def fps(self):
+        """
+        The frames per second achieved over the frames in the buffer
+        """
+        if len(self._frame_times) < 2:
+            return float('nan')
+        elapsed = self._frame_times[-1] - self._frame_times[0]
+        return (len(self._frame_times) - 1)/elapsed
+
+    def acquire(self):
+        """
+        Acquire one frame into the buffer and return it, shape (signals,
+        slow points, fast points)
+        """
+        frame = self.slow_axis.acquire_frame(self)
+        if self.resampler is not None:
+            frame = self.resampler(frame)
+        self.frames.append(frame)
+        self._frame_times.append(time.perf_counter())
+        return frame
+
+    def _init_plot(self):
+        nsignals = self.frame_shape[0]
+        self._figure, axes = plt.subplots(1, nsignals, squeeze=False,
+                                          figsize=(5*nsignals, 4))
+        extent = [self.fast_setpoints[0], self.fast_setpoints[-1],
+                  self.slow_axis.setpoints[0], self.slow_axis.setpoints[-1]]
+        self._images = []
+        for ii, ax in enumerate(axes[0]):
+            image = ax.imshow(np.zeros(self.frame_shape[1:]), origin='lower',
+                              aspect='auto', extent=extent)
+            ax.set_xlabel('{} (V)'.format(self.scope_avger[0].setpoint_labels[0]))
+            ax.set_ylabel('{} (V)'.format(self.slow_axis.label))
+            ax.set_title(self.labels[ii])
+            self._figure.colorbar(image, ax=ax)
+            self._images.append(image)
+        plt.show(block=False)
+
+    def _update_plot(self):
+        if self.average_frames > 1:
+            frame = self.frames.mean(self.average_frames)
+        else:
+            frame = self.frames.latest
+        for image, data in zip(self._images, frame):
+            image.set_data(data)
+            if np.isfinite(data).any():
+                image.set_clim(np.nanmin(data), np.nanmax(data))
+        self._figure.suptitle('frame {}, {:.1f} fps'.format(self.frames.count,
+                                                            self.fps))
+        self._figure.canvas.draw_idle()
+        self._figure.canvas.flush_events()
+
+    def run(self, n_frames=None, duration=None):
+        """
+        Acquire frames until n_frames are acquired, duration (s) has
+        passed or the acquisition is interrupted (Ctrl-C)
+
+        Returns:
+            FrameBuffer: The buffer of the last frames
+        """
+        self.prepare()
+        if self.plot:
+            self._init_plot()
+        started = time.perf_counter()
+        try:
+            while True:
+                self.acquire()
+                if self.plot:
+                    self._update_plot()
+                if n_frames is not None and self.frames.count >= n_frames:
+                    break
+                if (duration is not None and
+                        time.perf_counter() - started > duration):
+                    break
+        except KeyboardInterrupt:
+            print('Video mode interrupted.')
+        finally:
+            self.stop()
+        log.info('Acquired {} frames at {:.1f} fps'.format(self.frames.count,
+                                                           self.fps))
+        return self.frames
+
+    def stop(self):
+        """
+        Switch off the sawtooth outputs
+        """
+        keysight_output_off(self.keysight,
+                            self.diagram_kwargs['keysight_channel'])
+        self.slow_axis.finish(self)
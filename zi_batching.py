@@ -0,0 +1,66 @@
+# Module containing the batching of node writes to the ZI data server
+import logging
+
+log = logging.getLogger(__name__)
+
+# Calls of the data server which neither read nor write node values and
+# can therefore pass the pending writes
+NODE_INDEPENDENT_CALLS = frozenset(['listNodes', 'listNodesJSON', 'help',
+                                    'version', 'revision'])
+
+
+class BatchedDAQ:
+    """
+    Stand-in for the ziDAQServer of a ZIUHFLI collecting the node writes
+    (setInt, setDouble) instead of sending them one at a time. The writes
+    are sent as one set call followed by a single sync by flush. Syncs in
+    between are dropped. Every other call goes to the server directly
+    after flushing, such that reads see the pending writes and other
+    writes (e.g. set with a list, setVector, setString) or modules created
+    from the server are applied in the order of the calls.
+
+    Args:
+        daq (ziDAQServer): The data server connection
+        on_failure (Optional[callable]): Called if sending the writes
+            fails, before the error is raised, e.g. to forget the values
+            recorded as written
+    """
+
+    def __init__(self, daq, on_failure=None):
+        self._daq = daq
+        self._on_failure = on_failure
+        self._pending = []
+
+    def setInt(self, path, value):
+        self._pending.append((path, int(value)))
+
+    def setDouble(self, path, value):
+        self._pending.append((path, float(value)))
+
+    def sync(self):
+        # the pending writes are followed by a sync when flushed and all
+        # other calls flush first, so dropping it cannot reorder anything
+        pass
+
+    def flush(self):
+        if not self._pending:
+            return
+        items = self._pending
+        self._pending = []
+        log.debug('Sending {} batched node writes'.format(len(items)))
+        try:
+            self._daq.set(items)
+            self._daq.sync()
+        except Exception:
+            if self._on_failure is not None:
+                self._on_failure()
+            raise
+
+    def __getattr__(self, name):
+        attr = getattr(self._daq, name)
+        if callable(attr) and name not in NODE_INDEPENDENT_CALLS:
+            def flushing(*args, **kwargs):
+                self.flush()
+                return attr(*args, **kwargs)
+            return flushing
+        return attr
@@ -0,0 +1,148 @@
+# Module containing triggered grid acquisitions with the ZI DAQ module
+import logging
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Trigger types and grid modes of the DAQ module
+TRIGGER_TYPES = {'continuous': 0, 'edge': 1, 'digital': 2, 'hardware': 6}
+GRID_MODES = {'nearest': 1, 'linear': 2, 'exact': 4}
+
+
+class DAQModuleGrid:
+    """
+    Triggered grid acquisition of demodulator samples with the data
+    acquisition module of the ZI UHF-LI. Every trigger fills one row of
+    cols points spanning duration, and the data server assembles (and
+    averages over repetitions) the full grid, which is read as one array
+    per signal. There is no arming and reading per row, only per grid.
+
+    The demodulators of the signals must be enabled and their rate must
+    be high enough to give cols points per duration.
+
+    Args:
+        zi (ZIUHFLI): The lock-in
+        signals (list): The signals to record, e.g. ['demods/0/sample.r',
+            'demods/0/sample.auxin0']. Paths are relative to the device.
+        rows (int): The number of rows (triggers) per grid
+        cols (int): The number of points per row
+        duration (float): The duration of each row (s)
+        repetitions (int): The number of grids averaged into one
+        trigger_node (str): The trigger signal, relative to the device
+        trigger_type (str): One of TRIGGER_TYPES
+        delay (float): The delay of the rows after the trigger (s)
+        holdoff (float): The minimal time between triggers (s)
+        grid_mode (str): How the samples are put on the grid, one of
+            GRID_MODES
+        timeout (float): The maximal time to wait for a grid (s)
+    """
+
+    def __init__(self, zi, signals, rows, cols, duration, repetitions=1,
+                 trigger_node='demods/0/sample.TrigIn1',
+                 trigger_type='hardware', delay=0, holdoff=0,
+                 grid_mode='linear', timeout=10):
+        if trigger_type not in TRIGGER_TYPES:
+            raise ValueError('Unknown trigger type {}, must be one of '
+                             '{}'.format(trigger_type, list(TRIGGER_TYPES)))
+        if grid_mode not in GRID_MODES:
+            raise ValueError('Unknown grid mode {}, must be one of '
+                             '{}'.format(grid_mode, list(GRID_MODES)))
+        self.zi = zi
+        self.signals = list(signals)
+        self.rows = rows
+        self.cols = cols
+        self.duration = duration
+        self.repetitions = repetitions
+        self.trigger_node = trigger_node
+        self.trigger_type = trigger_type
+        self.delay = delay
+        self.holdoff = holdoff
+        self.grid_mode = grid_mode
+        self.timeout = timeout
+        self._module = None
+
+    def _path(self, node):
+        return '/{}/{}'.format(self.zi.device, node.lstrip('/'))
+
+    def _set(self, setting, value):
+        self._module.set('dataAcquisitionModule/{}'.format(setting), value)
+
+    def prepare(self):
+        """
+        Create and configure the DAQ module and subscribe to the signals
+        """
+        if self._module is not None:
+            self.close()
+        self._module = self.zi.daq.dataAcquisitionModule()
+        self._set('device', self.zi.device)
+        self._set('type', TRIGGER_TYPES[self.trigger_type])
+        self._set('triggernode', self._path(self.trigger_node))
+        self._set('edge', 1)
+        self._set('grid/mode', GRID_MODES[self.grid_mode])
+        self._set('grid/rows', self.rows)
+        self._set('grid/cols', self.cols)
+        self._set('grid/repetitions', self.repetitions)
+        self._set('grid/direction', 0)
+        self._set('duration', self.duration)
+        self._set('delay', self.delay)
+        self._set('holdoff/time', self.holdoff)
+        self._set('holdoff/count', 0)
+        self._set('count', 1)
+        self._set('endless', 0)
+        for signal in self.signals:
+            self._module.subscribe(self._path(signal))
+
+    def acquire(self):
+        """
+        Acquire one grid
+
+        Returns:
+            array: The grids, shape (signals, rows, cols)
+        """
+        if self._module is None:
+            self.prepare()
+        self._module.execute()
+        deadline = time.perf_counter() + self.timeout
+        while not self._module.finished():
+            if time.perf_counter() > deadline:
+                self._module.finish()
+                raise TimeoutError('No grid of {} rows within {} s, are the '
+                                   'triggers arriving?'.format(self.rows,
+                                                               self.timeout))
+            time.sleep(min(self.duration*self.rows, 10e-3))
+        data = self._module.read(True)
+        # the data server may change the case of the signal names
+        data = {path.lower(): value for path, value in data.items()}
+
+        grids = np.empty((len(self.signals), self.rows, self.cols),
+                         dtype=np.float32)
+        for ii, signal in enumerate(self.signals):
+            path = self._path(signal).lower()
+            if not data.get(path):
+                raise RuntimeError('No data of {} in the grid.'.format(path))
+            grids[ii] = np.reshape(data[path][-1]['value'],
+                                   (self.rows, self.cols))
+        return grids
+
+    def close(self):
+        """
+        Stop and clear the DAQ module
+        """
+        if self._module is None:
+            return
+        try:
+            self._module.finish()
+            self._module.unsubscribe('*')
+            self._module.clear()
+        except Exception as e:
+            log.warning('Could not clear the DAQ module: {}'.format(e))
+        self._module = None
+
+    def __enter__(self):
+        self.prepare()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()